@@ -1,9 +1,75 @@
+import collections
 import concurrent.futures
+import contextlib
+import io
+import itertools
 import math
 import os
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import logging
+import multiprocessing
+import queue
+import shutil
+import signal
+import threading
+import time
+import zlib
+from datetime import datetime
+from mdCandleBuffer import mdCandleBuffer, mdCandleFlushError, mdStreamingCandleBuffer
+from mdCandleSchema import mdCandleSchema, mdParquetOptions
+from mdJsonDecoder import mdJsonDecoder
+from mdLogging import consts as logging_consts, getLogFormatter, mdDownloadProgress
+from mdMetrics import consts as metrics_consts, mdMetrics, mdMetricsExporter
+from mdProductCatalog import consts as product_catalog_consts, mdProductCatalog
+from mdRateLimiter import tokenBucketRateLimiter
+from mdRequestHandler import consts as request_handler_consts, mdRequestError, mdRequestHandler
+from mdResumeIndex import mdResumeIndex
+from mdTaskScheduler import consts as scheduler_consts, mdRecordingTask, mdTaskScheduler
 from totalRequestHandler import totalRequestHandler as requestHandler
+from typing import Callable, Iterator
+
+
+class consts:
+    TRANSPORT_SESSION = 'session'
+    TRANSPORT_EXTERNAL = 'external'
+    PARTITION_FILENAME = 'part-0.parquet'
+    WEEK_IN_SEC = 7 * 24 * 60 * 60
+    FIRST_MONDAY_AFTER_EPOCH_IN_SEC = 4 * 24 * 60 * 60  # 1970-01-05
+    STREAM_FLUSH_INTERVAL_IN_SEC = 1
+    DAEMON_PRODUCT_CATALOG_TTL_IN_SEC = 60 * 60
+    # Runtime state that is not sent to writer processes (connections, thread pools, locks...)
+    WRITER_PROCESS_EXCLUDED_ATTRIBUTES = ['request_handler', 'rate_limiter', 'json_decoder', 'window_executor',
+                                          'product_catalog', 'product_catalog_lock', 'writer_pool', 'write_slots',
+                                          'pending_writes', 'pending_writes_lock', 'metrics_exporter',
+                                          'recorded_products_catalog', 'daemon_stop_event', 'kline_stream',
+                                          'streamed_candles', 'stream_writer', 'stream_stop_event',
+                                          'busy_streamed_series_lock']
+
+
+# Recorder copy used by a writer process (see setWriterPool)
+writer_process_recorder = None
+
+
+def initWriterProcess(recorder, log_level: int, log_format: str | None, log_date_format: str | None) -> None:
+    global writer_process_recorder
+    logging.basicConfig(level=log_level, format=log_format, datefmt=log_date_format)
+    recorder.resume_index.autosave = False  # the index file is owned by the recording process
+    writer_process_recorder = recorder
+
+
+# Returns the resume index entry written for filename, so that the recording process can save it, and the metrics
+# collected while writing, so that it can merge them into its own
+def writeInWriterProcess(candles: pd.DataFrame, filename: str, resume_index_entry: dict | None,
+                         series_labels: dict[str, str]) -> tuple[bool, dict | None, tuple[dict, dict]]:
+    recorder = writer_process_recorder
+    recorder.resume_index.setRawEntry(filename, resume_index_entry)
+    recorder.series_by_filename[filename] = series_labels
+    recorder.metrics = mdMetrics(recorder.exchange_name, recorder.metrics.enabled)
+    success: bool = recorder.writeCandlesToDisk(candles.drop_duplicates(recorder.key_date), filename)
+    return success, recorder.resume_index.getRawEntry(filename), recorder.metrics.getState()
 
 
 class MDRecorderBase:
@@ -14,119 +80,1138 @@ class MDRecorderBase:
         self.api_url: str = api_url
         self.header: list[str] = header
         self.key_date: str = key_date
+        self.date_column_index: int = header.index(key_date)
         self.max_candles_per_api_request: int = max_candles_per_api_request
         self.exchange_name: str = exchange_name
 
         self.interesting_base_currencies: list[str] = interesting_base_currencies
         self.interesting_quote_currencies: list[str] = interesting_quote_currencies
+        # Hashed versions of the above, built once (an empty set means that every currency is interesting)
+        self.interesting_base_currency_set: frozenset[str] = frozenset(interesting_base_currencies or [])
+        self.interesting_quote_currency_set: frozenset[str] = frozenset(interesting_quote_currencies or [])
         self.output_directory: str = output_directory
         self.timeframes: list[str] = timeframes
         self.write_new_files: bool = write_new_files
-        self.request_handler: requestHandler = requestHandler(max_api_requests_per_sec, 1, cooldown_period_in_sec)
+        self.max_api_requests_per_sec: int = max_api_requests_per_sec
+        self.cooldown_period_in_sec: int = cooldown_period_in_sec
+        self.rate_limiter: tokenBucketRateLimiter = tokenBucketRateLimiter(max_api_requests_per_sec)
+        self.http_transport: str = consts.TRANSPORT_SESSION
+        self.http_pool_size: int = 0
+        self.http_keep_alive: bool = True
+        self.max_request_retries: int = request_handler_consts.DEFAULT_MAX_RETRIES
+        self.http_compression: bool = True
+        self.http2: bool = False
+        # Recreated with the final settings (and a pool sized to the worker count) by startRecordingProcess
+        self.request_handler: mdRequestHandler | requestHandler = mdRequestHandler(self.rate_limiter,
+                                                                                   cooldown_period_in_sec)
+        self.json_decoder: mdJsonDecoder = mdJsonDecoder()
+        self.candle_dtypes: dict[str, np.dtype] = {}  # known column dtypes of the exchange's candle arrays
+        self.candle_schema: mdCandleSchema | None = None
+        self.parquet_options: mdParquetOptions = mdParquetOptions()
+        self.max_parallel_windows: int = 1
+        self.window_executor: concurrent.futures.ThreadPoolExecutor | None = None
+        self.flush_every_n_candles: int = 0
+        self.flush_every_n_bytes: int = 0
+        self.product_catalog: mdProductCatalog | None = None
+        self.product_catalog_ttl_in_sec: int = 0
+        self.product_catalog_lock: threading.Lock = threading.Lock()
         self.use_parquet_files: bool = use_parquet_files
+        self.append_only_writes: bool = False
+        self.partitioned_layout: bool = False
+        self.fill_gaps: bool = False
+        self.resume_index: mdResumeIndex = mdResumeIndex(os.path.join(output_directory,
+                                                                      f'.{exchange_name}_resume_index.json'))
+        self.shard_index: int = 0
+        self.num_shards: int = 1
+        self.num_writer_processes: int = 0
+        self.writer_pool: concurrent.futures.ProcessPoolExecutor | None = None
+        self.write_slots: threading.BoundedSemaphore | None = None
+        self.pending_writes: dict[str, concurrent.futures.Future] = {}
+        self.pending_writes_lock: threading.Lock = threading.Lock()
+        self.metrics: mdMetrics = mdMetrics(exchange_name)
+        self.metrics_exporter: mdMetricsExporter | None = None
+        self.metrics_filename: str | None = None
+        self.metrics_format: str = metrics_consts.FORMAT_PROMETHEUS
+        self.metrics_interval_in_sec: float = 0
+        self.series_by_filename: dict[str, dict[str, str]] = {}  # product and timeframe labels of every file
+        self.log_mode: str = logging_consts.LOG_MODE_VERBOSE
+        self.log_sample_interval_in_sec: float = logging_consts.DEFAULT_SAMPLE_INTERVAL_IN_SEC
+        self.priority_symbols: frozenset[str] = frozenset()
+        self.max_running_backfills: int = 0
+        self.recorded_products_catalog: mdProductCatalog | None = None
+        self.recorded_product_ids: tuple[list[str], set[str]] = ([], set())
+        self.daemon_stop_event: threading.Event | None = None
+        self.stream_klines: bool = False
+        self.stream_flush_interval_in_sec: float = consts.STREAM_FLUSH_INTERVAL_IN_SEC
+        self.websocket_url: str | None = None
+        self.kline_stream = None  # mdKlineStream, only imported (with aiohttp) when streaming
+        self.streamed_candles: queue.SimpleQueue | None = None  # (product_id, timeframe, row) of closed candles
+        self.stream_writer: threading.Thread | None = None
+        self.stream_stop_event: threading.Event | None = None
+        self.busy_streamed_series: set[tuple[str, str]] = set()  # series being written or refetched
+        self.busy_streamed_series_lock: threading.Lock = threading.Lock()
+
+    def __getstate__(self) -> dict:
+        state: dict = self.__dict__.copy()
+        for attribute in consts.WRITER_PROCESS_EXCLUDED_ATTRIBUTES:
+            state[attribute] = None
+        return state
+
+    def setAppendOnlyWrites(self, append_only_writes: bool) -> None:
+        self.append_only_writes = append_only_writes
+
+    # Hive style dataset layout for parquet output (see writePartitions). The "filename" of a series is then the
+    # directory holding its partitions.
+    def setPartitionedLayout(self, partitioned_layout: bool) -> None:
+        if partitioned_layout and not self.use_parquet_files:
+            logging.error('The partitioned layout is only supported for parquet files. Writing csv files instead.')
+            return
+        self.partitioned_layout = partitioned_layout
+
+    # Scan every recorded file for missing candles after it is updated and refetch only those (see fillGaps)
+    def setGapFilling(self, fill_gaps: bool) -> None:
+        self.fill_gaps = fill_gaps
+
+    # Restricts this recorder to the products whose (process independent) hash falls into shard_index. Each shard keeps
+    # its own resume index, since the processes recording the other shards would otherwise overwrite its entries.
+    def setShard(self, shard_index: int, num_shards: int) -> None:
+        self.shard_index = shard_index
+        self.num_shards = max(1, num_shards)
+        if self.num_shards > 1:
+            self.resume_index = mdResumeIndex(os.path.join(
+                self.output_directory, f'.{self.exchange_name}_resume_index.shard{shard_index}of{num_shards}.json'))
+
+    def isInShard(self, product_id: str) -> bool:
+        return self.num_shards == 1 or zlib.crc32(product_id.encode()) % self.num_shards == self.shard_index
+
+    # With num_writer_processes > 0, writeToDisk hands the downloaded candles to a pool of writer processes and returns
+    # right away, so that network workers keep sending requests while the files are merged, checked and encoded.
+    # At most max_pending_writes writes can be queued; beyond that, writeToDisk blocks until a writer catches up.
+    # Streaming downloads (see setStreamingFlush) are still written by the network workers.
+    def setWriterPool(self, num_writer_processes: int, max_pending_writes: int = 0) -> None:
+        self.num_writer_processes = max(0, num_writer_processes)
+        if self.num_writer_processes > 0:
+            self.write_slots = threading.BoundedSemaphore(max_pending_writes if max_pending_writes > 0
+                                                          else 2 * self.num_writer_processes)
+
+    def createWriterPool(self) -> concurrent.futures.ProcessPoolExecutor:
+        root_logger: logging.Logger = logging.getLogger()
+        formatter: logging.Formatter | None = getLogFormatter()
+        # Spawned rather than forked, since forking while the network worker threads are running is not safe
+        return concurrent.futures.ProcessPoolExecutor(
+            max_workers=self.num_writer_processes, mp_context=multiprocessing.get_context('spawn'),
+            initializer=initWriterProcess, initargs=(self, root_logger.level, formatter._fmt if formatter else None,
+                                                     formatter.datefmt if formatter else None))
+
+    def submitWrite(self, candles: pd.DataFrame, filename: str) -> bool:
+        self.write_slots.acquire()
+        try:
+            future: concurrent.futures.Future = self.writer_pool.submit(
+                writeInWriterProcess, candles, filename, self.resume_index.getRawEntry(filename),
+                self.getSeriesLabels(filename))
+        except Exception as e:
+            self.write_slots.release()
+            logging.error(f'Could not queue write of {filename} ({e})')
+            return False
+        future.add_done_callback(lambda f: self.onWriteDone(f, filename))
+        with self.pending_writes_lock:
+            self.pending_writes[filename] = future
+        logging.info(f'Queued {len(candles)} candles for writing to {filename}')
+        return True
+
+    def onWriteDone(self, future: concurrent.futures.Future, filename: str) -> None:
+        self.write_slots.release()
+        if not future.cancelled() and future.exception() is None:
+            success, resume_index_entry, metrics_state = future.result()
+            self.metrics.merge(metrics_state)
+            if success:
+                self.resume_index.setRawEntry(filename, resume_index_entry)
+
+    # Waits for the queued write of filename (if any) and returns whether it succeeded
+    def waitForWrite(self, filename: str) -> bool:
+        with self.pending_writes_lock:
+            future: concurrent.futures.Future | None = self.pending_writes.pop(filename, None)
+        if future is None:
+            return True
+        try:
+            return future.result()[0]
+        except Exception as e:
+            logging.error(f'Writer process failed to write {filename} ({e})')
+            return False
+
+    # Collects request, rate limiter, write and merge metrics and exports them to filename every interval_in_sec (and
+    # once more when the recording process is done), in the Prometheus text format or as JSON (see mdMetrics)
+    def setMetricsExport(self, filename: str, export_format: str, interval_in_sec: float) -> None:
+        self.metrics.enabled = True
+        self.metrics_filename = filename
+        self.metrics_format = export_format
+        self.metrics_interval_in_sec = interval_in_sec
+
+    # With stream_klines, the daemon writes the candles of the timeframes that the exchange streams as they close
+    # instead of polling them (see startKlineStream). websocket_url = None uses the exchange's default. The closed
+    # candles of each series are collected for flush_interval_in_sec and written together (see runStreamWriter).
+    def setKlineStreaming(self, stream_klines: bool, websocket_url: str | None,
+                          flush_interval_in_sec: float = consts.STREAM_FLUSH_INTERVAL_IN_SEC) -> None:
+        self.stream_klines = stream_klines
+        self.websocket_url = websocket_url
+        self.stream_flush_interval_in_sec = flush_interval_in_sec
+
+    # In sampled mode, the pages of a download are only logged at DEBUG and summarized per download (see
+    # mdDownloadProgress), and the list of interesting products is only logged at DEBUG
+    def setLogMode(self, log_mode: str, sample_interval_in_sec: float) -> None:
+        if log_mode not in (logging_consts.LOG_MODE_VERBOSE, logging_consts.LOG_MODE_SAMPLED):
+            logging.error(f'Unsupported log mode:{log_mode}. Using {logging_consts.LOG_MODE_VERBOSE} instead.')
+            return
+        self.log_mode = log_mode
+        self.log_sample_interval_in_sec = sample_interval_in_sec
+
+    def createDownloadProgress(self, product_id: str, timeframe: str) -> mdDownloadProgress:
+        return mdDownloadProgress(f'{timeframe} candles for {product_id}', self.log_mode,
+                                  self.log_sample_interval_in_sec, self.getTimestampUnitsPerSec())
+
+    # Products (or every product of a coin) in priority_symbols are recorded before the others. At most
+    # max_running_backfills worker threads run backfills at the same time (0 = half of them), so that incremental
+    # updates never wait for a few long backfills (see mdTaskScheduler).
+    def setTaskScheduling(self, priority_symbols: list[str], max_running_backfills: int) -> None:
+        self.priority_symbols = frozenset(priority_symbols or [])
+        self.max_running_backfills = max(0, max_running_backfills)
+
+    def getSeriesLabels(self, filename: str) -> dict[str, str]:
+        return self.series_by_filename.get(filename, {})
+
+    def measureWrite(self, filename: str) -> contextlib.AbstractContextManager:
+        return self.metrics.measure(metrics_consts.WRITE_DURATION, metrics_consts.WRITE_SECONDS,
+                                    **self.getSeriesLabels(filename))
+
+    def measureMerge(self, filename: str) -> contextlib.AbstractContextManager:
+        return self.metrics.measure(metrics_consts.MERGE_DURATION, metrics_consts.MERGE_SECONDS,
+                                    **self.getSeriesLabels(filename))
+
+    def setJsonDecoder(self, json_decoder: mdJsonDecoder) -> None:
+        self.json_decoder = json_decoder
+
+    # Declared column types (see mdCandleSchema). They replace the dtypes known by the recorder and are applied to new
+    # as well as existing candles, so that the dtype conversion fallbacks of the write paths are no longer hit.
+    def setCandleSchema(self, candle_schema: mdCandleSchema) -> None:
+        self.candle_schema = candle_schema
+        self.candle_dtypes = candle_schema.getCandleDtypes()
+
+    def setParquetOptions(self, parquet_options: mdParquetOptions) -> None:
+        self.parquet_options = parquet_options
+
+    # The same limiter instance is shared by every worker thread
+    def setRateLimiter(self, rate_limiter: tokenBucketRateLimiter) -> None:
+        self.rate_limiter = rate_limiter
+
+    # http_transport 'external' keeps using totalRequestHandler (which ignores the other settings and the rate
+    # limiter). An http_pool_size of 0 sizes the connection pool to the number of threads that send requests.
+    def setHttpTransport(self, http_transport: str, http_pool_size: int, http_keep_alive: bool,
+                         http_compression: bool, http2: bool) -> None:
+        self.http_transport = http_transport
+        self.http_pool_size = max(0, http_pool_size)
+        self.http_keep_alive = http_keep_alive
+        self.http_compression = http_compression
+        self.http2 = http2
+
+    # Rate limited, server error and failed requests are retried up to max_request_retries times before the download
+    # that sent them fails (see mdRequestHandler)
+    def setMaxRequestRetries(self, max_request_retries: int) -> None:
+        self.max_request_retries = max(0, max_request_retries)
+
+    def createRequestHandler(self, max_threads: int) -> mdRequestHandler | requestHandler:
+        # Window fetches run on their own threads, so they need connections of their own
+        pool_size: int = self.http_pool_size or max_threads + (self.max_parallel_windows
+                                                               if self.max_parallel_windows > 1 else 0)
+        if self.http_transport == consts.TRANSPORT_EXTERNAL:
+            return requestHandler(self.max_api_requests_per_sec, 1, self.cooldown_period_in_sec)
+        if self.http_transport != consts.TRANSPORT_SESSION:
+            logging.error(f'Unsupported http transport:{self.http_transport}. Using {consts.TRANSPORT_SESSION} instead.')
+        return mdRequestHandler(self.rate_limiter, self.cooldown_period_in_sec, pool_size, self.http_keep_alive,
+                                self.http_compression, self.http2, self.metrics, self.max_request_retries)
+
+    # Sends a request for the candles of product_id/timeframe, labelling its request metrics with them (the external
+    # transport takes neither labels nor metrics)
+    def getSeriesResponse(self, url: str, params: dict[str, str], product_id: str, timeframe: str):
+        if isinstance(self.request_handler, mdRequestHandler):
+            return self.request_handler.get(url, params, product_id, timeframe)
+        return self.request_handler.get(url, params)
+
+    # With a TTL > 0, a product catalog persisted by an earlier run is reused as long as it is younger than the TTL
+    def setProductCatalogTTL(self, product_catalog_ttl_in_sec: int) -> None:
+        self.product_catalog_ttl_in_sec = product_catalog_ttl_in_sec
+
+    # 0 disables the respective limit. If both are 0, candles are only written once the download is complete.
+    def setStreamingFlush(self, flush_every_n_candles: int, flush_every_n_megabytes: float) -> None:
+        self.flush_every_n_candles = max(0, flush_every_n_candles)
+        self.flush_every_n_bytes = max(0, int(flush_every_n_megabytes * 1024 * 1024))
+
+    # The window executor is shared by all products so that the total number of in-flight window requests stays
+    # bounded no matter how many products are being backfilled at the same time
+    def setMaxParallelWindows(self, max_parallel_windows: int) -> None:
+        self.max_parallel_windows = max(1, max_parallel_windows)
+        if self.max_parallel_windows > 1:
+            self.window_executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_parallel_windows,
+                                                                         thread_name_prefix='window')
+
+    # Splits [start_time, end_time) into contiguous windows of window_size, oldest first (or newest first if
+    # descending). Windows are generated lazily because the lower bound of a fresh backfill may be unknown (0).
+    @staticmethod
+    def planRequestWindows(start_time: int, end_time: int, window_size: int,
+                           descending: bool = False) -> Iterator[tuple[int, int]]:
+        if descending:
+            window_end: int = end_time
+            while window_end > start_time:
+                yield max(start_time, window_end - window_size), window_end
+                window_end -= window_size
+        else:
+            window_start: int = start_time
+            while window_start < end_time:
+                yield window_start, min(end_time, window_start + window_size)
+                window_start += window_size
+
+    # Fetches the planned windows concurrently (at most max_parallel_windows in flight) and yields the non-empty
+    # responses in window order so that they can simply be concatenated. Like the sequential loops, it stops after
+    # 3 consecutive empty responses.
+    def fetchWindowsInParallel(self, windows: Iterator[tuple[int, int]],
+                               fetch_window: Callable[[int, int], list[list]]) -> Iterator[list[list]]:
+        in_flight: collections.deque[concurrent.futures.Future] = collections.deque(
+            self.window_executor.submit(fetch_window, *window)
+            for window in itertools.islice(windows, self.max_parallel_windows))
+        num_empty_responses: int = 0
+        try:
+            while in_flight and num_empty_responses < 3:
+                r_json: list[list] = in_flight.popleft().result()
+                for window in itertools.islice(windows, 1):
+                    in_flight.append(self.window_executor.submit(fetch_window, *window))
+                if len(r_json) == 0:
+                    num_empty_responses += 1
+                    logging.log(logging.DEBUG if self.log_mode == logging_consts.LOG_MODE_SAMPLED else logging.INFO,
+                                logging_consts.EMPTY_PAGE_MESSAGE, num_empty_responses)
+                    continue
+                num_empty_responses = 0
+                yield r_json
+        finally:
+            for future in in_flight:
+                future.cancel()
+            # Windows that were already being fetched can't be cancelled. Wait for them, so that no request of this
+            # download is still being sent once it is over.
+            concurrent.futures.wait(in_flight)
 
     @staticmethod
     def getProductIdFromCoinAndQuoteCurrency(coin_name: str, quote_currency: str) -> str:
         return f'{coin_name}-{quote_currency}'
 
     def getFilenameFromProductIdAndTimeframe(self, product_id: str, timeframe: str) -> str:
+        if self.partitioned_layout:
+            return os.path.join(self.output_directory, f'exchange={self.exchange_name}', f'product={product_id}',
+                                f'timeframe={timeframe}')
         extension = 'parquet' if self.use_parquet_files else 'csv'
         file_name: str = os.path.join(self.output_directory,
                                       f'{self.exchange_name}_{product_id}_{timeframe}.{extension}')
         return file_name
 
+    def getMDFileExtension(self) -> str:
+        return '.parquet' if self.use_parquet_files else '.csv'
+
+    # True if filename is a non-empty market data file (or, with the partitioned layout, has any partition)
+    def isExistingMDFile(self, filename: str) -> bool:
+        if self.partitioned_layout:
+            return len(self.getPartitionFilenames(filename)) > 0
+        return os.path.isfile(filename) and os.path.getsize(filename) > 0
+
     def getLatestTimestampFromFile(self, filename: str) -> int:
-        if not os.path.isfile(filename) or os.path.getsize(filename) == 0:
+        if not self.isExistingMDFile(filename):
             return 0
+        if self.partitioned_layout:
+            # Only the footer of the latest partition has to be read, so there is no need for the resume index
+            latest_timestamp: float = self.getLatestTimestampFromParquetFooter(self.getPartitionFilenames(filename)[-1])
+            return 0 if math.isnan(latest_timestamp) else int(latest_timestamp)
+
+        indexed_latest_timestamp: int | None = self.resume_index.getLatestTimestamp(filename)
+        if indexed_latest_timestamp is not None:
+            return indexed_latest_timestamp
 
-        all_candles: pd.DataFrame = self.readMDFile(filename)
-        latest_timestamp: int = all_candles[self.key_date].max()
+        if self.use_parquet_files:
+            latest_timestamp = self.getLatestTimestampFromParquetFooter(filename)
+        else:
+            _, tail_lines = self.readCSVTailLines(filename, math.inf)
+            date_index: int = self.header.index(self.key_date)
+            latest_timestamp = float(tail_lines[-1][1].split(b',')[date_index]) if tail_lines else 0
         if math.isnan(latest_timestamp):
             latest_timestamp = 0
+        return int(latest_timestamp)
+
+    # Uses the row group statistics stored in the parquet footer so that no data pages need to be read. Falls back to
+    # reading only the date column if a writer did not store statistics.
+    def getLatestTimestampFromParquetFooter(self, filename: str) -> float:
+        metadata: pq.FileMetaData = pq.ParquetFile(filename).metadata
+        latest_timestamp: float = math.nan
+        for i in range(metadata.num_row_groups):
+            row_group: pq.RowGroupMetaData = metadata.row_group(i)
+            if row_group.num_rows == 0:
+                continue
+            column: pq.ColumnChunkMetaData = next(row_group.column(j) for j in range(row_group.num_columns)
+                                                  if row_group.column(j).path_in_schema == self.key_date)
+            if column.statistics is None or not column.statistics.has_min_max:
+                date_column: pd.Series = pd.read_parquet(filename, columns=[self.key_date])[self.key_date]
+                return date_column.max() if len(date_column) > 0 else math.nan
+            if math.isnan(latest_timestamp) or column.statistics.max > latest_timestamp:
+                latest_timestamp = column.statistics.max
         return latest_timestamp
 
     @staticmethod
-    def getLastNonBlankLineFromFile(filename: str) -> str:
-        last_line: str = ''
-        for line in open(filename):
-            if line.strip():
-                last_line = line.strip()
-        return last_line
+    def getLastNonBlankLineFromFile(filename: str, block_size: int = 1 << 12) -> str:
+        with open(filename, 'rb') as f:
+            position: int = f.seek(0, os.SEEK_END)
+            buffer: bytes = b''
+            while position > 0:
+                read_size: int = min(block_size, position)
+                position -= read_size
+                f.seek(position)
+                buffer = f.read(read_size) + buffer
+                lines: list[bytes] = [line for line in buffer.split(b'\n') if line.strip()]
+                # Only trust the last line once a newline before it was seen (or the start of the file was reached)
+                if len(lines) > 1 or (position == 0 and lines):
+                    return lines[-1].decode().strip()
+        return ''
 
     def getDateTimestampFromLine(self, line: str) -> int:
         if not line:
             return 0
-        elements_arr: list[str] = [x.strip() for x in line.split(',')]
-        df: pd.DataFrame = pd.DataFrame([elements_arr], columns=self.header)
-        return int(df.at[0, self.key_date])
+        return int(line.split(',')[self.date_column_index].strip())
+
+    def getDateTimestampFromRow(self, row: list) -> int:
+        return int(row[self.date_column_index])
+
+    # Returns (earliest, latest) timestamp of a whole response, regardless of the order the exchange returns it in
+    def getDateTimestampRangeFromRows(self, rows: list[list]) -> tuple[int, int]:
+        timestamps: np.ndarray = np.fromiter((row[self.date_column_index] for row in rows), dtype=np.int64,
+                                             count=len(rows))
+        return int(timestamps.min()), int(timestamps.max())
+
+    # Last candle of a market data file as a comma separated line (i.e. like the last line of a csv file)
+    def getLastCandleLineFromFile(self, filename: str) -> str:
+        if not self.use_parquet_files:
+            return self.getLastNonBlankLineFromFile(filename)
+        last_filename: str = self.getPartitionFilenames(filename)[-1] if os.path.isdir(filename) else filename
+        last_row: tuple = next(pd.read_parquet(last_filename).tail(1).itertuples(index=False))  # keeps ints as ints
+        return ','.join(str(x) for x in last_row)
 
     def readMDFile(self, filename: str, csv_dtypes: dict | None = None) -> pd.DataFrame:
+        if os.path.isdir(filename):
+            partitions: list[pd.DataFrame] = [self.conformCandles(pd.read_parquet(x))
+                                              for x in self.getPartitionFilenames(filename)]
+            return pd.concat(partitions, ignore_index=True) if partitions else pd.DataFrame([], columns=self.header)
         if self.use_parquet_files:
-            return pd.read_parquet(filename)
+            return self.conformCandles(pd.read_parquet(filename))
         else:
-            return pd.read_csv(filename, dtype=csv_dtypes)
+            return self.conformCandles(pd.read_csv(filename, dtype=csv_dtypes))
+
+    def conformCandles(self, candles: pd.DataFrame) -> pd.DataFrame:
+        return candles if self.candle_schema is None else self.candle_schema.conform(candles)
+
+    def toArrowTable(self, candles: pd.DataFrame, schema: pa.Schema | None = None) -> pa.Table:
+        if self.candle_schema is None:
+            return pa.Table.from_pandas(candles, schema=schema, preserve_index=False)
+        return self.candle_schema.toArrowTable(candles)
 
-    def writeToDisk(self, data: list[list], filename: str) -> bool:
-        candles: pd.DataFrame = pd.DataFrame(data, columns=self.header).drop_duplicates(self.key_date)
-        if not self.write_new_files and os.path.isfile(filename):
+    def writeParquetFile(self, candles: pd.DataFrame, filename: str) -> None:
+        self.parquet_options.writeTable(self.toArrowTable(candles), filename)
+
+    # Parquet files can't be appended to in place (their footer describes every row group), so appending to a single
+    # parquet file means rewriting all of it. Only CSV files and partitioned datasets, where just the latest
+    # partitions are rewritten, support append-only writes.
+    def canAppendToFiles(self) -> bool:
+        return not self.use_parquet_files or self.partitioned_layout
+
+    # Walks backwards from EOF and returns the header line along with (offset, line) for every line whose date is
+    # >= min_timestamp. The last line of the file is always returned. Relies on the file being sorted by date.
+    def readCSVTailLines(self, filename: str, min_timestamp: float,
+                         block_size: int = 1 << 16) -> tuple[bytes, list[tuple[int, bytes]]]:
+        with open(filename, 'rb') as f:
+            header_line: bytes = f.readline().rstrip(b'\r\n')
+            date_index: int = [x.strip() for x in header_line.decode().split(',')].index(self.key_date)
+            data_start: int = f.tell()
+            position: int = f.seek(0, os.SEEK_END)
+            buffer: bytes = b''
+            while position > data_start:
+                read_size: int = min(block_size, position - data_start)
+                position -= read_size
+                f.seek(position)
+                buffer = f.read(read_size) + buffer
+                # Unless the start of the data was reached, the first line in the buffer may be incomplete
+                lines_start: int = 0 if position == data_start else buffer.find(b'\n') + 1
+                if lines_start == 0 and position != data_start:
+                    continue
+                complete_lines: list[bytes] = [line for line in buffer[lines_start:].split(b'\n') if line.strip()]
+                if complete_lines and float(complete_lines[0].split(b',')[date_index]) < min_timestamp:
+                    break
+
+        tail_lines: list[tuple[int, bytes]] = []
+        lines_start = 0 if position == data_start else buffer.find(b'\n') + 1
+        offset: int = position + lines_start
+        for line in buffer[lines_start:].split(b'\n'):
+            if line.strip():
+                tail_lines.append((offset, line.rstrip(b'\r')))
+            offset += len(line) + 1
+
+        if len(tail_lines) == 0:
+            return header_line, []
+        first_index: int = next((i for i, (_, line) in enumerate(tail_lines)
+                                 if float(line.split(b',')[date_index]) >= min_timestamp), len(tail_lines) - 1)
+        return header_line, tail_lines[first_index:]
+
+    # Returns the rows of an existing CSV file whose date is >= min_timestamp (always at least the last row) without
+    # loading the whole file
+    def readMDFileTail(self, filename: str, min_timestamp: float, csv_dtypes: dict | None = None) -> pd.DataFrame:
+        header_line, tail_lines = self.readCSVTailLines(filename, min_timestamp)
+        csv_bytes: bytes = b'\n'.join([header_line] + [line for _, line in tail_lines])
+        return self.conformCandles(pd.read_csv(io.BytesIO(csv_bytes), dtype=csv_dtypes))
+
+    # Append-only counterpart of writeToDisk: only the part of the existing file that overlaps with the new candles
+    # is read and validated, then the new candles are appended. Falls back to a full rewrite if the new candles
+    # would have to be inserted in the middle of the existing data, or if the file can't be appended to (see
+    # canAppendToFiles).
+    def appendToDisk(self, candles: pd.DataFrame, filename: str) -> bool:
+        if len(candles) == 0:
+            logging.info(f'No new candles to append to existing data file:{filename}')
+            return True
+        if self.partitioned_layout:
+            return self.writePartitions(candles, filename, merge_existing=True)
+        if not self.canAppendToFiles():
+            return self.mergeAndWriteToDisk(candles, filename)
+
+        with self.measureMerge(filename):
+            previous_row_count: int | None = self.resume_index.getRowCount(filename)
+            earliest_new_timestamp = candles[self.key_date].min()
             try:
-                old_candles: pd.DataFrame = self.readMDFile(filename, candles.dtypes.to_dict())
-                candles = pd.merge(candles, old_candles, how='outer').drop_duplicates(self.key_date)
+                old_tail: pd.DataFrame = self.readMDFileTail(filename, earliest_new_timestamp, candles.dtypes.to_dict())
+                old_tail.merge(candles)
             except Exception as e:
-                old_candles = self.readMDFile(filename)
+                old_tail = self.readMDFileTail(filename, earliest_new_timestamp)
                 type1: pd.Series = candles.dtypes
-                type2: pd.Series = old_candles.dtypes
-                logging.exception(f'Caught exception "{e}" while reading/writing file {filename}.\n'
-                                  f'Type1:{type1}\nType2:{type2}')
-                try:
-                    logging.exception(f'Trying to convert new candles to Type2 instead.')
-                    for key, value in type2.items():
-                        candles[key] = candles[key].astype(value)
-                    candles = pd.merge(candles, old_candles, how='outer').drop_duplicates(self.key_date)
-                    logging.info(f'Converted new candles to Type2 successfully')
-                except Exception as e:
-                    logging.exception(f'Caught exception "{e}" while retrying. Skipping...\n'
+                type2: pd.Series = old_tail.dtypes
+                converted_old_tail: pd.DataFrame | None = self.convertExistingCandles(old_tail, candles, filename)
+                if converted_old_tail is not None:
+                    old_tail = converted_old_tail
+                else:
+                    logging.exception(f'Caught exception "{e}" while reading/appending file {filename}.\n'
                                       f'Type1:{type1}\nType2:{type2}')
-                    return False
+                    try:
+                        logging.exception(f'Trying to convert new candles to Type2 instead.')
+                        candles = candles.astype(type2.to_dict())
+                        old_tail.merge(candles)
+                        logging.info(f'Converted new candles to Type2 successfully')
+                    except Exception as e:
+                        logging.exception(f'Caught exception "{e}" while retrying. Skipping...\n'
+                                          f'Type1:{type1}\nType2:{type2}')
+                        return False
 
-            # Sanity check of new data (check that all the "old_candles" (except the last one) exist is "candles"
-            if len(old_candles.iloc[:-1,:].merge(candles)) == len(old_candles.iloc[:-1,:]):
-                logging.info(f'Sanity check passed before rewriting existing data file:{filename}')
-            else:
-                logging.error(f'Differences found between existing and new candles when writing file:{filename}. '
-                              f'Not updating this file. Investigate further.')
+            if len(old_tail) == 0:
+                logging.info(f'Existing data file:{filename} has no candles. Rewriting it.')
+                return self.writeNewFile(candles, filename)
+
+            latest_old_timestamp = old_tail[self.key_date].iloc[-1]
+            overlapping_new_candles: pd.DataFrame = candles[candles[self.key_date] < latest_old_timestamp]
+            if not overlapping_new_candles[self.key_date].isin(old_tail[self.key_date]).all():
+                logging.info(f'New candles fill gaps inside existing data file:{filename}. '
+                             f'Falling back to full rewrite.')
+                return self.mergeAndWriteToDisk(candles, filename)
+
+            if not self.checkCandlesConsistency(old_tail, candles, filename, 'appending to'):
                 return False
 
-        candles.sort_values(self.key_date, inplace=True)
+        new_candles: pd.DataFrame = candles[candles[self.key_date] >= latest_old_timestamp]
+        new_candles = new_candles.sort_values(self.key_date)
+        replace_last_row: bool = False
+        if len(new_candles) > 0 and new_candles[self.key_date].iloc[0] == latest_old_timestamp:
+            if len(old_tail.iloc[-1:, :].merge(new_candles.iloc[:1, :])) == 1:
+                new_candles = new_candles.iloc[1:, :]
+            else:
+                replace_last_row = True
+
+        if len(new_candles) == 0:
+            logging.info(f'Nothing to append to existing data file:{filename}')
+            return True
+
+        self.appendToCSVFile(new_candles, filename, replace_last_row)
+        row_count: int | None = None if previous_row_count is None else \
+            previous_row_count + len(new_candles) - int(replace_last_row)
+        self.resume_index.update(filename, new_candles[self.key_date].iloc[-1], row_count)
+        logging.info(f'Appended {len(new_candles)} candles to {filename} (replacedLastRow:{replace_last_row})')
+        return True
+
+    # Returns the timestamps of the existing candles (except the last one, which may have been incomplete when it was
+    # recorded) whose values differ from the new candle with the same timestamp. Only the timestamp range covered by
+    # new_candles is compared, by looking up each existing timestamp in the sorted new timestamps and comparing a hash
+    # over all the values of both rows. Existing candles that the new candles don't have are not differences.
+    def findDifferingCandles(self, existing_candles: pd.DataFrame, new_candles: pd.DataFrame) -> np.ndarray:
+        existing_candles = existing_candles.iloc[:-1, :]
+        if len(existing_candles) == 0 or len(new_candles) == 0:
+            return np.empty(0)
+        if not existing_candles[self.key_date].is_monotonic_increasing:
+            existing_candles = existing_candles.sort_values(self.key_date)
+        if not new_candles[self.key_date].is_monotonic_increasing:
+            new_candles = new_candles.sort_values(self.key_date)
 
+        new_timestamps: np.ndarray = new_candles[self.key_date].to_numpy()
+        existing_timestamps: np.ndarray = existing_candles[self.key_date].to_numpy()
+        first: int = int(np.searchsorted(existing_timestamps, new_timestamps[0], side='left'))
+        last: int = int(np.searchsorted(existing_timestamps, new_timestamps[-1], side='right'))
+        overlap: pd.DataFrame = existing_candles.iloc[first:last, :]
+        overlap_timestamps: np.ndarray = existing_timestamps[first:last]
+        positions: np.ndarray = np.minimum(np.searchsorted(new_timestamps, overlap_timestamps), len(new_timestamps) - 1)
+        found: np.ndarray = new_timestamps[positions] == overlap_timestamps
+        overlap, positions = overlap[found], positions[found]
+        if len(overlap) == 0:
+            return np.empty(0)
+
+        matching_new_candles: pd.DataFrame = new_candles.iloc[positions][list(overlap.columns)]
+        try:
+            overlap = overlap.astype(matching_new_candles.dtypes.to_dict())
+        except (ValueError, TypeError):
+            pass  # rows with values that can't be converted are reported as differences
+        existing_hashes: np.ndarray = pd.util.hash_pandas_object(overlap, index=False).to_numpy()
+        new_hashes: np.ndarray = pd.util.hash_pandas_object(matching_new_candles, index=False).to_numpy()
+        return overlap_timestamps[found][existing_hashes != new_hashes]
+
+    # Sanity check of new data before writing it to an existing file (see findDifferingCandles)
+    def checkCandlesConsistency(self, existing_candles: pd.DataFrame, new_candles: pd.DataFrame, filename: str,
+                                action: str) -> bool:
+        differing_timestamps: np.ndarray = self.findDifferingCandles(existing_candles, new_candles)
+        if len(differing_timestamps) == 0:
+            logging.info(f'Sanity check passed before {action} existing data file:{filename}')
+            return True
+        max_logged_timestamps: int = 20
+        timestamps_str: str = ', '.join(str(x) for x in differing_timestamps[:max_logged_timestamps])
+        if len(differing_timestamps) > max_logged_timestamps:
+            timestamps_str += ', ...'
+        logging.error(f'Differences found between existing and new candles when writing file:{filename}. '
+                      f'NumDifferingCandles:{len(differing_timestamps)} Timestamps:[{timestamps_str}]. '
+                      f'Not updating this file. Investigate further.')
+        return False
+
+    def appendToCSVFile(self, new_candles: pd.DataFrame, filename: str, replace_last_row: bool) -> None:
+        _, tail_lines = self.readCSVTailLines(filename, math.inf)
+        with open(filename, 'r+b') as f:
+            end_offset: int = f.seek(0, os.SEEK_END)
+            if replace_last_row:
+                f.seek(tail_lines[-1][0])
+                f.truncate()
+            elif end_offset > 0:
+                f.seek(end_offset - 1)
+                if f.read(1) != b'\n':
+                    f.write(b'\n')
+            f.write(new_candles.to_csv(index=False, header=False).encode())
+
+    def writeNewFile(self, candles: pd.DataFrame, filename: str) -> bool:
+        if self.partitioned_layout:
+            return self.writePartitions(candles, filename, merge_existing=False)
+        candles = candles.sort_values(self.key_date)
         if self.use_parquet_files:
-            candles.to_parquet(filename, index=False)
+            self.writeParquetFile(candles, filename)
         else:
             candles.to_csv(filename, index=False)
+        if len(candles) > 0:
+            self.resume_index.update(filename, candles[self.key_date].iloc[-1], len(candles))
         return True
 
+    def getPartitionFilenames(self, dataset_directory: str) -> list[str]:
+        if not os.path.isdir(dataset_directory):
+            return []
+        partition_filenames: list[str] = []
+        for year_directory in sorted(x for x in os.listdir(dataset_directory) if x.startswith('year=')):
+            year_path: str = os.path.join(dataset_directory, year_directory)
+            for month_directory in sorted(x for x in os.listdir(year_path) if x.startswith('month=')):
+                partition_filename: str = os.path.join(year_path, month_directory, consts.PARTITION_FILENAME)
+                if os.path.isfile(partition_filename):
+                    partition_filenames.append(partition_filename)
+        return partition_filenames  # oldest first, since year and month are zero padded
+
+    @staticmethod
+    def getPartitionFilename(dataset_directory: str, year: int, month: int) -> str:
+        return os.path.join(dataset_directory, f'year={year:04d}', f'month={month:02d}', consts.PARTITION_FILENAME)
+
+    # Exchanges send either seconds or milliseconds since the epoch. 1e11s is more than 3000 years away while 1e11ms
+    # is in 1973, so larger timestamps have to be in milliseconds.
+    @staticmethod
+    def getDatetimesFromTimestamps(timestamps: pd.Series) -> pd.Series:
+        return pd.to_datetime(timestamps, unit='ms' if timestamps.max() > 1e11 else 's')
+
+    # Writes candles to the monthly partitions of a dataset directory ({dataset}/year=YYYY/month=MM/part-0.parquet),
+    # so that readers can prune partitions by time. Only the partitions that candles fall into are touched: with
+    # merge_existing, each of them is read, sanity checked and merged with the new candles; without it, they are
+    # replaced and all the other partitions of the dataset are removed. Every partition is checked and written to a
+    # temp file first, and the temp files only replace the partitions once all of them are written, so that a failed
+    # check leaves the whole dataset unchanged.
+    def writePartitions(self, candles: pd.DataFrame, dataset_directory: str, merge_existing: bool) -> bool:
+        candles = candles.sort_values(self.key_date)
+        temp_filenames: dict[str, str] = {}  # partition filename -> temp filename
+        try:
+            if len(candles) > 0:
+                datetimes: pd.Series = self.getDatetimesFromTimestamps(candles[self.key_date])
+                for (year, month), partition_candles in candles.groupby([datetimes.dt.year.to_numpy(),
+                                                                         datetimes.dt.month.to_numpy()], sort=True):
+                    partition_filename: str = self.getPartitionFilename(dataset_directory, year, month)
+                    if merge_existing and os.path.isfile(partition_filename):
+                        partition_candles = self.mergePartition(partition_candles, partition_filename,
+                                                                dataset_directory)
+                        if partition_candles is None:
+                            return False
+
+                    os.makedirs(os.path.dirname(partition_filename), exist_ok=True)
+                    temp_filename: str = f'{partition_filename}.{os.getpid()}.tmp'
+                    temp_filenames[partition_filename] = temp_filename
+                    self.writeParquetFile(partition_candles, temp_filename)
+
+            for partition_filename, temp_filename in temp_filenames.items():
+                os.replace(temp_filename, partition_filename)
+            written_partition_filenames: set[str] = set(temp_filenames)
+            temp_filenames = {}
+        finally:
+            for temp_filename in temp_filenames.values():
+                if os.path.isfile(temp_filename):
+                    os.remove(temp_filename)
+
+        if not merge_existing:
+            for partition_filename in self.getPartitionFilenames(dataset_directory):
+                if partition_filename not in written_partition_filenames:
+                    os.remove(partition_filename)
+        partition_filenames: list[str] = self.getPartitionFilenames(dataset_directory)
+        if len(partition_filenames) > 0:
+            # Merged candles may all be older than the existing ones, so the latest timestamp comes from the footer
+            latest_timestamp: float = self.getLatestTimestampFromParquetFooter(partition_filenames[-1])
+            if not math.isnan(latest_timestamp):
+                self.resume_index.update(dataset_directory, int(latest_timestamp), None, partition_filenames[-1])
+        logging.info(f'Wrote {len(candles)} candles to {len(written_partition_filenames)} partition(s) of '
+                     f'{dataset_directory}')
+        return True
+
+    # Returns the candles of an existing partition merged with partition_candles, or None if they can't be merged or
+    # don't pass the sanity check
+    def mergePartition(self, partition_candles: pd.DataFrame, partition_filename: str,
+                       dataset_directory: str) -> pd.DataFrame | None:
+        with self.measureMerge(dataset_directory):
+            existing_candles: pd.DataFrame = self.conformCandles(pd.read_parquet(partition_filename))
+            if not existing_candles.dtypes.equals(partition_candles.dtypes):
+                existing_candles = self.convertExistingCandles(existing_candles, partition_candles,
+                                                               partition_filename)
+                if existing_candles is None:
+                    logging.error(f'Cannot merge new candles into partition:{partition_filename}. '
+                                  f'Not updating this dataset. Investigate further.')
+                    return None
+            if not self.checkCandlesConsistency(existing_candles, partition_candles, partition_filename, 'updating'):
+                return None
+            merged_candles: pd.DataFrame = pd.concat([existing_candles, partition_candles], ignore_index=True)
+            merged_candles = merged_candles.drop_duplicates(self.key_date, keep='last')
+            return merged_candles.sort_values(self.key_date)
+
+    # Files written before candles were parsed into typed columns (see mdCandleBuffer) may hold numbers as strings.
+    # Returns existing_candles converted to the dtypes of the new candles, or None if that is not possible.
+    @staticmethod
+    def convertExistingCandles(existing_candles: pd.DataFrame, candles: pd.DataFrame,
+                               filename: str) -> pd.DataFrame | None:
+        try:
+            converted_candles: pd.DataFrame = existing_candles.astype(candles.dtypes.to_dict())
+            converted_candles.merge(candles)
+        except Exception:
+            return None
+        logging.info(f'Converted existing candles in {filename} to the dtypes of the new candles')
+        return converted_candles
+
+    # descending should be set by recorders that page backwards in time
+    def createCandleBuffer(self, filename: str | None = None, descending: bool = False) -> mdCandleBuffer:
+        if filename is None or (self.flush_every_n_candles == 0 and self.flush_every_n_bytes == 0):
+            return mdCandleBuffer(self.header, descending=descending, dtypes=self.candle_dtypes)
+        return mdStreamingCandleBuffer(self.header, lambda buffer: self.flushCandleChunk(buffer, filename),
+                                       self.flush_every_n_candles, self.flush_every_n_bytes, descending,
+                                       self.candle_dtypes)
+
+    @staticmethod
+    def getChunkDirectory(filename: str) -> str:
+        return f'{filename}.chunks'
+
+    def getChunkFilenames(self, filename: str) -> list[str]:
+        chunk_directory: str = self.getChunkDirectory(filename)
+        if not os.path.isdir(chunk_directory):
+            return []
+        extension: str = self.getMDFileExtension()
+        return sorted(os.path.join(chunk_directory, x) for x in os.listdir(chunk_directory) if x.endswith(extension))
+
+    # Ascending downloads are appended straight to the data file, which doubles as their checkpoint. Descending
+    # downloads can't be appended before the older candles are known, and single parquet files would be rewritten on
+    # every flush, so then every flush is written to a numbered chunk file next to the data file (via a temp file +
+    # rename) and the chunks are written to the data file once the download is complete.
+    def flushCandleChunk(self, buffer: mdStreamingCandleBuffer, filename: str) -> bool:
+        with self.measureWrite(filename):
+            candles: pd.DataFrame = self.conformCandles(buffer.toDataFrame().drop_duplicates(self.key_date))
+            if buffer.descending or not self.canAppendToFiles():
+                candles = candles.sort_values(self.key_date)
+                chunk_directory: str = self.getChunkDirectory(filename)
+                os.makedirs(chunk_directory, exist_ok=True)
+                extension: str = self.getMDFileExtension()
+                chunk_filename: str = os.path.join(chunk_directory,
+                                                   f'{len(self.getChunkFilenames(filename)):06d}{extension}')
+                temp_filename: str = chunk_filename + '.tmp'
+                if self.use_parquet_files:
+                    self.writeParquetFile(candles, temp_filename)
+                else:
+                    candles.to_csv(temp_filename, index=False)
+                os.replace(temp_filename, chunk_filename)
+                logging.info(f'Flushed {len(candles)} candles to chunk:{chunk_filename}')
+                return True
+
+            logging.info(f'Flushing {len(candles)} candles to {filename}')
+            if buffer.num_flushes == 0 and (self.write_new_files or not self.isExistingMDFile(filename)):
+                return self.writeNewFile(candles, filename)
+            return self.appendToDisk(candles, filename)
+
+    # Returns the oldest (descending) or latest (ascending) timestamp of an interrupted download (see flushCandleChunk)
+    # so that the recorder can continue paging from there, or None if there is nothing to resume
+    def getStreamingResumeTimestamp(self, filename: str, descending: bool = True) -> int | None:
+        chunk_filenames: list[str] = self.getChunkFilenames(filename)
+        if len(chunk_filenames) == 0:
+            return None
+        chunk_timestamps: pd.Series = self.readMDFile(chunk_filenames[-1])[self.key_date]
+        resume_timestamp: int = int(chunk_timestamps.min() if descending else chunk_timestamps.max())
+        logging.info(f'Resuming interrupted download of {filename} from chunk:{chunk_filenames[-1]} '
+                     f'resumeTimestamp:{resume_timestamp}')
+        return resume_timestamp
+
+    def finishStreamingWrite(self, buffer: mdStreamingCandleBuffer, filename: str) -> bool:
+        with self.measureWrite(filename):
+            try:
+                buffer.flush()
+            except mdCandleFlushError as e:
+                logging.error(f'Failed to flush candles to {filename} ({e}). Investigate further.')
+                return False
+
+            chunk_filenames: list[str] = self.getChunkFilenames(filename)
+            if buffer.num_flushes == 0 and len(chunk_filenames) == 0:
+                return self.writeCandlesToDisk(buffer.toDataFrame().drop_duplicates(self.key_date), filename)
+
+            if not self.canAppendToFiles():
+                # All the chunks are written with a single rewrite of the data file
+                chunks: pd.DataFrame = pd.concat([self.readMDFile(x) for x in chunk_filenames], ignore_index=True)
+                if not self.writeCandlesToDisk(chunks.drop_duplicates(self.key_date, keep='last'), filename):
+                    logging.error(f'Failed to write chunks of {filename}. Keeping them.')
+                    return False
+                shutil.rmtree(self.getChunkDirectory(filename))
+                return True
+
+            for i, chunk_filename in enumerate(reversed(chunk_filenames)):
+                chunk: pd.DataFrame = self.readMDFile(chunk_filename)
+                if i == 0 and (self.write_new_files or not self.isExistingMDFile(filename)):
+                    success: bool = self.writeNewFile(chunk, filename)
+                else:
+                    success = self.appendToDisk(chunk, filename)
+                if not success:
+                    logging.error(f'Failed to append chunk:{chunk_filename} to {filename}. Keeping remaining chunks.')
+                    return False
+                os.remove(chunk_filename)
+            if len(chunk_filenames) > 0:
+                shutil.rmtree(self.getChunkDirectory(filename))
+            return True
+
+    def writeToDisk(self, data: mdCandleBuffer | list[list], filename: str) -> bool:
+        self.metrics.increment(metrics_consts.CANDLES_RECEIVED,
+                               data.num_appended if isinstance(data, mdCandleBuffer) else len(data),
+                               **self.getSeriesLabels(filename))
+        if isinstance(data, mdStreamingCandleBuffer):
+            return self.finishStreamingWrite(data, filename)
+        if isinstance(data, mdCandleBuffer):
+            candles: pd.DataFrame = data.toDataFrame()
+        else:
+            candles = pd.DataFrame(data, columns=self.header)
+        if self.writer_pool is not None:
+            return self.submitWrite(candles, filename)
+        return self.writeCandlesToDisk(candles.drop_duplicates(self.key_date), filename)
+
+    def writeCandlesToDisk(self, candles: pd.DataFrame, filename: str) -> bool:
+        with self.measureWrite(filename):
+            candles = self.conformCandles(candles)
+            if self.append_only_writes and self.canAppendToFiles() and not self.write_new_files and \
+                    self.isExistingMDFile(filename):
+                return self.appendToDisk(candles, filename)
+            return self.mergeAndWriteToDisk(candles, filename)
+
+    def mergeAndWriteToDisk(self, candles: pd.DataFrame, filename: str) -> bool:
+        if self.partitioned_layout:
+            return self.writePartitions(candles, filename, merge_existing=not self.write_new_files)
+        new_candles: pd.DataFrame = candles  # same object, so the in place conversions below apply to it as well
+        if not self.write_new_files and self.isExistingMDFile(filename):
+            with self.measureMerge(filename):
+                try:
+                    old_candles: pd.DataFrame = self.readMDFile(filename, candles.dtypes.to_dict())
+                    candles = pd.merge(candles, old_candles, how='outer').drop_duplicates(self.key_date)
+                except Exception as e:
+                    old_candles = self.readMDFile(filename)
+                    type1: pd.Series = candles.dtypes
+                    type2: pd.Series = old_candles.dtypes
+                    converted_old_candles: pd.DataFrame | None = self.convertExistingCandles(old_candles, candles,
+                                                                                              filename)
+                    if converted_old_candles is not None:
+                        old_candles = converted_old_candles
+                        candles = pd.merge(candles, old_candles, how='outer').drop_duplicates(self.key_date)
+                    else:
+                        logging.exception(f'Caught exception "{e}" while reading/writing file {filename}.\n'
+                                          f'Type1:{type1}\nType2:{type2}')
+                        try:
+                            logging.exception(f'Trying to convert new candles to Type2 instead.')
+                            for key, value in type2.items():
+                                candles[key] = candles[key].astype(value)
+                            candles = pd.merge(candles, old_candles, how='outer').drop_duplicates(self.key_date)
+                            logging.info(f'Converted new candles to Type2 successfully')
+                        except Exception as e:
+                            logging.exception(f'Caught exception "{e}" while retrying. Skipping...\n'
+                                              f'Type1:{type1}\nType2:{type2}')
+                            return False
+
+                if not self.checkCandlesConsistency(old_candles, new_candles, filename, 'rewriting'):
+                    return False
+
+        return self.writeNewFile(candles, filename)
+
     def startRecordingProcess(self, max_threads: int) -> None:
+        executor: concurrent.futures.ThreadPoolExecutor = self.startRecordingSession(max_threads)
+        try:
+            interesting_product_ids, delisted_product_ids = self.getRecordedProductIDs()
+            self.recordProducts(executor, max_threads, interesting_product_ids, delisted_product_ids, self.timeframes)
+        finally:
+            self.stopRecordingSession(executor)
+
+    # Keeps the recorder, its product catalog, resume index, connections and writer processes alive and records every
+    # timeframe again right after each of its candles closes (plus close_delay_in_sec, so that the exchange has
+    # published the closed candle), starting with a full pass. Only the candles since the latest one of each file are
+    # requested, and they are appended to it (as with -a) instead of merged into a rewrite of the whole file. The
+    # product catalog is refetched once it is older than its TTL (DAEMON_PRODUCT_CATALOG_TTL_IN_SEC unless set), so
+    # that listings and delistings are picked up. Runs until SIGTERM/SIGINT, after finishing the pass in progress.
+    def runDaemon(self, max_threads: int, close_delay_in_sec: float) -> None:
+        if not self.append_only_writes:
+            logging.info('Daemon mode appends new candles to existing files')
+            self.append_only_writes = True
+        if self.product_catalog_ttl_in_sec <= 0:
+            self.product_catalog_ttl_in_sec = consts.DAEMON_PRODUCT_CATALOG_TTL_IN_SEC
+        self.daemon_stop_event = threading.Event()
+        if threading.current_thread() is threading.main_thread():
+            for signal_number in (signal.SIGTERM, signal.SIGINT):
+                signal.signal(signal_number, lambda signum, frame: self.stopDaemon())
+        executor: concurrent.futures.ThreadPoolExecutor = self.startRecordingSession(max_threads)
+        try:
+            timeframes: list[str] = self.timeframes
+            polled_timeframes: list[str] = self.timeframes
+            streamed_product_ids: list[str] = []
+            while not self.daemon_stop_event.is_set():
+                try:
+                    interesting_product_ids, delisted_product_ids = self.getRecordedProductIDs()
+                    if timeframes:
+                        self.recordProducts(executor, max_threads, interesting_product_ids, delisted_product_ids,
+                                            timeframes)
+                except Exception as e:
+                    logging.exception(f'Caught exception "{e}" while refreshing timeframes:{",".join(timeframes)}. '
+                                      f'Retrying at the next candle close.')
+                if self.write_new_files:
+                    logging.info('Updating the files written by the first pass from now on')
+                    self.write_new_files = False
+                if self.stream_klines and self.recorded_product_ids[0] and \
+                        self.recorded_product_ids[0] != streamed_product_ids:
+                    if streamed_product_ids:
+                        logging.info('Recorded products changed. Resubscribing to their kline streams.')
+                        self.stopKlineStream()
+                    streamed_timeframes: list[str] = self.startKlineStream(executor, self.recorded_product_ids[0])
+                    polled_timeframes = [x for x in self.timeframes if x not in streamed_timeframes]
+                    streamed_product_ids = self.recorded_product_ids[0]
+
+                wake_up_times: dict[str, float] = {}
+                for timeframe in polled_timeframes:
+                    next_close_time: float | None = self.getNextCandleCloseTime(timeframe, time.time())
+                    if next_close_time is not None:
+                        wake_up_times[timeframe] = next_close_time + close_delay_in_sec
+                if not wake_up_times and self.kline_stream is not None:
+                    logging.info(f'Every timeframe is streamed. Refreshing the product catalog in '
+                                 f'{self.product_catalog_ttl_in_sec}s.')
+                    self.daemon_stop_event.wait(self.product_catalog_ttl_in_sec)
+                    timeframes = []
+                    continue
+                if not wake_up_times:
+                    logging.error('No timeframe with a known candle interval to refresh. Stopping daemon.')
+                    break
+                wake_up_time: float = min(wake_up_times.values())
+                timeframes = [x for x, wake_up_time_of_x in wake_up_times.items() if wake_up_time_of_x == wake_up_time]
+                logging.info(f'Next refresh of timeframes:{",".join(timeframes)} at '
+                             f'{datetime.fromtimestamp(wake_up_time)}')
+                self.daemon_stop_event.wait(max(0.0, wake_up_time - time.time()))
+            logging.info('Daemon stopped')
+        finally:
+            self.stopKlineStream()
+            self.stopRecordingSession(executor)
+
+    def stopDaemon(self) -> None:
+        logging.info('Stopping daemon once the current pass is done')
+        self.daemon_stop_event.set()
+
+    # Must return the stream of the closed candles of product_ids (see mdKlineStream) calling onClosedCandle, or None if
+    # the exchange's candles can't be streamed. websocket_url = None means the exchange's default.
+    def createKlineStream(self, websocket_url: str | None, product_ids: list[str], timeframes: list[str]):
+        return None
+
+    # Streams the candles of product_ids for the timeframes that the exchange streams, and returns those timeframes.
+    # REST is only used for history then: the initial pass of the daemon and the candles missed while a connection was
+    # down (see writeStreamedCandles). runDaemon stops and restarts the stream when the recorded products change.
+    def startKlineStream(self, executor: concurrent.futures.ThreadPoolExecutor, product_ids: list[str]) -> list[str]:
+        self.kline_stream = self.createKlineStream(self.websocket_url, product_ids, self.timeframes)
+        if self.kline_stream is None:
+            logging.error(f'Streaming is not supported for exchange:{self.exchange_name}. Polling every timeframe '
+                          f'instead.')
+            return []
+        streamed_timeframes: list[str] = self.kline_stream.getTimeframes()
+        if not streamed_timeframes:
+            logging.warning(f'None of the timeframes:{",".join(self.timeframes)} can be streamed from exchange:'
+                            f'{self.exchange_name}. Polling them instead.')
+            self.kline_stream = None
+            return []
+        self.streamed_candles = queue.SimpleQueue()
+        self.stream_stop_event = threading.Event()
+        self.stream_writer = threading.Thread(target=self.runStreamWriter, args=(executor,), name='streamWriter',
+                                              daemon=True)
+        self.stream_writer.start()
+        self.kline_stream.start()
+        return streamed_timeframes
+
+    def stopKlineStream(self) -> None:
+        if self.kline_stream is None:
+            return
+        self.kline_stream.stop()
+        self.stream_stop_event.set()
+        self.stream_writer.join()
+        self.kline_stream = None
+
+    def onClosedCandle(self, product_id: str, timeframe: str, row: list) -> None:
+        self.streamed_candles.put((product_id, timeframe, row))
+
+    # Hands the closed candles of each series to the executor once the oldest of them has waited for
+    # stream_flush_interval_in_sec, so that every write covers all the candles that closed in that interval. A series
+    # is only written by one task at a time: candles that close while it is being written (or refetched) are written
+    # after that. Whatever is pending is handed over when the stream stops.
+    def runStreamWriter(self, executor: concurrent.futures.ThreadPoolExecutor) -> None:
+        pending_candles: dict[tuple[str, str], list[list]] = {}
+        pending_since: dict[tuple[str, str], float] = {}
+        poll_interval_in_sec: float = min(consts.STREAM_FLUSH_INTERVAL_IN_SEC, self.stream_flush_interval_in_sec)
+        stopping: bool = False
+        while not stopping:
+            stopping = self.stream_stop_event.wait(poll_interval_in_sec)
+            now: float = time.time()
+            while True:
+                try:
+                    product_id, timeframe, row = self.streamed_candles.get_nowait()
+                except queue.Empty:
+                    break
+                pending_candles.setdefault((product_id, timeframe), []).append(row)
+                pending_since.setdefault((product_id, timeframe), now)
+            for series in list(pending_candles):
+                if not stopping and now - pending_since[series] < self.stream_flush_interval_in_sec:
+                    continue
+                with self.busy_streamed_series_lock:
+                    if series in self.busy_streamed_series:
+                        continue
+                    self.busy_streamed_series.add(series)
+                del pending_since[series]
+                future: concurrent.futures.Future = executor.submit(self.writeStreamedCandles, *series,
+                                                                    pending_candles.pop(series))
+                future.add_done_callback(lambda f, done_series=series: self.onStreamedCandlesWritten(f, done_series))
+
+    def onStreamedCandlesWritten(self, future: concurrent.futures.Future, series: tuple[str, str]) -> None:
+        with self.busy_streamed_series_lock:
+            self.busy_streamed_series.discard(series)
+        exception: BaseException | None = future.exception()
+        if exception is not None:
+            logging.error(f'Caught exception "{exception}" while writing the streamed candles of ProductID:{series[0]} '
+                          f'Timeframe:{series[1]}', exc_info=exception)
+
+    # Writes streamed candles through the same path as downloaded ones. If candles are missing between the file and
+    # them (the connection was down, or the exchange sent no update for a while), the file is brought up to date over
+    # REST instead, which also covers the streamed candles. As in findGaps, only two intervals or more count as a gap.
+    def writeStreamedCandles(self, product_id: str, timeframe: str, rows: list[list]) -> bool:
+        filename: str = self.getFilenameFromProductIdAndTimeframe(product_id, timeframe)
+        granularity: int | None = self.getGranularity(timeframe)
+        latest_timestamp: int = self.getLatestTimestampFromFile(filename)
+        earliest_streamed_timestamp: int = min(self.getDateTimestampFromRow(x) for x in rows)
+        if latest_timestamp == 0 or (granularity and earliest_streamed_timestamp - latest_timestamp >= 2 * granularity):
+            logging.info(f'Candles missing between {filename} (LatestTimestamp:{latest_timestamp}) and its streamed '
+                         f'candles (EarliestTimestamp:{earliest_streamed_timestamp}). Refetching them over REST.')
+            success, _ = self.initiateDownloadAndRecord(product_id, timeframe, False)
+        else:
+            self.series_by_filename[filename] = {'product': product_id, 'timeframe': timeframe}
+            success = self.writeToDisk(rows, filename)
+        success = self.waitForWrite(filename) and success
+        if not success:
+            logging.error(f'Failed to write the streamed candles of {filename}')
+        return success
+
+    # Close time of the candle of timeframe that is open at timestamp_in_sec (candles are aligned to the epoch, except
+    # weekly ones, which start on Mondays)
+    def getNextCandleCloseTime(self, timeframe: str, timestamp_in_sec: float) -> float | None:
+        granularity: int | None = self.getGranularity(timeframe)
+        if not granularity:
+            return None
+        granularity_in_sec: float = granularity / self.getTimestampUnitsPerSec()
+        offset_in_sec: float = consts.FIRST_MONDAY_AFTER_EPOCH_IN_SEC if granularity_in_sec == consts.WEEK_IN_SEC else 0
+        return (math.floor((timestamp_in_sec - offset_in_sec) / granularity_in_sec) + 1) * granularity_in_sec + \
+            offset_in_sec
+
+    # Interesting and delisted products, only recomputed (and logged) when the product catalog has been refetched
+    def getRecordedProductIDs(self) -> tuple[list[str], set[str]]:
+        product_catalog: mdProductCatalog = self.getProductCatalog()
+        if product_catalog is not self.recorded_products_catalog:
+            interesting_product_ids: list[str] = list(dict.fromkeys(self.getAllInterestingProductIDs()))  # to remove any duplicates
+            self.recorded_product_ids = (interesting_product_ids,
+                                         set(self.getAllDelistedProductIDs(interesting_product_ids)))
+            self.recorded_products_catalog = product_catalog
+        return self.recorded_product_ids
+
+    def startRecordingSession(self, max_threads: int) -> concurrent.futures.ThreadPoolExecutor:
         executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_threads)
-        futures: list[concurrent.futures.Future] = []
         logging.info(f'Starting recording process with maxThreads={max_threads}')
+        if isinstance(self.request_handler, mdRequestHandler):
+            self.request_handler.close()
+        self.request_handler = self.createRequestHandler(max_threads)
+        if self.num_writer_processes > 0:
+            self.writer_pool = self.createWriterPool()
+        if self.metrics_filename is not None:
+            self.metrics_exporter = mdMetricsExporter(self.metrics, self.metrics_filename, self.metrics_format,
+                                                      self.metrics_interval_in_sec)
+        return executor
+
+    def stopRecordingSession(self, executor: concurrent.futures.ThreadPoolExecutor) -> None:
+        executor.shutdown()
+        if not isinstance(self.request_handler, requestHandler):
+            self.request_handler.close()
+        if self.writer_pool is not None:
+            self.writer_pool.shutdown()
+            self.writer_pool = None
+        self.resume_index.flush()
+        if self.metrics_exporter is not None:
+            self.metrics_exporter.stop()
+            self.metrics_exporter = None
 
-        interesting_product_ids: list[str] = list(dict.fromkeys(self.getAllInterestingProductIDs()))  # to remove any duplicates
-        delisted_product_ids: list[str] = list(dict.fromkeys(self.getAllDelistedProductIDs(interesting_product_ids)))  # to remove any duplicates
-        total_number_of_files: int = len(interesting_product_ids) * len(self.timeframes)
-        iteration_number: int = 0
+    # Records every product/timeframe combination and returns the number of failures
+    def recordProducts(self, executor: concurrent.futures.ThreadPoolExecutor, max_threads: int,
+                       interesting_product_ids: list[str], delisted_product_ids: set[str],
+                       timeframes: list[str]) -> int:
+        scheduler: mdTaskScheduler = mdTaskScheduler(
+            self.createRecordingTasks(interesting_product_ids, delisted_product_ids, timeframes), max_threads,
+            self.max_running_backfills or math.ceil(max_threads * scheduler_consts.DEFAULT_BACKFILL_WORKER_SHARE))
+        total_number_of_files: int = scheduler.getNumTasks()
+        logging.info(f'Scheduled {total_number_of_files} tasks, {scheduler.getNumBackfills()} of them backfills')
         failed_iterations: list[str] = []
-        for product_id in interesting_product_ids:
-            is_delisted: bool = product_id in delisted_product_ids
-            for timeframe in self.timeframes:
-                iteration_number += 1
-                futures.append(executor.submit(self.initiateDownloadAndRecord, product_id, timeframe, is_delisted))
+        finished_futures: queue.SimpleQueue[concurrent.futures.Future] = queue.SimpleQueue()
+        self.dispatchRecordingTasks(executor, scheduler, finished_futures)
 
         num_successful_iterations: int = 0
         num_failed_iterations: int = 0
-        filenum: int = 0
-        for future in concurrent.futures.as_completed(futures):
-            filenum += 1
-            success, filename = future.result()
+        for filenum in range(1, total_number_of_files + 1):
+            success, filename = finished_futures.get().result()
+            success = self.waitForWrite(filename) and success
             if success:
                 log_message_prefix = 'Successfully recorded data for'
                 num_successful_iterations += 1
@@ -136,36 +1221,257 @@ class MDRecorderBase:
                 num_failed_iterations += 1
             logging.info(f'{log_message_prefix} {filename} ({filenum}/{total_number_of_files})')
 
+        self.resume_index.flush()
         logging.info(f'Recording Process Completed. TotalIterations:{total_number_of_files} '
                      f'NumSuccesses:{num_successful_iterations} NumFailures:{num_failed_iterations}')
         if num_failed_iterations > 0:
             print_str = '\n' + '\n'.join(failed_iterations)
             logging.info(f'Files with errors:{print_str}')
+        return num_failed_iterations
+
+    def isPriorityProduct(self, product_id: str) -> bool:
+        if not self.priority_symbols:
+            return False
+        if product_id in self.priority_symbols:
+            return True
+        product: dict | None = self.getProductCatalog().getProduct(product_id)
+        return product is not None and product[product_catalog_consts.KEY_BASECURRENCY] in self.priority_symbols
+
+    # Number of requests the download of product_id/timeframe is expected to take, from the latest timestamp of its
+    # file (a missing file counts as a backfill from the epoch, so finer timeframes cost more)
+    def estimateNumRequests(self, product_id: str, timeframe: str) -> float:
+        granularity: int | None = self.getGranularity(timeframe)
+        if not granularity:
+            return 1
+        filename: str = self.getFilenameFromProductIdAndTimeframe(product_id, timeframe)
+        latest_timestamp: int = 0 if self.write_new_files else self.getLatestTimestampFromFile(filename)
+        num_candles: float = (time.time() * self.getTimestampUnitsPerSec() - latest_timestamp) / granularity
+        return max(1, math.ceil(num_candles / self.max_candles_per_api_request))
+
+    def createRecordingTasks(self, product_ids: list[str], delisted_product_ids: set[str],
+                             timeframes: list[str]) -> list[mdRecordingTask]:
+        return [mdRecordingTask(product_id, timeframe, product_id in delisted_product_ids,
+                                self.estimateNumRequests(product_id, timeframe), self.isPriorityProduct(product_id))
+                for product_id in product_ids for timeframe in timeframes]
+
+    # Submits tasks until the scheduler holds the rest back. Every finished task is queued for the recording process
+    # and hands out the next tasks from its completion callback.
+    def dispatchRecordingTasks(self, executor: concurrent.futures.ThreadPoolExecutor, scheduler: mdTaskScheduler,
+                               finished_futures: queue.SimpleQueue) -> None:
+        while (task := scheduler.popNextTask()) is not None:
+            future: concurrent.futures.Future = executor.submit(self.initiateDownloadAndRecord, task.product_id,
+                                                                task.timeframe, task.is_delisted)
+            future.add_done_callback(lambda f, done_task=task: self.onRecordingTaskDone(
+                f, done_task, executor, scheduler, finished_futures))
+
+    def onRecordingTaskDone(self, future: concurrent.futures.Future, task: mdRecordingTask,
+                            executor: concurrent.futures.ThreadPoolExecutor, scheduler: mdTaskScheduler,
+                            finished_futures: queue.SimpleQueue) -> None:
+        scheduler.onTaskDone(task)
+        finished_futures.put(future)
+        self.dispatchRecordingTasks(executor, scheduler, finished_futures)
 
     def initiateDownloadAndRecord(self, product_id: str, timeframe: str, is_delisted: bool) -> tuple[bool, str]:
         filename: str = self.getFilenameFromProductIdAndTimeframe(product_id, timeframe)
-        success: bool = self.downloadAndWriteData(product_id, timeframe, filename, is_delisted)
+        self.series_by_filename[filename] = {'product': product_id, 'timeframe': timeframe}
+        with self.metrics.measure(None, metrics_consts.DOWNLOAD_SECONDS, product_id, timeframe):
+            try:
+                success: bool = self.downloadAndWriteData(product_id, timeframe, filename, is_delisted)
+            except mdCandleFlushError as e:
+                logging.error(f'Failed to flush candles to {filename} ({e}). Stopped its download. '
+                              f'Investigate further.')
+                success = False
+            except mdRequestError as e:
+                logging.error(f'{e}. Stopped the download of {filename}.')
+                success = False
+            if success and self.fill_gaps:
+                success = self.waitForWrite(filename) and self.fillGaps(product_id, timeframe, filename)
         return success, filename
 
-    def isInterestingQuoteCurrency(self, quote_currency: str) -> bool:
-        if not self.interesting_quote_currencies or len(self.interesting_quote_currencies) == 0:
+    # Must return (candle interval in the unit of the exchange's timestamps, function fetching the candles of a
+    # [start, end) window) or None if the recorder can't refetch arbitrary windows
+    def getGapFetcher(self, product_id: str, timeframe: str) -> tuple[int, Callable[[int, int], list[list]]] | None:
+        return None
+
+    # Must return the candle interval of timeframe in the unit of the exchange's timestamps, or None if unknown (the
+    # cost of the product/timeframe's task can't be estimated then)
+    def getGranularity(self, timeframe: str) -> int | None:
+        return None
+
+    # Timestamps of the exchange's candles per second (e.g. 1000 for millisecond timestamps)
+    @staticmethod
+    def getTimestampUnitsPerSec() -> int:
+        return 1
+
+    # Sorted, unique timestamps of a market data file that are >= min_timestamp (only the date column is read, and
+    # only the tail of CSV files, the partitions from the month of min_timestamp on and the matching row groups of
+    # parquet files)
+    def readTimestampsFromFile(self, filename: str, min_timestamp: int | None = None) -> np.ndarray:
+        if os.path.isdir(filename):
+            partition_filenames: list[str] = self.getPartitionFilenames(filename)
+            if min_timestamp is not None:
+                min_datetime: pd.Timestamp = self.getDatetimesFromTimestamps(pd.Series([min_timestamp])).iloc[0]
+                min_partition_filename: str = self.getPartitionFilename(filename, min_datetime.year,
+                                                                        min_datetime.month)
+                partition_filenames = [x for x in partition_filenames if x >= min_partition_filename]
+            columns: list[pd.Series] = [pd.read_parquet(x, columns=[self.key_date])[self.key_date]
+                                        for x in partition_filenames]
+            timestamps: pd.Series = pd.concat(columns, ignore_index=True) if columns else pd.Series([])
+        elif self.use_parquet_files:
+            timestamps = pd.read_parquet(filename, columns=[self.key_date],
+                                         filters=None if min_timestamp is None else
+                                         [(self.key_date, '>=', min_timestamp)])[self.key_date]
+        elif min_timestamp is not None:
+            timestamps = self.readMDFileTail(filename, min_timestamp)[self.key_date]
+        else:
+            timestamps = pd.read_csv(filename, usecols=[self.key_date])[self.key_date]
+        timestamps_array: np.ndarray = np.unique(timestamps.to_numpy().astype(np.int64))
+        return timestamps_array if min_timestamp is None else timestamps_array[timestamps_array >= min_timestamp]
+
+    # Returns the [start, end) ranges of missing candles between consecutive timestamps. Only distances of at least two
+    # intervals count as gaps, so that timeframes of varying length (e.g. Binance's 1M, whose interval is taken as 28
+    # days) don't look like they are missing candles.
+    @staticmethod
+    def findGaps(timestamps: np.ndarray, granularity: int) -> list[tuple[int, int]]:
+        if len(timestamps) < 2:
+            return []
+        gap_indices: np.ndarray = np.flatnonzero(np.diff(timestamps) >= 2 * granularity)
+        return [(int(timestamps[i]) + granularity, int(timestamps[i + 1])) for i in gap_indices]
+
+    # Recorders only resume from the latest timestamp of a file, so candles missing inside it (exchange outages, early
+    # exits after empty responses, interrupted runs) are never downloaded again. This refetches just the windows
+    # covering those gaps and merges them into the file, instead of re-downloading the whole file with -n.
+    # The resume index keeps the timestamp up to which the file has been scanned, so that only the candles written
+    # since then are read, and the gaps the exchange returned no candles for, so that they are not requested again.
+    def fillGaps(self, product_id: str, timeframe: str, filename: str) -> bool:
+        gap_fetcher: tuple[int, Callable[[int, int], list[list]]] | None = self.getGapFetcher(product_id, timeframe)
+        if gap_fetcher is None:
+            logging.info(f'Gap filling is not supported for exchange:{self.exchange_name}. Skipping {filename}')
             return True
-        if quote_currency in self.interesting_quote_currencies:
+        if not self.isExistingMDFile(filename):
             return True
-        return False
 
-    def isInterestingBaseCurrency(self, base_currency: str) -> bool:
-        if not self.interesting_base_currencies or len(self.interesting_base_currencies) == 0:
+        granularity, fetch_window = gap_fetcher
+        scanned_until: int | None = None if self.write_new_files else self.resume_index.getGapsScannedUntil(
+            filename, self.getPartitionFilenames(filename)[-1] if self.partitioned_layout else None)
+        empty_ranges: list[tuple[int, int]] = self.resume_index.getEmptyRanges(filename)
+        timestamps: np.ndarray = self.readTimestampsFromFile(filename, scanned_until)
+        if len(timestamps) == 0:
             return True
-        if base_currency in self.interesting_base_currencies:
+        gaps: list[tuple[int, int]] = [x for x in self.findGaps(timestamps, granularity) if x not in empty_ranges]
+        if len(gaps) == 0:
+            logging.info(f'No gaps found in {filename}' + ('' if scanned_until is None else
+                                                            f' since timestamp:{scanned_until}'))
+            self.resume_index.setGapScan(filename, timestamps[-1], empty_ranges)
             return True
-        return False
+        num_missing_candles: int = sum((end - start) // granularity for start, end in gaps)
+        logging.info(f'Found {len(gaps)} gap(s) with {num_missing_candles} missing candles in {filename}. '
+                     f'Refetching them.')
+
+        windows: list[tuple[int, int]] = [window for start, end in gaps for window in
+                                          self.planRequestWindows(start, end,
+                                                                  granularity * self.max_candles_per_api_request)]
+        if self.window_executor is not None:
+            responses: Iterator[list[list]] = self.window_executor.map(lambda window: fetch_window(*window), windows)
+        else:
+            responses = (fetch_window(*window) for window in windows)
+        candles: mdCandleBuffer = self.createCandleBuffer()
+        for r_json in responses:
+            candles += r_json
+        refetched_timestamps: np.ndarray = np.sort(candles.getColumn(self.key_date).astype(np.float64))
+        new_empty_ranges: list[tuple[int, int]] = [
+            (start, end) for start, end in gaps
+            if np.searchsorted(refetched_timestamps, start) == np.searchsorted(refetched_timestamps, end)]
+        if len(new_empty_ranges) > 0:
+            logging.info(f'Exchange has no candles for {len(new_empty_ranges)}/{len(gaps)} gap(s) in {filename}. '
+                         f'Not requesting them again.')
+        if len(candles) > 0:
+            logging.info(f'Refetched {len(candles)} candles for the gaps in {filename}')
+            if not (self.writeToDisk(candles, filename) and self.waitForWrite(filename)):
+                return False
+        self.resume_index.setGapScan(filename, timestamps[-1], empty_ranges + new_empty_ranges)
+        return True
+
+    def isInterestingQuoteCurrency(self, quote_currency: str) -> bool:
+        return not self.interesting_quote_currency_set or quote_currency in self.interesting_quote_currency_set
+
+    def isInterestingBaseCurrency(self, base_currency: str) -> bool:
+        return not self.interesting_base_currency_set or base_currency in self.interesting_base_currency_set
+
+    def getProductCatalogFilename(self) -> str:
+        return os.path.join(self.output_directory, f'.{self.exchange_name}_product_catalog.json')
+
+    # Fetches and parses the exchange info at most once per run (or once per TTL if persisted catalogs are enabled or
+    # in daemon mode). If refetching an expired catalog fails, the previous one is kept.
+    def getProductCatalog(self) -> mdProductCatalog:
+        with self.product_catalog_lock:
+            if self.product_catalog is not None and (self.product_catalog_ttl_in_sec <= 0 or
+                                                     not self.product_catalog.isExpired(
+                                                         self.product_catalog_ttl_in_sec)):
+                return self.product_catalog
+
+            catalog_filename: str = self.getProductCatalogFilename()
+            if self.product_catalog_ttl_in_sec > 0:
+                product_catalog: mdProductCatalog | None = mdProductCatalog.load(catalog_filename)
+                if product_catalog is not None and not product_catalog.isExpired(self.product_catalog_ttl_in_sec):
+                    logging.info(f'Using product catalog:{catalog_filename} '
+                                 f'with {product_catalog.getNumProducts()} products')
+                    self.product_catalog = product_catalog
+                    return self.product_catalog
+
+            try:
+                product_catalog_entries: list[dict] = self.fetchProductCatalogEntries()
+            except Exception as e:
+                if self.product_catalog is None:
+                    raise
+                logging.exception(f'Caught exception "{e}" while refetching the product catalog. Using the previous '
+                                  f'one for another {self.product_catalog_ttl_in_sec}s.')
+                self.product_catalog.fetch_time = time.time()
+                return self.product_catalog
+            self.product_catalog = mdProductCatalog(product_catalog_entries)
+            self.product_catalog.save(catalog_filename)
+            return self.product_catalog
 
     def getAllInterestingProductIDs(self) -> list[str]:
-        raise NotImplementedError('ERROR: Method getAllInterestingProductIDs must be defined in child class!')
+        product_catalog: mdProductCatalog = self.getProductCatalog()
+        candidate_product_ids: set[str] | None = None
+        if self.interesting_quote_currency_set:
+            candidate_product_ids = set().union(*(product_catalog.getProductIDsByQuoteCurrency(x)
+                                                  for x in self.interesting_quote_currency_set))
+        if self.interesting_base_currency_set:
+            base_product_ids: set[str] = set().union(*(product_catalog.getProductIDsByBaseCurrency(x)
+                                                       for x in self.interesting_base_currency_set))
+            candidate_product_ids = base_product_ids if candidate_product_ids is None \
+                else candidate_product_ids & base_product_ids
+
+        interesting_product_ids: list[str] = [x for x in product_catalog.getRecordableProductIDs()
+                                              if (candidate_product_ids is None or x in candidate_product_ids)
+                                              and self.isInShard(x)]
+        shard_str: str = f' in shard {self.shard_index + 1}/{self.num_shards}' if self.num_shards > 1 else ''
+        if self.log_mode == logging_consts.LOG_MODE_SAMPLED:
+            logging.info(f'{len(interesting_product_ids)}/{product_catalog.getNumProducts()} interesting products '
+                         f'found{shard_str}')
+            if logging.getLogger().isEnabledFor(logging.DEBUG):
+                logging.debug('Interesting products:\n' + '\n'.join(interesting_product_ids))
+            return interesting_product_ids
+        product_ids_str = '\n' + '\n'.join(interesting_product_ids)
+        logging.info(f'{len(interesting_product_ids)}/{product_catalog.getNumProducts()} interesting products found'
+                     f'{shard_str}:{product_ids_str}')
+        return interesting_product_ids
 
     def getAllDelistedProductIDs(self, interesting_product_id_list: list[str]) -> list[str]:
-        raise NotImplementedError('ERROR: Method getAllDelistedProductIDs must be defined in child class!')
+        product_catalog: mdProductCatalog = self.getProductCatalog()
+        interesting_product_id_set: set[str] = set(interesting_product_id_list or [])
+        delisted_product_ids: list[str] = list(dict.fromkeys(
+            x for x in product_catalog.getDelistedProductIDs()
+            if not interesting_product_id_set or x in interesting_product_id_set))  # to remove any duplicates
+        delisted_product_ids_str = '\n' + '\n'.join(delisted_product_ids)
+        logging.info(f'{len(delisted_product_ids)} delisted products found: {delisted_product_ids_str}')
+        return delisted_product_ids
+
+    # Must return one mdProductCatalog.createProduct entry per symbol listed by the exchange
+    def fetchProductCatalogEntries(self) -> list[dict]:
+        raise NotImplementedError('ERROR: Method fetchProductCatalogEntries must be defined in child class!')
 
     def downloadAndWriteData(self, product_id: str, timeframe: str, filename: str, is_delisted: bool) -> bool:
         raise NotImplementedError('ERROR: Method downloadAndWriteData must be defined in child class!')
@@ -0,0 +1,120 @@
+# Load external modules
+from ext_modules.ext_modules_loader import load_ext_modules
+load_ext_modules()
+
+# Regular imports
+import argparse
+import json
+import os
+import resource
+import shutil
+import tempfile
+import time
+
+from main import configureLogging, createArgumentParser, recordExchange, runSupervisor
+from mdLogging import enableQueueLogging
+from mdMockExchange import mdMockExchange, mdMockExchangeServer
+from mdRecorderConfig import mdRecorderConfig
+import logging
+
+
+# Runs a recorder end to end (product catalog, downloads, writes) against a local mock exchange (see mdMockExchange)
+# and reports its throughput, so that thread counts and limits can be tuned and performance regressions caught without
+# sending a single request to a live exchange. Options that are not listed here are passed on to the recorder, e.g.
+#   python benchmark.py -c configs/config_binance.ini --products 50 --latency-ms 20 -x 20 -z -a --writers 2
+# With --stream (or --daemon) the recorder keeps running against the mock exchange, whose kline streams are then
+# served as well, until it is stopped with Ctrl+C.
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark a recorder against a local mock exchange',
+                                     epilog='Any other option is passed on to the recorder (see python main.py -h)')
+    parser.add_argument('-c', dest='config', type=str, required=True, metavar='',
+                        help='Config file of the exchange to benchmark (its api_url is redirected to the mock exchange)')
+    parser.add_argument('-o', dest='outputDirectory', type=str, required=False, metavar='',
+                        help='Directory where market data files are saved (default = temporary directory that is '
+                             'removed afterwards)')
+    parser.add_argument('--products', dest='numProducts', type=int, required=False, default=20, metavar='',
+                        help='Number of products listed by the mock exchange (default = 20)')
+    parser.add_argument('--history-days', dest='historyDays', type=float, required=False, default=30, metavar='',
+                        help='Days of candle history per product (default = 30)')
+    parser.add_argument('--latency-ms', dest='latencyMs', type=float, required=False, default=0, metavar='',
+                        help='Latency added to every response of the mock exchange (default = 0)')
+    parser.add_argument('--server-max-rps', dest='serverMaxRequestsPerSec', type=int, required=False, default=0,
+                        metavar='', help='Requests per sec over which the mock exchange responds with 429 '
+                                         '(default = 0, i.e. never)')
+    parser.add_argument('--json', dest='jsonOutputFile', type=str, required=False, metavar='',
+                        help='Also write the results to this JSON file (e.g. to compare runs)')
+    args, recorderArgv = parser.parse_known_args()
+    configureLogging()
+
+    config: mdRecorderConfig = mdRecorderConfig(args.config)
+    exchangeName: str = config.getExchangeName()
+    quoteCurrency: str = (config.getInterestingQuoteCurrencies() or ['USDT'])[0]
+    outputDirectory: str = args.outputDirectory if args.outputDirectory else tempfile.mkdtemp(prefix='mdbenchmark_')
+    streamKlines: bool = createArgumentParser().parse_args(['-c', args.config, '-o', outputDirectory] +
+                                                           recorderArgv).stream
+    exchange: mdMockExchange = mdMockExchange(exchangeName, args.numProducts, quoteCurrency,
+                                              int(args.historyDays * 24 * 60 * 60), args.latencyMs / 1000,
+                                              args.serverMaxRequestsPerSec, streamKlines)
+    server: mdMockExchangeServer = mdMockExchangeServer(exchange)
+    try:
+        recorderArgs: argparse.Namespace = createArgumentParser().parse_args(
+            ['-c', args.config, '-o', outputDirectory, '-u', server.getAPIURL(config.getAPIURL()),
+             '-q', quoteCurrency, '-s', ','.join(exchange.base_currencies)] +
+            (['--ws-url', server.getWebsocketURL()] if streamKlines else []) + recorderArgv)
+        if recorderArgs.debug:
+            logging.getLogger().setLevel(logging.DEBUG)
+        if recorderArgs.logQueue:
+            enableQueueLogging()
+        logging.info(f'Benchmarking {exchangeName} with recorder options:{" ".join(recorderArgv)}')
+
+        startTime: float = time.perf_counter()
+        if recorderArgs.numShards > 1:
+            runSupervisor(recorderArgs, [args.config], recorderArgs.numShards)
+        else:
+            recordExchange(recorderArgs, args.config)
+        elapsedTimeInSec: float = time.perf_counter() - startTime
+
+        # Read before the mock exchange is stopped, so that only recorder processes count as children
+        peakChildRSSInMB: float = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+        results: dict = getResults(server.getStats(), elapsedTimeInSec, getOutputSize(outputDirectory),
+                                   resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, peakChildRSSInMB)
+    finally:
+        server.stop()
+        if not args.outputDirectory:
+            shutil.rmtree(outputDirectory, ignore_errors=True)
+
+    logging.info('Benchmark results:\n' + '\n'.join(f'  {key}: {value}' for key, value in results.items()))
+    if args.jsonOutputFile:
+        with open(args.jsonOutputFile, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+# Total size of the market data files (resume indexes and product catalogs are hidden files and not counted)
+def getOutputSize(outputDirectory: str) -> int:
+    outputSize: int = 0
+    for directory, _, filenames in os.walk(outputDirectory):
+        outputSize += sum(os.path.getsize(os.path.join(directory, x)) for x in filenames if not x.startswith('.'))
+    return outputSize
+
+
+def getResults(serverStats: dict[str, int], elapsedTimeInSec: float, outputSize: int, peakRSSInMB: float,
+               peakChildRSSInMB: float) -> dict:
+    megabyte: int = 1024 * 1024
+    return {
+        'elapsed_sec': round(elapsedTimeInSec, 3),
+        'num_requests': serverStats['num_requests'],
+        'requests_per_sec': round(serverStats['num_requests'] / elapsedTimeInSec, 1),
+        'num_rate_limited_requests': serverStats['num_rate_limited'],
+        'num_candles': serverStats['num_candles'],
+        'candles_per_sec': round(serverStats['num_candles'] / elapsedTimeInSec, 1),
+        'downloaded_mb': round(serverStats['num_bytes'] / megabyte, 3),
+        'output_mb': round(outputSize / megabyte, 3),
+        # Size of the output over the whole run (downloads included), not the throughput of the writes themselves
+        'output_mb_per_sec': round(outputSize / megabyte / elapsedTimeInSec, 3),
+        'peak_rss_mb': round(peakRSSInMB, 1),
+        'peak_child_process_rss_mb': round(peakChildRSSInMB, 1)
+    }
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,10 @@
 import logging
 import os.path
-import random
 import time
-from datetime import datetime
 from MDRecorderBase import MDRecorderBase
+from mdCandleBuffer import mdCandleBuffer
+from mdLogging import mdDownloadProgress
+from mdProductCatalog import mdProductCatalog
 import os
 
 
@@ -30,44 +31,22 @@ class binanceFundingRateRecorder(MDRecorderBase):
                                 [consts.BINANCE_FUNDINGRATE_TIMEFRAME], write_new_files, max_api_requests_per_sec,
                                 cooldown_period_in_sec, use_parquet_files)
 
-    def getAllInterestingProductIDs(self) -> list[str]:
+    def fetchProductCatalogEntries(self) -> list[dict]:
         request_url = self.api_url + 'exchangeInfo'
         r = self.request_handler.get(request_url)
 
-        interesting_product_ids: list[str] = []
-        symbol_info_list: list[dict] = r.json()[consts.KEY_SYMBOLS]
+        products: list[dict] = []
+        symbol_info_list: list[dict] = self.json_decoder.decodeResponse(r)[consts.KEY_SYMBOLS]
         for symbol_info in symbol_info_list:
             symbol: str = symbol_info[consts.KEY_BASEASSET]
             quote_currency: str = symbol_info[consts.KEY_QUOTEASSET]
-            isPerpetualFuture: bool = symbol_info[consts.KEY_CONTRACTTYPE] == consts.KEY_CONTRACTTYPE_PERP
-            if isPerpetualFuture and self.isInterestingQuoteCurrency(quote_currency) and self.isInterestingBaseCurrency(symbol):
-                product_id: str = self.getProductIdFromCoinAndQuoteCurrency(symbol, quote_currency)
-                interesting_product_ids.append(product_id)
-
-        random.shuffle(interesting_product_ids)
-        product_ids_str = '\n' + '\n'.join(interesting_product_ids)
-        logging.info(
-            f'{len(interesting_product_ids)}/{len(symbol_info_list)} interesting products found:{product_ids_str}')
-        return interesting_product_ids
-
-    def getAllDelistedProductIDs(self, interesting_product_id_list: list[str]) -> list[str]:
-        request_url = self.api_url + 'exchangeInfo'
-        r = self.request_handler.get(request_url)
-
-        delisted_product_ids: list[str] = []
-        symbol_info_list: list[dict] = r.json()[consts.KEY_SYMBOLS]
-        for symbol_info in symbol_info_list:
             trading_status: str = symbol_info[consts.KEY_TRADINGSTATUS]
-            if trading_status != consts.KEY_TRADINGSTATUS_TRADING:
-                symbol: str = symbol_info[consts.KEY_BASEASSET]
-                quote_currency: str = symbol_info[consts.KEY_QUOTEASSET]
-                product_id: str = self.getProductIdFromCoinAndQuoteCurrency(symbol, quote_currency)
-                if not interesting_product_id_list or product_id in interesting_product_id_list:
-                    delisted_product_ids.append(product_id)
-
-        delisted_product_ids_str = '\n' + '\n'.join(delisted_product_ids)
-        logging.info(f'{len(delisted_product_ids)} delisted products found: {delisted_product_ids_str}')
-        return delisted_product_ids
+            isPerpetualFuture: bool = symbol_info[consts.KEY_CONTRACTTYPE] == consts.KEY_CONTRACTTYPE_PERP
+            product_id: str = self.getProductIdFromCoinAndQuoteCurrency(symbol, quote_currency)
+            products.append(mdProductCatalog.createProduct(product_id, symbol, quote_currency, trading_status,
+                                                           trading_status != consts.KEY_TRADINGSTATUS_TRADING,
+                                                           isPerpetualFuture))
+        return products
 
     def downloadAndWriteData(self, product_id: str, timeframe: str, filename: str, is_delisted: bool) -> bool:
         if not self.validateTimeframeStr(timeframe):
@@ -76,12 +55,18 @@ class binanceFundingRateRecorder(MDRecorderBase):
 
         granularity: int = self.getNumMillisecondsFromTimeframe(timeframe)
         min_req_start_time: int = self.getMinReqStartTime(filename)
-        candles: list[list[str | int]] = []
+        candles: mdCandleBuffer = self.createCandleBuffer(filename, descending=True)
         request_url = self.api_url + 'fundingRate'
         req_end_time: int = int(granularity * int(time.time()*1000 / granularity))
+        progress: mdDownloadProgress = self.createDownloadProgress(product_id, timeframe)
         logging.info(f'Starting download of funding rates for {product_id} to {filename}. '
                      f'minReqStartTime:{min_req_start_time}')
         loop_iteration_number = 0
+        resume_timestamp: int | None = self.getStreamingResumeTimestamp(filename)
+        if resume_timestamp is not None:
+            # Continue an interrupted chunked download below its oldest flushed candle
+            req_end_time = resume_timestamp
+            loop_iteration_number = 1
         while req_end_time > min_req_start_time:
             loop_iteration_number += 1
             req_start_time = req_end_time - granularity * self.max_candles_per_api_request
@@ -98,9 +83,9 @@ class binanceFundingRateRecorder(MDRecorderBase):
                     'symbol': product_id.replace('-', ''),
                     'limit': str(int(self.max_candles_per_api_request))
                 }
-            r = self.request_handler.get(request_url, params)
+            r = self.getSeriesResponse(request_url, params, product_id, timeframe)
 
-            r_json: list[dict] = r.json()
+            r_json: list[dict] = self.json_decoder.decodeResponse(r)
             if len(r_json) == 0:
                 logging.info(f'Received blank response. Breaking out of loop')
                 break
@@ -112,11 +97,11 @@ class binanceFundingRateRecorder(MDRecorderBase):
                 new_candles_arr.append([funding_time, funding_rate])
 
             if loop_iteration_number == 1 and is_delisted:
-                req_start_time = self.getDateTimestampFromLine(','.join(str(x) for x in new_candles_arr[0]))
+                req_start_time = self.getDateTimestampFromRow(new_candles_arr[0])
                 # if file exists, check if it is already up to date
                 if min_req_start_time != 0:
                     latest_candle_str = ','.join(str(x) for x in new_candles_arr[-1])
-                    raw_last_line: str = self.getLastNonBlankLineFromFile(filename)
+                    raw_last_line: str = self.getLastCandleLineFromFile(filename)
 
                     # also create float arrays in case one of the lines has a number like 1.0 instead of 1 etc
                     latest_candle_float_arr: list[float] = [float(x) for x in latest_candle_str.split(',')]
@@ -131,16 +116,14 @@ class binanceFundingRateRecorder(MDRecorderBase):
             req_end_time = int(req_start_time/1000)*1000
 
             candles += new_candles_arr
-            earliest_timestamp: int = self.getDateTimestampFromLine(','.join(str(x) for x in new_candles_arr[0]))
-            latest_timestamp: int = self.getDateTimestampFromLine(','.join(str(x) for x in new_candles_arr[-1]))
-            logging.info(f'URL:{r.url} NumCandlesReceived:{len(new_candles_arr)} '
-                         f'EarliestTimestamp:{earliest_timestamp} ({datetime.fromtimestamp(earliest_timestamp / 1000)})'
-                         f' LatestTimestamp:{latest_timestamp} ({datetime.fromtimestamp(latest_timestamp / 1000)})')
+            earliest_timestamp, latest_timestamp = self.getDateTimestampRangeFromRows(new_candles_arr)
+            progress.onPage(r.url, len(new_candles_arr), earliest_timestamp, latest_timestamp)
 
         if loop_iteration_number == 0 and len(candles) == 0 and min_req_start_time != 0:
             logging.info(f'Data already up to date for {filename}')
             return True
 
+        progress.finish()
         return self.writeToDisk(candles, filename)
 
     # Available timeframes: 8h
@@ -154,6 +137,13 @@ class binanceFundingRateRecorder(MDRecorderBase):
 
         return True
 
+    def getGranularity(self, timeframe: str) -> int | None:
+        return self.getNumMillisecondsFromTimeframe(timeframe) if self.validateTimeframeStr(timeframe) else None
+
+    @staticmethod
+    def getTimestampUnitsPerSec() -> int:
+        return 1000
+
     @staticmethod
     def getNumMillisecondsFromTimeframe(timeframe: str) -> int:
         if not binanceFundingRateRecorder.validateTimeframeStr(timeframe):
@@ -167,7 +157,7 @@ class binanceFundingRateRecorder(MDRecorderBase):
                 os._exit(1)
 
     def getMinReqStartTime(self, filename: str) -> int:
-        file_exists = os.path.isfile(filename)
+        file_exists = self.isExistingMDFile(filename)
         if self.write_new_files or not file_exists:
             return 0
 
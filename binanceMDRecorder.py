@@ -1,9 +1,13 @@
 import logging
 import os.path
-import random
 import time
-from datetime import datetime
+from datetime import datetime, timezone
+import numpy as np
 from MDRecorderBase import MDRecorderBase
+from mdCandleBuffer import mdCandleBuffer
+from mdLogging import mdDownloadProgress
+from mdProductCatalog import mdProductCatalog
+from typing import Callable
 
 
 class consts:
@@ -14,6 +18,12 @@ class consts:
     KEY_TRADINGSTATUS = 'status'
     KEY_TRADINGSTATUS_TRADING = 'TRADING'
     KEY_TRADINGSTATUS_DELISTED = 'BREAK'
+    WEBSOCKET_URL = 'wss://stream.binance.com:9443/stream'  # combined streams
+    # Layout of a kline array (prices and volumes are sent as strings)
+    CANDLE_DTYPES = {'open_time': np.int64, 'open': np.float64, 'high': np.float64, 'low': np.float64,
+                     'close': np.float64, 'volume': np.float64, 'close_time': np.int64,
+                     'quote_asset_volume': np.float64, 'number_of_trades': np.int64,
+                     'taker_buy_base_asset_volume': np.float64, 'taker_buy_quote_asset_volume': np.float64}
 
 
 class binanceMDRecorder(MDRecorderBase):
@@ -24,44 +34,22 @@ class binanceMDRecorder(MDRecorderBase):
         MDRecorderBase.__init__(self, api_url, header, key_date, max_candles_per_api_request, exchange_name,
                                 interesting_base_currencies, interesting_quote_currencies, output_directory, timeframes,
                                 write_new_files, max_api_requests_per_sec, cooldown_period_in_sec, use_parquet_files)
+        self.candle_dtypes = consts.CANDLE_DTYPES
 
-    def getAllInterestingProductIDs(self) -> list[str]:
+    def fetchProductCatalogEntries(self) -> list[dict]:
         request_url = self.api_url + 'exchangeInfo'
         r = self.request_handler.get(request_url)
 
-        interesting_product_ids: list[str] = []
-        symbol_info_list: list[dict[str, str]] = r.json()[consts.KEY_SYMBOLS]
+        products: list[dict] = []
+        symbol_info_list: list[dict[str, str]] = self.json_decoder.decodeResponse(r)[consts.KEY_SYMBOLS]
         for symbol_info in symbol_info_list:
             quote_currency: str = symbol_info[consts.KEY_QUOTEASSET]
             symbol: str = symbol_info[consts.KEY_BASEASSET]
-            if self.isInterestingQuoteCurrency(quote_currency) and self.isInterestingBaseCurrency(symbol):
-                product_id: str = self.getProductIdFromCoinAndQuoteCurrency(symbol, quote_currency)
-                interesting_product_ids.append(product_id)
-
-        random.shuffle(interesting_product_ids)
-        product_ids_str = '\n' + '\n'.join(interesting_product_ids)
-        logging.info(
-            f'{len(interesting_product_ids)}/{len(symbol_info_list)} interesting products found:{product_ids_str}')
-        return interesting_product_ids
-
-    def getAllDelistedProductIDs(self, interesting_product_ids: list[str]) -> list[str]:
-        request_url = self.api_url + 'exchangeInfo'
-        r = self.request_handler.get(request_url)
-
-        delisted_product_ids: list[str] = []
-        symbol_info_list: list[dict[str, str]] = r.json()[consts.KEY_SYMBOLS]
-        for symbol_info in symbol_info_list:
             trading_status: str = symbol_info[consts.KEY_TRADINGSTATUS]
-            if trading_status == consts.KEY_TRADINGSTATUS_DELISTED:
-                symbol: str = symbol_info[consts.KEY_BASEASSET]
-                quote_currency: str = symbol_info[consts.KEY_QUOTEASSET]
-                product_id: str = self.getProductIdFromCoinAndQuoteCurrency(symbol, quote_currency)
-                if not interesting_product_ids or product_id in interesting_product_ids:
-                    delisted_product_ids.append(product_id)
-
-        delisted_product_ids_str = '\n' + '\n'.join(delisted_product_ids)
-        logging.info(f'{len(delisted_product_ids)} delisted products found: {delisted_product_ids_str}')
-        return delisted_product_ids
+            product_id: str = self.getProductIdFromCoinAndQuoteCurrency(symbol, quote_currency)
+            products.append(mdProductCatalog.createProduct(product_id, symbol, quote_currency, trading_status,
+                                                           trading_status == consts.KEY_TRADINGSTATUS_DELISTED))
+        return products
 
     def downloadAndWriteData(self, product_id: str, timeframe: str, filename: str, is_delisted: bool) -> bool:
         if not self.validateTimeframeStr(timeframe):
@@ -70,9 +58,13 @@ class binanceMDRecorder(MDRecorderBase):
 
         granularity: int = self.getNumMillisecondsFromTimeframeStr(timeframe)
         req_start_time: int = self.getReqStartTime(filename)
-        candles: list[list] = []
+        resume_timestamp: int | None = self.getStreamingResumeTimestamp(filename, descending=False)
+        if resume_timestamp is not None:
+            req_start_time = max(req_start_time, resume_timestamp)
+        candles: mdCandleBuffer = self.createCandleBuffer(filename)
         num_empty_responses: int = 0
         request_url: str = self.api_url + 'klines'
+        progress: mdDownloadProgress = self.createDownloadProgress(product_id, timeframe)
         logging.info(f'Starting download of {timeframe} candles for {product_id} to {filename}.'
                      f' reqStartTime:{req_start_time}')
 
@@ -84,30 +76,27 @@ class binanceMDRecorder(MDRecorderBase):
                 # 'endTime': e,
                 'limit': str(int(self.max_candles_per_api_request))
             }
-            r = self.request_handler.get(request_url, params)
-            r_json: list[list] = r.json()
+            r = self.getSeriesResponse(request_url, params, product_id, timeframe)
+            r_json: list[list] = self.json_decoder.decodeResponse(r)
             if len(r_json) == 0:
                 num_empty_responses += 1
                 req_start_time += granularity * self.max_candles_per_api_request
-                logging.info(f'Received blank response. numEmptyResponses:{num_empty_responses}')
+                progress.onEmptyPage(num_empty_responses)
                 continue
 
             candles += r_json
             num_empty_responses = 0
-            earliest_timestamp: int = self.getDateTimestampFromLine(','.join(str(x) for x in r_json[0]))
-            latest_timestamp: int = self.getDateTimestampFromLine(','.join(str(x) for x in r_json[-1]))
-            logging.info(f'URL:{r.url} NumCandlesReceived:{len(r_json)} '
-                         f'EarliestTimestamp:{earliest_timestamp} ({datetime.fromtimestamp(earliest_timestamp / 1000)})'
-                         f' LatestTimestamp:{latest_timestamp} ({datetime.fromtimestamp(latest_timestamp / 1000)})')
+            earliest_timestamp, latest_timestamp = self.getDateTimestampRangeFromRows(r_json)
+            progress.onPage(r.url, len(r_json), earliest_timestamp, latest_timestamp)
 
             # These conditions would be true only if a request is sent on a delisted product
             # and there is an up to date existing market data file
             if is_delisted and len(r_json) == 1 and len(candles) == 1 and req_start_time != 0:
-                candle_str: str = ','.join(str(e) for e in candles[0])
-                raw_last_line: str = self.getLastNonBlankLineFromFile(filename)
+                candle_str: str = ','.join(str(e) for e in r_json[0])
+                raw_last_line: str = self.getLastCandleLineFromFile(filename)
 
                 # also create float arrays in case one of the lines has a number like 1.0 instead of 1 etc
-                candle_float_arr: list[float] = [float(x) for x in candles[0]]
+                candle_float_arr: list[float] = [float(x) for x in r_json[0]]
                 raw_last_line_arr: list[float] = [float(x) for x in raw_last_line.split(',')]
 
                 if candle_str == raw_last_line or candle_float_arr == raw_last_line_arr:
@@ -115,8 +104,61 @@ class binanceMDRecorder(MDRecorderBase):
                     return True
 
             req_start_time = latest_timestamp + granularity
+            # Once the start of the data is known, the rest of the history can be split up into independent windows
+            if self.max_parallel_windows > 1:
+                windows = self.planRequestWindows(req_start_time, int(time.time() * 1000),
+                                                  granularity * self.max_candles_per_api_request)
+                for window_candles in self.fetchWindowsInParallel(
+                        windows, lambda s, e: self.downloadWindow(request_url, product_id, timeframe, s, e,
+                                                                  progress)):
+                    candles += window_candles
+                break
+        progress.finish()
         return self.writeToDisk(candles, filename)
 
+    def downloadWindow(self, request_url: str, product_id: str, timeframe: str, start_time: int,
+                       end_time: int, progress: mdDownloadProgress) -> list[list]:
+        params: dict[str, str] = {
+            'symbol': product_id.replace('-', ''),
+            'interval': timeframe,
+            'startTime': str(int(start_time)),
+            'endTime': str(int(end_time - 1)),
+            'limit': str(int(self.max_candles_per_api_request))
+        }
+        r = self.getSeriesResponse(request_url, params, product_id, timeframe)
+        r_json: list[list] = self.json_decoder.decodeResponse(r)
+        if len(r_json) > 0:
+            progress.onPage(r.url, len(r_json), *self.getDateTimestampRangeFromRows(r_json))
+        return r_json
+
+    def getGranularity(self, timeframe: str) -> int | None:
+        return self.getNumMillisecondsFromTimeframeStr(timeframe) if self.validateTimeframeStr(timeframe) else None
+
+    @staticmethod
+    def getTimestampUnitsPerSec() -> int:
+        return 1000
+
+    # Monthly candles close at the start of the next calendar month rather than every getGranularity (28 days)
+    def getNextCandleCloseTime(self, timeframe: str, timestamp_in_sec: float) -> float | None:
+        if timeframe != '1M':
+            return MDRecorderBase.getNextCandleCloseTime(self, timeframe, timestamp_in_sec)
+        now: datetime = datetime.fromtimestamp(timestamp_in_sec, timezone.utc)
+        return datetime(now.year + now.month // 12, now.month % 12 + 1, 1, tzinfo=timezone.utc).timestamp()
+
+    def getGapFetcher(self, product_id: str, timeframe: str) -> tuple[int, Callable[[int, int], list[list]]] | None:
+        if not self.validateTimeframeStr(timeframe):
+            return None
+        request_url: str = self.api_url + 'klines'
+        progress: mdDownloadProgress = self.createDownloadProgress(product_id, timeframe)
+        return self.getNumMillisecondsFromTimeframeStr(timeframe), \
+            lambda s, e: self.downloadWindow(request_url, product_id, timeframe, s, e, progress)
+
+    def createKlineStream(self, websocket_url: str | None, product_ids: list[str], timeframes: list[str]):
+        # Imported here so that aiohttp is only required when streaming
+        from mdKlineStream import binanceKlineStream
+        return binanceKlineStream(websocket_url or consts.WEBSOCKET_URL, product_ids,
+                                  [x for x in timeframes if self.validateTimeframeStr(x)], self.onClosedCandle)
+
     # Available timeframes:
     # s-> seconds; m -> minutes; h -> hours; d -> days; w -> weeks; M -> months
     # 1s, 1m, 3m, 5m, 15m, 30m, 1h, 2h, 4h, 6h, 8h, 12h, 1d, 3d, 1w, 1M
@@ -174,7 +216,7 @@ class binanceMDRecorder(MDRecorderBase):
                 os._exit(1)
 
     def getReqStartTime(self, filename: str) -> int:
-        file_exists = os.path.isfile(filename)
+        file_exists = self.isExistingMDFile(filename)
         if self.write_new_files or not file_exists:
             return 0
 
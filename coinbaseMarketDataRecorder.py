@@ -1,8 +1,11 @@
 import logging
-import random
-from datetime import datetime
 import os
+import numpy as np
 from MDRecorderBase import MDRecorderBase
+from mdCandleBuffer import mdCandleBuffer
+from mdLogging import mdDownloadProgress
+from mdProductCatalog import mdProductCatalog
+from typing import Callable
 import time
 
 
@@ -13,6 +16,10 @@ class consts:
     KEY_TRADINGSTATUS = 'status'
     KEY_TRADINGSTATUS_TRADING = 'online'
     KEY_TRADINGSTATUS_DELISTED = 'delisted'
+    WEBSOCKET_URL = 'wss://advanced-trade-ws.coinbase.com'  # the Exchange websocket feed has no candles channel
+    # Layout of a candle array: [time, low, high, open, close, volume]
+    CANDLE_DTYPES = {'open_time': np.int64, 'low': np.float64, 'high': np.float64, 'open': np.float64,
+                     'close': np.float64, 'volume': np.float64}
 
 
 # https://docs.cloud.coinbase.com/exchange/reference/exchangerestapi_getproductcandles
@@ -25,59 +32,43 @@ class coinbaseMDRecorder(MDRecorderBase):
         MDRecorderBase.__init__(self, api_url, header, key_date, max_candles_per_api_request, exchange_name,
                                 interesting_base_currencies, interesting_quote_currencies, output_directory, timeframes,
                                 write_new_files, max_api_requests_per_sec, cooldown_period_in_sec, use_parquet_files)
+        self.candle_dtypes = consts.CANDLE_DTYPES
 
-    def getAllInterestingProductIDs(self) -> list[str]:
+    def fetchProductCatalogEntries(self) -> list[dict]:
         request_url = self.api_url + 'products'
         r = self.request_handler.get(request_url)
 
-        interesting_product_ids: list[str] = []
-        response_list: list[dict[str, str]] = r.json()
+        products: list[dict] = []
+        response_list: list[dict[str, str]] = self.json_decoder.decodeResponse(r)
         for response in response_list:
             quoteCurrency: str = response[consts.KEY_QUOTECURRENCY]
             symbol: str = response[consts.KEY_BASECURRENCY]
-            if self.isInterestingQuoteCurrency(quoteCurrency) and self.isInterestingBaseCurrency(symbol):
-                # Get product_id from response instead of from getProductIdFromCoinAndQuoteCurrency because
-                # coinbase has cases like BTCAUCTION-USD where symbol = BTC & quoteCurrency = USD for both
-                # BTCUSD and BTCAUCTION-USD
-                product_id: str = response[consts.KEY_PRODUCTID]
-                interesting_product_ids.append(product_id)
-
-        random.shuffle(interesting_product_ids)
-        product_ids_str = '\n' + '\n'.join(interesting_product_ids)
-        logging.info(
-            f'{len(interesting_product_ids)}/{len(response_list)} interesting products found: {product_ids_str}')
-        return interesting_product_ids
-
-    def getAllDelistedProductIDs(self, interesting_product_id_list: list[str]) -> list[str]:
-        request_url = self.api_url + 'products'
-        r = self.request_handler.get(request_url)
-        delisted_product_ids: list[str] = []
-        response_list: list[dict[str, str]] = r.json()
-        for response in response_list:
             trading_status: str = response[consts.KEY_TRADINGSTATUS]
-            if trading_status == consts.KEY_TRADINGSTATUS_DELISTED:
-                # Get product_id from response instead of from getProductIdFromCoinAndQuoteCurrency because
-                # coinbase has cases like BTCAUCTION-USD where symbol = BTC & quoteCurrency = USD for both
-                # BTCUSD and BTCAUCTION-USD
-                product_id: str = response[consts.KEY_PRODUCTID]
-                if not interesting_product_id_list or product_id in interesting_product_id_list:
-                    delisted_product_ids.append(product_id)
-
-        delisted_product_ids_str = '\n' + '\n'.join(delisted_product_ids)
-        logging.info(f'{len(delisted_product_ids)} delisted products found: {delisted_product_ids_str}')
-        return delisted_product_ids
+            # Get product_id from response instead of from getProductIdFromCoinAndQuoteCurrency because
+            # coinbase has cases like BTCAUCTION-USD where symbol = BTC & quoteCurrency = USD for both
+            # BTCUSD and BTCAUCTION-USD
+            product_id: str = response[consts.KEY_PRODUCTID]
+            products.append(mdProductCatalog.createProduct(product_id, symbol, quoteCurrency, trading_status,
+                                                           trading_status == consts.KEY_TRADINGSTATUS_DELISTED))
+        return products
 
     def downloadAndWriteData(self, product_id: str, timeframe: str, filename: str, is_delisted: bool) -> bool:
         granularity: int = self.getGranularityFromTimeframeStr(timeframe)
         min_req_start_time: int = self.getMinReqStartTime(filename)
-        candles: list[list] = []
+        candles: mdCandleBuffer = self.createCandleBuffer(filename, descending=True)
         num_empty_responses: int = 0
         request_url = self.api_url + f'products/{product_id}/candles'
         req_end_time: int = int(granularity * int(time.time() / granularity))
+        progress: mdDownloadProgress = self.createDownloadProgress(product_id, timeframe)
 
         logging.info(f'Starting download of {timeframe} candles for {product_id} to {filename}.'
                      f' minReqStartTime:{min_req_start_time}')
         loop_iteration_number: int = 0
+        resume_timestamp: int | None = self.getStreamingResumeTimestamp(filename)
+        if resume_timestamp is not None:
+            # Continue an interrupted chunked download below its oldest flushed candle
+            req_end_time = resume_timestamp - granularity
+            loop_iteration_number = 1
         while num_empty_responses < 3 and req_end_time >= min_req_start_time:
             loop_iteration_number += 1
             req_start_time: int = req_end_time - granularity * (self.max_candles_per_api_request - 1)
@@ -93,16 +84,16 @@ class coinbaseMDRecorder(MDRecorderBase):
                     'end': str(int(req_end_time))
                 }
 
-            r = self.request_handler.get(request_url, params)
-            r_json: list[list] = r.json()
+            r = self.getSeriesResponse(request_url, params, product_id, timeframe)
+            r_json: list[list] = self.json_decoder.decodeResponse(r)
 
             if loop_iteration_number == 1 and len(r_json) > 0:
                 if min_req_start_time == 0 or is_delisted:
-                    req_start_time = self.getDateTimestampFromLine(','.join(str(x) for x in r_json[-1]))
+                    req_start_time = self.getDateTimestampFromRow(r_json[-1])
 
                 if is_delisted and min_req_start_time != 0:
                     latest_candle_str: str = ','.join(str(e) for e in r_json[0])
-                    raw_last_line: str = self.getLastNonBlankLineFromFile(filename)
+                    raw_last_line: str = self.getLastCandleLineFromFile(filename)
 
                     # also create float arrays in case one of the lines has a number like 1.0 instead of 1 etc
                     latest_candle_float_arr: list[float] = [float(x) for x in r_json[0]]
@@ -117,21 +108,59 @@ class coinbaseMDRecorder(MDRecorderBase):
             req_end_time = req_start_time - granularity
             if len(r_json) == 0:
                 num_empty_responses += 1
-                logging.info(f'Received empty response. numEmptyResponses:{num_empty_responses}')
+                progress.onEmptyPage(num_empty_responses)
                 continue
 
             candles += r_json
             num_empty_responses = 0
-            earliest_timestamp: int = self.getDateTimestampFromLine(','.join(str(x) for x in r_json[-1]))
-            latest_timestamp: int = self.getDateTimestampFromLine(','.join(str(x) for x in r_json[0]))
-            logging.info(f'URL:{r.url} NumCandlesReceived:{len(r_json)}'
-                         f' EarliestTimestamp:{earliest_timestamp} ({datetime.fromtimestamp(earliest_timestamp)})'
-                         f' LatestTimestamp:{latest_timestamp} ({datetime.fromtimestamp(latest_timestamp)})')
+            earliest_timestamp, latest_timestamp = self.getDateTimestampRangeFromRows(r_json)
+            progress.onPage(r.url, len(r_json), earliest_timestamp, latest_timestamp)
+
+            # Once the latest candles are known, the rest of the history can be split up into independent windows
+            # (newest first, like the sequential loop)
+            if self.max_parallel_windows > 1:
+                windows = self.planRequestWindows(min_req_start_time, req_end_time + granularity,
+                                                  granularity * self.max_candles_per_api_request, descending=True)
+                for window_candles in self.fetchWindowsInParallel(
+                        windows, lambda s, e: self.downloadWindow(request_url, product_id, timeframe, granularity,
+                                                                  s, e, progress)):
+                    candles += window_candles
+                break
+
+        progress.finish()
+        return self.writeToDisk(candles, filename)
+
+    def downloadWindow(self, request_url: str, product_id: str, timeframe: str, granularity: int, start_time: int,
+                       end_time: int, progress: mdDownloadProgress) -> list[list]:
+        params: dict[str, str] = {
+            'granularity': str(int(granularity)),
+            'start': str(int(start_time)),
+            'end': str(int(end_time - granularity))
+        }
+        r = self.getSeriesResponse(request_url, params, product_id, timeframe)
+        r_json: list[list] = self.json_decoder.decodeResponse(r)
+        if len(r_json) > 0:
+            progress.onPage(r.url, len(r_json), *self.getDateTimestampRangeFromRows(r_json))
+        return r_json
+
+    def getGranularity(self, timeframe: str) -> int | None:
+        return self.getGranularityFromTimeframeStr(timeframe)
+
+    def getGapFetcher(self, product_id: str, timeframe: str) -> tuple[int, Callable[[int, int], list[list]]] | None:
+        granularity: int = self.getGranularityFromTimeframeStr(timeframe)
+        request_url: str = self.api_url + f'products/{product_id}/candles'
+        progress: mdDownloadProgress = self.createDownloadProgress(product_id, timeframe)
+        return granularity, lambda s, e: self.downloadWindow(request_url, product_id, timeframe, granularity, s, e,
+                                                             progress)
 
-        return self.writeToDisk(candles[::-1], filename)
+    def createKlineStream(self, websocket_url: str | None, product_ids: list[str], timeframes: list[str]):
+        # Imported here so that aiohttp is only required when streaming
+        from mdKlineStream import coinbaseKlineStream
+        return coinbaseKlineStream(websocket_url or consts.WEBSOCKET_URL, product_ids, timeframes,
+                                   self.onClosedCandle)
 
     def getMinReqStartTime(self, filename: str) -> int:
-        file_exists: bool = os.path.isfile(filename)
+        file_exists: bool = self.isExistingMDFile(filename)
         if self.write_new_files or not file_exists:
             return 0
 
@@ -1,10 +1,10 @@
 import logging
 import os
-import random
 import time
-from datetime import datetime
 
 from MDRecorderBase import MDRecorderBase
+from mdLogging import mdDownloadProgress
+from mdProductCatalog import mdProductCatalog
 
 
 class consts:
@@ -31,57 +31,39 @@ class ftxMDRecorder(MDRecorderBase):
                                 interesting_base_currencies, interesting_quote_currencies, output_directory, timeframes,
                                 write_new_files, max_api_requests_per_sec, cooldown_period_in_sec, use_parquet_files)
 
-    def getAllInterestingProductIDs(self):
+    def fetchProductCatalogEntries(self):
         request_url = self.api_url + 'markets'
         r = self.request_handler.get(request_url)
 
-        symbol_info_list = r.json()[consts.KEY_DATA]
-        interesting_product_ids = []
+        symbol_info_list = self.json_decoder.decodeResponse(r)[consts.KEY_DATA]
+        products = []
         for symbol_info in symbol_info_list:
             quote_currency = symbol_info[consts.KEY_QUOTECURRENCY]
             coin = symbol_info[consts.KEY_BASECURRENCY]
+            trading_enabled = symbol_info[consts.KEY_TRADING_ENABLED]
             isTokenizedEquity = symbol_info.get(consts.KEY_TOKENIZED_EQUITY, False)
             isETF = symbol_info[consts.KEY_IS_ETF_MARKET]
-            if self.isInterestingQuoteCurrency(quote_currency) and self.isInterestingBaseCurrency(coin) and \
-                    not isTokenizedEquity and not isETF:
-                product_id = self.getProductIdFromCoinAndQuoteCurrency(coin, quote_currency)
-                interesting_product_ids.append(product_id)
-
-        random.shuffle(interesting_product_ids)
-        product_ids_str = '\n' + '\n'.join(interesting_product_ids)
-        logging.info(
-            f'{len(interesting_product_ids)}/{len(symbol_info_list)} interesting products found:{product_ids_str}')
-        return interesting_product_ids
-
-    def getAllDelistedProductIDs(self, interesting_product_id_list):
-        request_url = self.api_url + 'markets'
-        r = self.request_handler.get(request_url)
-
-        symbol_info_list = r.json()[consts.KEY_DATA]
-        delisted_product_ids = []
-        for symbol_info in symbol_info_list:
-            trading_enabled = symbol_info[consts.KEY_TRADING_ENABLED]
-            if not trading_enabled:
-                quote_currency = symbol_info[consts.KEY_QUOTECURRENCY]
-                coin = symbol_info[consts.KEY_BASECURRENCY]
-                product_id = self.getProductIdFromCoinAndQuoteCurrency(coin, quote_currency)
-                if not interesting_product_id_list or product_id in interesting_product_id_list:
-                    delisted_product_ids.append(product_id)
-
-        delisted_product_ids_str = '\n' + '\n'.join(delisted_product_ids)
-        logging.info(f'{len(delisted_product_ids)} delisted products found: {delisted_product_ids_str}')
-        return delisted_product_ids
+            product_id = self.getProductIdFromCoinAndQuoteCurrency(coin, quote_currency)
+            products.append(mdProductCatalog.createProduct(product_id, coin, quote_currency, trading_enabled,
+                                                           not trading_enabled, not isTokenizedEquity and not isETF))
+        return products
 
     # Note: isDelisted case is not handled in FTX because I couldn't find an existing delisted product to
     # test is with.
     def downloadAndWriteData(self, product_id, timeframe, filename, is_delisted):
         resolution = self.getResolutionFromTimeframeStrInSec(timeframe)
         minReqStartTime = self.getMinReqStartTime(filename)
-        candles = []
+        candles = self.createCandleBuffer(filename, descending=True)
         request_url = self.api_url + f'markets/{product_id.replace("-", "/")}/candles'
         numEmptyResponses = 0
         reqEndTime = int(resolution * int(time.time() / resolution))
         loop_iteration_number = 0
+        resumeTimestamp = self.getStreamingResumeTimestamp(filename)
+        if resumeTimestamp is not None:
+            # Continue an interrupted chunked download below its oldest flushed candle
+            reqEndTime = int(resumeTimestamp / 1000) - resolution
+            loop_iteration_number = 1
+        progress: mdDownloadProgress = self.createDownloadProgress(product_id, timeframe)
         logging.info(f'Starting download of {timeframe} candles for {product_id} to {filename}.'
                      f' minReqStartTime:{minReqStartTime}')
         while numEmptyResponses < 3 and reqEndTime >= minReqStartTime:
@@ -101,8 +83,8 @@ class ftxMDRecorder(MDRecorderBase):
                     'end_time': str(int(reqEndTime))
                 }
 
-            r = self.request_handler.get(request_url, params)
-            r_json = r.json()[consts.KEY_DATA]
+            r = self.getSeriesResponse(request_url, params, product_id, timeframe)
+            r_json = self.json_decoder.decodeResponse(r)[consts.KEY_DATA]
 
             if reqStartTime == 0 and len(r_json) > 0:
                 reqStartTime = int(int(r_json[0][consts.KEY_DATA_TIME]) / 1000)
@@ -113,18 +95,24 @@ class ftxMDRecorder(MDRecorderBase):
                 if reqStartTime == 0:
                     logging.error('Received empty response with reqStartTime:0. Unexpected behavior, aborting...')
                     return False
-                logging.info(f'Received empty response. numEmptyResponses:{numEmptyResponses}')
+                progress.onEmptyPage(numEmptyResponses)
                 continue
 
             candles += [self.convertJSONLineToMDFileString(x) for x in r_json]
             numEmptyResponses = 0
             earliestTimestamp = int(r_json[0][consts.KEY_DATA_TIME])
             latestTimestamp = int(r_json[-1][consts.KEY_DATA_TIME])
-            logging.info(f'NumCandlesReceived:{len(r_json)}'
-                         f' EarliestTimestamp:{earliestTimestamp} ({datetime.fromtimestamp(earliestTimestamp / 1000)})'
-                         f' LatestTimestamp:{latestTimestamp} ({datetime.fromtimestamp(latestTimestamp / 1000)})')
+            progress.onPage(r.url, len(r_json), earliestTimestamp, latestTimestamp)
+        progress.finish()
         return self.writeToDisk(candles, filename)
 
+    def getGranularity(self, timeframe: str) -> int | None:
+        return self.getResolutionFromTimeframeStrInSec(timeframe) * 1000
+
+    @staticmethod
+    def getTimestampUnitsPerSec() -> int:
+        return 1000
+
     @staticmethod
     def getResolutionFromTimeframeStrInSec(timeframeStr):
         match timeframeStr:
@@ -147,7 +135,7 @@ class ftxMDRecorder(MDRecorderBase):
                 os._exit(1)
 
     def getMinReqStartTime(self, filename):
-        fileExists = os.path.isfile(filename)
+        fileExists = self.isExistingMDFile(filename)
         if self.write_new_files or not fileExists:
             return 0
 
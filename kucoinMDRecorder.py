@@ -1,10 +1,14 @@
 import logging
-from datetime import datetime
 import os
-import random
 import time
 
+import numpy as np
+
 from MDRecorderBase import MDRecorderBase
+from mdCandleBuffer import mdCandleBuffer
+from mdLogging import mdDownloadProgress
+from mdProductCatalog import mdProductCatalog
+from typing import Callable
 
 
 class consts:
@@ -12,6 +16,9 @@ class consts:
     KEY_BASECURRENCY = 'baseCurrency'
     KEY_QUOTECURRENCY = 'quoteCurrency'
     KEY_TRADING_ENABLED = 'enableTrading'
+    # Layout of a candle array (all values are sent as strings): [time, open, close, high, low, volume, turnover]
+    CANDLE_DTYPES = {'open_time': np.int64, 'open': np.float64, 'close': np.float64, 'high': np.float64,
+                     'low': np.float64, 'volume': np.float64, 'turnover': np.float64}
 
 
 class kucoinMDRecorder(MDRecorderBase):
@@ -22,44 +29,22 @@ class kucoinMDRecorder(MDRecorderBase):
         MDRecorderBase.__init__(self, api_url, header, key_date, max_candles_per_api_request, exchange_name,
                                 interesting_base_currencies, interesting_quote_currencies, output_directory, timeframes,
                                 write_new_files, max_api_requests_per_sec, cooldown_period_in_sec, use_parquet_files)
+        self.candle_dtypes = consts.CANDLE_DTYPES
 
-    def getAllInterestingProductIDs(self) -> list[str]:
+    def fetchProductCatalogEntries(self) -> list[dict]:
         request_url = self.api_url + 'api/v2/symbols'
         r = self.request_handler.get(request_url)
 
-        symbol_info_list: list[dict[str, str]] = r.json()[consts.KEY_DATA]
-        interesting_product_ids: list[str] = []
+        products: list[dict] = []
+        symbol_info_list: list[dict[str, str]] = self.json_decoder.decodeResponse(r)[consts.KEY_DATA]
         for symbol_info in symbol_info_list:
             quote_currency: str = symbol_info[consts.KEY_QUOTECURRENCY]
             symbol: str = symbol_info[consts.KEY_BASECURRENCY]
-            if self.isInterestingQuoteCurrency(quote_currency) and self.isInterestingBaseCurrency(symbol):
-                product_id: str = self.getProductIdFromCoinAndQuoteCurrency(symbol, quote_currency)
-                interesting_product_ids.append(product_id)
-
-        random.shuffle(interesting_product_ids)
-        product_ids_str = '\n' + '\n'.join(interesting_product_ids)
-        logging.info(
-            f'{len(interesting_product_ids)}/{len(symbol_info_list)} interesting products found:{product_ids_str}')
-        return interesting_product_ids
-
-    def getAllDelistedProductIDs(self, interesting_product_id_list: list[str]) -> list[str]:
-        request_url = self.api_url + 'api/v2/symbols'
-        r = self.request_handler.get(request_url)
-
-        symbol_info_list: list[dict[str, str]] = r.json()[consts.KEY_DATA]
-        delisted_product_ids: list[str] = []
-        for symbol_info in symbol_info_list:
-            trading_enabled: str = symbol_info[consts.KEY_TRADING_ENABLED]
-            if not trading_enabled:
-                coin: str = symbol_info[consts.KEY_BASECURRENCY]
-                quote_currency: str = symbol_info[consts.KEY_QUOTECURRENCY]
-                product_id: str = self.getProductIdFromCoinAndQuoteCurrency(coin, quote_currency)
-                if not interesting_product_id_list or product_id in interesting_product_id_list:
-                    delisted_product_ids.append(product_id)
-
-        delisted_product_ids_str = '\n' + '\n'.join(delisted_product_ids)
-        logging.info(f'{len(delisted_product_ids)} delisted products found: {delisted_product_ids_str}')
-        return delisted_product_ids
+            trading_enabled: bool = symbol_info[consts.KEY_TRADING_ENABLED]
+            product_id: str = self.getProductIdFromCoinAndQuoteCurrency(symbol, quote_currency)
+            products.append(mdProductCatalog.createProduct(product_id, symbol, quote_currency, trading_enabled,
+                                                           not trading_enabled))
+        return products
 
     def downloadAndWriteData(self, product_id: str, timeframe: str, filename: str, is_delisted: bool) -> bool:
         if not self.validateTimeframeStr(timeframe):
@@ -69,13 +54,19 @@ class kucoinMDRecorder(MDRecorderBase):
         candle_type: str = self.getCandleTypeFromTimeframeStr(timeframe)
         granularity: int = self.getNumSecondsFromTimeframeStr(timeframe)
         min_req_start_time: int = self.getMinReqStartTime(filename)
-        candles: list[list] = []
+        candles: mdCandleBuffer = self.createCandleBuffer(filename, descending=True)
         request_url = self.api_url + 'api/v1/market/candles'
         num_empty_responses: int = 0
         req_end_time: int = int(granularity * int(time.time() / granularity + 1))
+        progress: mdDownloadProgress = self.createDownloadProgress(product_id, timeframe)
         logging.info(f'Starting download of {timeframe} candles for {product_id} to {filename}.'
                      f' minReqStartTime:{min_req_start_time}')
         loop_iteration_number: int = 0
+        resume_timestamp: int | None = self.getStreamingResumeTimestamp(filename)
+        if resume_timestamp is not None:
+            # Continue an interrupted chunked download below its oldest flushed candle
+            req_end_time = resume_timestamp
+            loop_iteration_number = 1
         while num_empty_responses < 3 and req_end_time > min_req_start_time:
             loop_iteration_number += 1
             req_start_time: int = req_end_time - granularity * self.max_candles_per_api_request
@@ -95,16 +86,16 @@ class kucoinMDRecorder(MDRecorderBase):
                     'endAt': str(int(req_end_time))
                 }
 
-            r = self.request_handler.get(request_url, params)
-            r_json: list[list] = r.json()[consts.KEY_DATA]
+            r = self.getSeriesResponse(request_url, params, product_id, timeframe)
+            r_json: list[list] = self.json_decoder.decodeResponse(r)[consts.KEY_DATA]
 
             if loop_iteration_number == 1 and len(r_json) > 0:
                 if min_req_start_time == 0 or is_delisted:
-                    req_start_time = self.getDateTimestampFromLine(','.join(str(x) for x in r_json[-1]))
+                    req_start_time = self.getDateTimestampFromRow(r_json[-1])
 
                 if is_delisted and min_req_start_time != 0:
                     latest_candle_str: str = ','.join(str(e) for e in r_json[0])
-                    raw_last_line: str = self.getLastNonBlankLineFromFile(filename)
+                    raw_last_line: str = self.getLastCandleLineFromFile(filename)
 
                     # also create float arrays in case one of the lines has a number like 1.0 instead of 1 etc
                     latest_candle_float_arr: list[float] = [float(x) for x in r_json[0]]
@@ -119,7 +110,7 @@ class kucoinMDRecorder(MDRecorderBase):
             req_end_time = req_start_time
             if len(r_json) == 0:
                 num_empty_responses += 1
-                logging.info(f'Received blank response. numEmptyResponses:{num_empty_responses}')
+                progress.onEmptyPage(num_empty_responses)
                 # If this was the first request sent to get latest candles then find where the
                 # data for that instrument stopped being broadcast (can happen with delisted instruments)
                 if req_start_time == 0:
@@ -128,13 +119,57 @@ class kucoinMDRecorder(MDRecorderBase):
 
             candles += r_json
             num_empty_responses = 0
-            earliest_timestamp = self.getDateTimestampFromLine(','.join(str(x) for x in r_json[-1]))
-            latest_timestamp = self.getDateTimestampFromLine(','.join(str(x) for x in r_json[0]))
-            logging.info(f'URL:{r.url} NumCandlesReceived:{len(r_json)}'
-                         f' EarliestTimestamp:{earliest_timestamp} ({datetime.fromtimestamp(earliest_timestamp)})'
-                         f' LatestTimestamp:{latest_timestamp} ({datetime.fromtimestamp(latest_timestamp)})')
+            earliest_timestamp, latest_timestamp = self.getDateTimestampRangeFromRows(r_json)
+            progress.onPage(r.url, len(r_json), earliest_timestamp, latest_timestamp)
+
+            # Once the latest candles are known, the rest of the history can be split up into independent windows
+            # (newest first, like the sequential loop)
+            if self.max_parallel_windows > 1:
+                windows = self.planRequestWindows(min_req_start_time, req_end_time,
+                                                  granularity * self.max_candles_per_api_request, descending=True)
+                for window_candles in self.fetchWindowsInParallel(
+                        windows, lambda s, e: self.downloadWindow(request_url, product_id, timeframe, candle_type,
+                                                                  s, e, progress)):
+                    candles += window_candles
+                break
+
+        progress.finish()
+        return self.writeToDisk(candles, filename)
+
+    def downloadWindow(self, request_url: str, product_id: str, timeframe: str, candle_type: str, start_time: int,
+                       end_time: int, progress: mdDownloadProgress) -> list[list]:
+        params: dict[str, str] = {
+            'symbol': product_id,
+            'type': candle_type,
+            'startAt': str(int(start_time)),
+            'endAt': str(int(end_time))
+        }
+        r = self.getSeriesResponse(request_url, params, product_id, timeframe)
+        r_json: list[list] = self.json_decoder.decodeResponse(r)[consts.KEY_DATA]
+        if len(r_json) > 0:
+            progress.onPage(r.url, len(r_json), *self.getDateTimestampRangeFromRows(r_json))
+        return r_json
 
-        return self.writeToDisk(candles[::-1], filename)
+    def getGranularity(self, timeframe: str) -> int | None:
+        return self.getNumSecondsFromTimeframeStr(timeframe) if self.validateTimeframeStr(timeframe) else None
+
+    def getGapFetcher(self, product_id: str, timeframe: str) -> tuple[int, Callable[[int, int], list[list]]] | None:
+        if not self.validateTimeframeStr(timeframe):
+            return None
+        candle_type: str = self.getCandleTypeFromTimeframeStr(timeframe)
+        request_url: str = self.api_url + 'api/v1/market/candles'
+        progress: mdDownloadProgress = self.createDownloadProgress(product_id, timeframe)
+        return self.getNumSecondsFromTimeframeStr(timeframe), \
+            lambda s, e: self.downloadWindow(request_url, product_id, timeframe, candle_type, s, e, progress)
+
+    # The websocket server (and a token to connect to it with) is requested from the REST API, unless websocket_url
+    # is set
+    def createKlineStream(self, websocket_url: str | None, product_ids: list[str], timeframes: list[str]):
+        # Imported here so that aiohttp is only required when streaming
+        from mdKlineStream import kucoinKlineStream
+        candle_types: dict[str, str] = {x: self.getCandleTypeFromTimeframeStr(x) for x in timeframes
+                                        if self.validateTimeframeStr(x)}
+        return kucoinKlineStream(websocket_url, self.api_url, product_ids, candle_types, self.onClosedCandle)
 
     @staticmethod
     def validateTimeframeStr(timeframe: str) -> bool:
@@ -220,7 +255,7 @@ class kucoinMDRecorder(MDRecorderBase):
                 os._exit(1)
 
     def getMinReqStartTime(self, filename: str) -> int:
-        file_exists: bool = os.path.isfile(filename)
+        file_exists: bool = self.isExistingMDFile(filename)
         if self.write_new_files or not file_exists:
             return 0
 
@@ -236,11 +271,11 @@ class kucoinMDRecorder(MDRecorderBase):
             'symbol': product_id,
             'type': self.getCandleTypeFromTimeframeStr('1d')
         }
-        r = self.request_handler.get(request_url, params)
-        r_json: list[list] = r.json()[consts.KEY_DATA]
+        r = self.getSeriesResponse(request_url, params, product_id, '1d')
+        r_json: list[list] = self.json_decoder.decodeResponse(r)[consts.KEY_DATA]
         logging.debug(f'findCloseTimestampOfLatestAvailableData received data:\n{r_json}')
         if len(r_json) > 0:
-            latest_data_timestamp = self.getDateTimestampFromLine(','.join(str(x) for x in r_json[0]))
+            latest_data_timestamp = self.getDateTimestampFromRow(r_json[0])
             calculated_close_timestamp = latest_data_timestamp + self.getNumSecondsFromTimeframeStr('1d')
         logging.info(f'findCloseTimestampOfLatestAvailableData returning calculatedCloseTimestamp:{calculated_close_timestamp} '
                      f'for product:{product_id} with observed latestDataTimestamp:{latest_data_timestamp}')
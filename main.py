@@ -4,11 +4,18 @@ load_ext_modules()
 
 # Regular imports
 import argparse
+import multiprocessing
+import os
 import sys
 
 from MDRecorderBase import MDRecorderBase
 from binanceFundingRateRecorder import binanceFundingRateRecorder
 from ftxMDRecorder import ftxMDRecorder
+from mdCandleSchema import createCandleSchema, mdCandleSchema, mdParquetOptions
+from mdJsonDecoder import mdJsonDecoder
+from mdLogging import consts as logging_consts, enableQueueLogging
+from mdMetrics import consts as metrics_consts
+from mdRateLimiter import createRateLimiter, tokenBucketRateLimiter
 from mdRecorderConfig import mdRecorderConfig
 from coinbaseMarketDataRecorder import coinbaseMDRecorder
 from binanceMDRecorder import binanceMDRecorder
@@ -16,7 +23,7 @@ from kucoinMDRecorder import kucoinMDRecorder
 import logging
 
 
-def main():
+def createArgumentParser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(description='Download market data files from crypto exchanges')
     requiredArgs = parser.add_argument_group('Required arguments')
     optionalArgs = parser.add_argument_group('Optional arguments')
@@ -24,7 +31,9 @@ def main():
 
     parser.add_argument('-d', '--debug', dest='debug', action='store_true', help='run in debug mode (more logging)')
 
-    requiredArgs.add_argument('-c', dest='config', type=str, required=True, metavar='', help='Config file')
+    requiredArgs.add_argument('-c', dest='config', type=str, required=True, metavar='',
+                              help='Config file (or comma separated list of config files, each recorded in its own '
+                                   'process)')
     requiredArgs.add_argument('-o', dest='outputDirectory', type=str, required=True, metavar='',
                               help='Directory where market data files are saved')
 
@@ -32,17 +41,97 @@ def main():
                               help='List of coins to download market data for (default = all)')
     optionalArgs.add_argument('-q', dest='interestingQuoteCurrencies', type=str, required=False, metavar='',
                               help='List of quote currencies to download market data for (default = all)')
+    optionalArgs.add_argument('--shards', dest='numShards', type=int, required=False, default=1, metavar='',
+                              help='Split the products of each config by hash across this many worker processes. '
+                                   'Rate limits stay global per exchange (default = 1)')
     optionalArgs.add_argument('-x', dest='numThreads', type=int, required=False, metavar='',
                               help='Number of threads to run (default = 5)')
+    optionalArgs.add_argument('--json-backend', dest='jsonBackend', type=str, required=False, default='auto',
+                              choices=['auto', 'orjson', 'simdjson', 'json'],
+                              help='JSON library used to decode responses (default = auto, i.e. fastest installed)')
+    optionalArgs.add_argument('-w', dest='maxParallelWindows', type=int, required=False, metavar='',
+                              help='Max number of request windows fetched in parallel when backfilling a single '
+                                   'product (default = 1, i.e. sequential)')
+    optionalArgs.add_argument('--flush-candles', dest='flushEveryNCandles', type=int, required=False, default=0,
+                              metavar='', help='Flush downloaded candles to disk every N candles (default = 0, i.e. '
+                                               'only once the download is complete)')
+    optionalArgs.add_argument('--flush-mb', dest='flushEveryNMegabytes', type=float, required=False, default=0,
+                              metavar='', help='Flush downloaded candles to disk every N megabytes (default = 0, '
+                                               'i.e. only once the download is complete)')
+    optionalArgs.add_argument('--catalog-ttl', dest='productCatalogTTL', type=int, required=False, default=0,
+                              metavar='', help='Reuse the product catalog saved by an earlier run if it is younger '
+                                               'than this many seconds, and refetch it once it is older with '
+                                               '--daemon (default = 0, i.e. always fetch; 3600 with --daemon)')
+    optionalArgs.add_argument('--writers', dest='numWriterProcesses', type=int, required=False, default=0,
+                              metavar='', help='Number of writer processes that files are written by, so that '
+                                               'downloads never wait for writes (default = 0, i.e. written by the '
+                                               'download threads)')
+    optionalArgs.add_argument('--max-pending-writes', dest='maxPendingWrites', type=int, required=False, default=0,
+                              metavar='', help='Max number of downloads waiting for a writer process '
+                                               '(default = 0, i.e. twice the number of writer processes)')
+    optionalArgs.add_argument('--daemon', dest='daemon', action='store_true', required=False,
+                              help='Keep running and update every timeframe right after each of its candles closes, '
+                                   'appending to existing files as with -a (stop with SIGTERM or Ctrl+C)')
+    optionalArgs.add_argument('--close-delay', dest='closeDelayInSec', type=float, required=False, default=2,
+                              metavar='', help='With --daemon, seconds to wait after a candle closes before '
+                                               'requesting it (default = 2)')
+    optionalArgs.add_argument('--stream', dest='stream', action='store_true', required=False,
+                              help='Like --daemon, but subscribe to the exchange\'s kline websocket streams and write '
+                                   'candles as they close. REST is only used for history, for candles missed while '
+                                   'disconnected and for timeframes the exchange doesn\'t stream (requires aiohttp)')
+    optionalArgs.add_argument('--stream-flush-interval', dest='streamFlushIntervalInSec', type=float, required=False,
+                              default=1, metavar='', help='With --stream, seconds that the closed candles of a series '
+                                                          'are collected before they are written together. Raise it '
+                                                          'for single parquet files, which are rewritten on every '
+                                                          'write (default = 1)')
+    optionalArgs.add_argument('--backfill-workers', dest='maxRunningBackfills', type=int, required=False, default=0,
+                              metavar='', help='Max number of threads running backfills at the same time, so that '
+                                               'the other threads keep files that only need an update current '
+                                               '(default = 0, i.e. half of the threads)')
     optionalArgs.add_argument('-n', dest='writeNewFiles', action='store_true', required=False,
                               help='Force write new market data files (even if old ones exist)')
     optionalArgs.add_argument('-z', dest='useParquet', action='store_true', required=False,
                               help='Write to parquet file (default=csv)')
+    optionalArgs.add_argument('--partitioned', dest='partitioned', action='store_true', required=False,
+                              help='With -z, write each series as a Hive style dataset partitioned by year and month '
+                                   '(exchange=/product=/timeframe=/year=/month=)')
+    optionalArgs.add_argument('-a', dest='appendOnly', action='store_true', required=False,
+                              help='Append new candles to existing files instead of rewriting them. Only CSV files '
+                                   'are appended to in place; parquet files are still rewritten, so use '
+                                   '--partitioned to only rewrite the latest monthly partitions')
+    optionalArgs.add_argument('--fill-gaps', dest='fillGaps', action='store_true', required=False,
+                              help='Scan every file for missing candles after updating it and refetch only those')
+    optionalArgs.add_argument('--log-mode', dest='logMode', type=str, required=False,
+                              default=logging_consts.LOG_MODE_VERBOSE,
+                              choices=[logging_consts.LOG_MODE_VERBOSE, logging_consts.LOG_MODE_SAMPLED],
+                              help='"sampled" logs each page of a download at debug level only, a progress line every '
+                                   '--log-interval seconds and a summary per download (default = verbose)')
+    optionalArgs.add_argument('--log-interval', dest='logIntervalInSec', type=float, required=False,
+                              default=logging_consts.DEFAULT_SAMPLE_INTERVAL_IN_SEC, metavar='',
+                              help='Seconds between progress lines of a download in sampled log mode '
+                                   f'(default = {logging_consts.DEFAULT_SAMPLE_INTERVAL_IN_SEC})')
+    optionalArgs.add_argument('--log-queue', dest='logQueue', action='store_true', required=False,
+                              help='Hand log records to a background thread instead of writing them from the '
+                                   'download threads')
+    optionalArgs.add_argument('--metrics-file', dest='metricsFile', type=str, required=False, metavar='',
+                              help='Export request latency, rate limiter wait, write/merge time and throughput '
+                                   'metrics to this file (one file per worker process, suffixed with its name)')
+    optionalArgs.add_argument('--metrics-format', dest='metricsFormat', type=str, required=False,
+                              choices=[metrics_consts.FORMAT_PROMETHEUS, metrics_consts.FORMAT_JSON],
+                              help='Format of the metrics file (default = json for .json files, prometheus text '
+                                   'otherwise, e.g. for the node exporter textfile collector)')
+    optionalArgs.add_argument('--metrics-interval', dest='metricsIntervalInSec', type=float, required=False,
+                              default=60, metavar='', help='Export the metrics every N seconds while recording '
+                                                           '(default = 60, 0 = only once done)')
 
+    cfgOverrideArgs.add_argument('--priority', dest='prioritySymbols', type=str, required=False, metavar='',
+                                 help='List of coins or product IDs that are recorded before all others')
     cfgOverrideArgs.add_argument('-t', dest='timeframes', type=str, required=False, metavar='',
                                  help='Timeframes to download data for (must be set here or in cfg file)')
     cfgOverrideArgs.add_argument('-u', dest='apiURL', type=str, required=False, metavar='',
                                  help='URL of exchange API')
+    cfgOverrideArgs.add_argument('--ws-url', dest='websocketURL', type=str, required=False, metavar='',
+                                 help='URL of exchange kline websocket streams')
     cfgOverrideArgs.add_argument('-r', dest='header', type=str, required=False, metavar='',
                                  help='List of header column names of received data (in order)')
     cfgOverrideArgs.add_argument('-k', dest='dateKey', type=str, required=False, metavar='',
@@ -54,12 +143,71 @@ def main():
                                  help='Max number of API requests that can be sent to the exchange per sec')
     cfgOverrideArgs.add_argument('-p', dest='cooldownPeriodInSec', type=int, required=False, metavar='',
                                  help='Cooldown period (in sec) before retrying in case of connection error')
+    return parser
+
 
-    args = parser.parse_args()
+def main():
+    args = createArgumentParser().parse_args()
     if args.debug:
         logging.getLogger().setLevel(logging.DEBUG)
+    if args.logQueue:
+        enableQueueLogging()
+
+    cmd: str = ' '.join(sys.argv)
+    logging.info(f'Running command: python {cmd}')
+
+    configFiles: list[str] = [x.strip() for x in args.config.split(',')]
+    numShards: int = max(1, args.numShards)
+    if len(configFiles) == 1 and numShards == 1:
+        recordExchange(args, configFiles[0])
+    else:
+        runSupervisor(args, configFiles, numShards)
+
+
+# Starts one worker process per config file and shard. Every exchange gets a single rate limiter whose state is
+# shared by all of its worker processes, so the configured limits hold for the whole run.
+def runSupervisor(args: argparse.Namespace, configFiles: list[str], numShards: int) -> None:
+    rateLimiters: dict[str, tokenBucketRateLimiter] = {}
+    processes: list[multiprocessing.Process] = []
+    for configFile in configFiles:
+        config: mdRecorderConfig = mdRecorderConfig(configFile)
+        exchangeName: str = args.exchangeName if args.exchangeName else config.getExchangeName()
+        if config.getHttpTransport() == 'external':
+            logging.warning(f'Config:{configFile} uses the external http transport. Its rate limit is not shared '
+                            f'with the other worker processes.')
+        if exchangeName not in rateLimiters:
+            maxAPIRequestsPerSec: int = args.maxAPIRequestsPerSec if args.maxAPIRequestsPerSec else config.getMaxNumberOfAPIRequestsPerSecond()
+            rateLimiters[exchangeName] = createRateLimiter(config.getRateLimiterType() or 'fixed', exchangeName,
+                                                           maxAPIRequestsPerSec, config.getMaxRequestWeightPerMinute(),
+                                                           process_shared=True)
+        for shardIndex in range(numShards):
+            process: multiprocessing.Process = multiprocessing.Process(
+                target=recordExchangeInWorkerProcess, name=f'{exchangeName}-shard{shardIndex}',
+                args=(args, configFile, shardIndex, numShards, rateLimiters[exchangeName]))
+            process.start()
+            processes.append(process)
+            logging.info(f'Started worker process:{process.name} (pid:{process.pid}) for config:{configFile}')
+
+    numFailedProcesses: int = 0
+    for process in processes:
+        process.join()
+        if process.exitcode != 0:
+            numFailedProcesses += 1
+            logging.error(f'Worker process:{process.name} exited with code:{process.exitcode}')
+    logging.info(f'Supervisor completed. NumWorkerProcesses:{len(processes)} NumFailures:{numFailedProcesses}')
+    if numFailedProcesses > 0:
+        sys.exit(1)
+
+
+def recordExchangeInWorkerProcess(args: argparse.Namespace, configFile: str, shardIndex: int, numShards: int,
+                                  rateLimiter: tokenBucketRateLimiter) -> None:
+    configureLogging(args.debug, args.logQueue)  # not inherited when worker processes are spawned instead of forked
+    recordExchange(args, configFile, shardIndex, numShards, rateLimiter)
+
 
-    config: mdRecorderConfig = mdRecorderConfig(args.config)
+def recordExchange(args: argparse.Namespace, configFile: str, shardIndex: int = 0, numShards: int = 1,
+                   rateLimiter: tokenBucketRateLimiter | None = None) -> None:
+    config: mdRecorderConfig = mdRecorderConfig(configFile)
 
     interestingQuoteCurrencies: list[str] = [x.strip() for x in args.interestingQuoteCurrencies.split(',')] if args.interestingQuoteCurrencies else config.getInterestingQuoteCurrencies()
     interestingBaseCurrencies: list[str] = [x.strip() for x in args.interestingBaseCurrencies.split(',')] if args.interestingBaseCurrencies else config.getInterestingCoins()
@@ -72,9 +220,6 @@ def main():
     maxAPIRequestsPerSec: int = args.maxAPIRequestsPerSec if args.maxAPIRequestsPerSec else config.getMaxNumberOfAPIRequestsPerSecond()
     cooldownPeriodInSec: int = args.cooldownPeriodInSec if args.cooldownPeriodInSec else config.getCooldownPeriodInSec()
 
-    cmd: str = ' '.join(sys.argv)
-    logging.info(f'Running command: python {cmd}')
-
     match exchangeName:
         case 'COINBASE':
             timeframes: list[str] = [x.strip() for x in
@@ -108,15 +253,73 @@ def main():
                                                     args.outputDirectory, args.writeNewFiles, maxAPIRequestsPerSec,
                                                     cooldownPeriodInSec, args.useParquet)
         case _:
-            print(f'Exchange:{exchangeName} not supported. Exiting...')
-            quit()
+            logging.error(f'Exchange:{exchangeName} not supported. Exiting...')
+            sys.exit(1)
 
+    mdRecorder.setAppendOnlyWrites(args.appendOnly)
+    mdRecorder.setPartitionedLayout(args.partitioned)
+    mdRecorder.setGapFilling(args.fillGaps)
+    mdRecorder.setLogMode(args.logMode, args.logIntervalInSec)
+    mdRecorder.setKlineStreaming(args.stream, args.websocketURL if args.websocketURL else config.getWebsocketURL(),
+                                 args.streamFlushIntervalInSec)
+    prioritySymbols: list[str] = [x.strip() for x in args.prioritySymbols.split(',')] if args.prioritySymbols else config.getPrioritySymbols()
+    mdRecorder.setTaskScheduling(prioritySymbols, args.maxRunningBackfills)
+    mdRecorder.setJsonDecoder(mdJsonDecoder(args.jsonBackend))
+    candleSchema: mdCandleSchema | None = createCandleSchema(header, config.getDataTypes())
+    if candleSchema is not None:
+        mdRecorder.setCandleSchema(candleSchema)
+    mdRecorder.setParquetOptions(mdParquetOptions(config.getParquetCompression(), config.getParquetCompressionLevel(),
+                                                  config.getParquetRowGroupSize(), config.getParquetDictionaryColumns(),
+                                                  config.getParquetDeltaColumns()))
+    mdRecorder.setHttpTransport(config.getHttpTransport(), config.getHttpPoolSize(), config.getHttpKeepAlive(),
+                                config.getHttpCompression(), config.getHttp2())
+    mdRecorder.setMaxRequestRetries(config.getMaxRequestRetries())
+    rateLimiterType: str | None = config.getRateLimiterType()
+    if rateLimiter is not None:
+        mdRecorder.setRateLimiter(rateLimiter)
+    elif rateLimiterType:
+        mdRecorder.setRateLimiter(createRateLimiter(rateLimiterType, exchangeName, maxAPIRequestsPerSec,
+                                                    config.getMaxRequestWeightPerMinute()))
+    mdRecorder.setShard(shardIndex, numShards)
+    mdRecorder.setProductCatalogTTL(args.productCatalogTTL)
+    mdRecorder.setStreamingFlush(args.flushEveryNCandles, args.flushEveryNMegabytes)
+    mdRecorder.setWriterPool(args.numWriterProcesses, args.maxPendingWrites)
+    mdRecorder.setMaxParallelWindows(args.maxParallelWindows if args.maxParallelWindows else 1)
+    if args.metricsFile:
+        mdRecorder.setMetricsExport(getMetricsFilename(args.metricsFile), getMetricsFormat(args),
+                                    args.metricsIntervalInSec)
     numThreads: int = args.numThreads if args.numThreads else 5
-    mdRecorder.startRecordingProcess(numThreads)
+    if args.daemon or args.stream:
+        mdRecorder.runDaemon(numThreads, args.closeDelayInSec)
+    else:
+        mdRecorder.startRecordingProcess(numThreads)
 
 
-if __name__ == "__main__":
-    logging.basicConfig(level=logging.INFO, format='[%(asctime)s] %(name)s %(levelname)s %(message)s',
+# Worker processes started by the supervisor each export to their own file, e.g. metrics.BINANCE-shard0.prom
+def getMetricsFilename(metricsFile: str) -> str:
+    processName: str = multiprocessing.current_process().name
+    if processName == 'MainProcess':
+        return metricsFile
+    root, extension = os.path.splitext(metricsFile)
+    return f'{root}.{processName}{extension}'
+
+
+def getMetricsFormat(args: argparse.Namespace) -> str:
+    if args.metricsFormat:
+        return args.metricsFormat
+    return metrics_consts.FORMAT_JSON if args.metricsFile.endswith('.json') else metrics_consts.FORMAT_PROMETHEUS
+
+
+def configureLogging(debug: bool = False, useQueue: bool = False) -> None:
+    logging.basicConfig(level=logging.INFO, format='[%(asctime)s] %(processName)s %(name)s %(levelname)s %(message)s',
                         datefmt='%Y-%m-%d %H:%M:%S')
     logging.Formatter(datefmt='%Y-%m-%d %H:%M:%S')
+    if debug:
+        logging.getLogger().setLevel(logging.DEBUG)
+    if useQueue:
+        enableQueueLogging()
+
+
+if __name__ == "__main__":
+    configureLogging()
     main()
@@ -0,0 +1,219 @@
+from typing import Callable
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+
+class consts:
+    INITIAL_CAPACITY = 1024
+    # Order in which a column is widened when a value doesn't fit its current dtype
+    DTYPE_PROMOTION_ORDER = [np.dtype(np.int64), np.dtype(np.float64), np.dtype(object)]
+
+
+# Preallocated, growable columnar storage for downloaded candles (one NumPy array per header column). Values are
+# parsed into int64/float64 columns as responses are appended (numeric strings such as Binance prices included), so
+# a long backfill no longer holds millions of boxed Python objects until writeToDisk is called.
+# Exchanges that page backwards in time create the buffer with descending=True; the DataFrame/Arrow conversions then
+# return the candles in the reverse of the order they were appended in (i.e. oldest first).
+# Recorders that know the layout of their exchange's candle arrays pass the column dtypes, which lets rows be
+# converted column by column straight into those dtypes (without inference or an intermediate object array).
+class mdCandleBuffer:
+    def __init__(self, header: list[str], capacity: int = consts.INITIAL_CAPACITY, descending: bool = False,
+                 dtypes: dict[str, np.dtype] | None = None):
+        self.header: list[str] = header
+        self.capacity: int = max(1, capacity)
+        self.descending: bool = descending
+        self.dtypes: list[np.dtype | None] | None = [np.dtype(dtypes[name]) if name in dtypes else None
+                                                     for name in header] if dtypes else None
+        self.size: int = 0
+        self.num_appended: int = 0  # total number of rows appended, including the ones cleared since
+        self.columns: list[np.ndarray] | None = None  # untyped columns are inferred from the first appended rows
+        self.num_string_bytes: int = 0  # characters of the strings held by object columns
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __iadd__(self, rows: list[list]):
+        self.append(rows)
+        return self
+
+    @staticmethod
+    def inferDtype(value) -> np.dtype:
+        if isinstance(value, bool):
+            return np.dtype(object)
+        if isinstance(value, (int, np.integer)):
+            return np.dtype(np.int64)
+        if isinstance(value, (float, np.floating)):
+            return np.dtype(np.float64)
+        if isinstance(value, str):
+            for dtype, parse in ((np.int64, int), (np.float64, float)):
+                try:
+                    parse(value)
+                    return np.dtype(dtype)
+                except ValueError:
+                    pass
+        return np.dtype(object)
+
+    # Converts a column of raw values to dtype, returning None if that would fail or lose information
+    @staticmethod
+    def convertColumn(values: np.ndarray, dtype: np.dtype) -> np.ndarray | None:
+        if dtype == object:
+            return values
+        try:
+            converted: np.ndarray = values.astype(dtype)
+            if dtype == np.int64 and not np.array_equal(values.astype(np.float64), converted):
+                return None  # e.g. 1.5 silently truncated to 1
+            return converted
+        except (ValueError, TypeError, OverflowError):
+            return None
+
+    # Fast path for columns with a known dtype. Returns None (and leaves it to convertColumn/promoteColumn) if the
+    # values don't fit, e.g. floats in an integer column.
+    @staticmethod
+    def convertTypedColumn(values: tuple, dtype: np.dtype) -> np.ndarray | None:
+        try:
+            if dtype != np.int64:
+                return np.array(values, dtype=dtype)
+            if isinstance(values[0], str):
+                return np.fromiter(map(int, values), dtype=np.int64, count=len(values))  # int('1.5') raises
+            converted: np.ndarray = np.array(values)
+            return converted.astype(np.int64, copy=False) if converted.dtype.kind in 'iu' else None
+        except (ValueError, TypeError, OverflowError):
+            return None
+
+    def promoteColumn(self, i: int, values: np.ndarray) -> np.ndarray:
+        dtype_index: int = consts.DTYPE_PROMOTION_ORDER.index(self.columns[i].dtype)
+        for dtype in consts.DTYPE_PROMOTION_ORDER[dtype_index + 1:]:
+            converted: np.ndarray | None = self.convertColumn(values, dtype)
+            if converted is not None:
+                self.columns[i] = self.columns[i].astype(dtype)
+                return converted
+        raise ValueError(f'Cannot store values of column:{self.header[i]}')
+
+    def reserve(self, capacity: int) -> None:
+        if capacity <= self.capacity:
+            return
+        self.capacity = max(capacity, 2 * self.capacity)
+        for i, column in enumerate(self.columns):
+            grown_column: np.ndarray = np.empty(self.capacity, dtype=column.dtype)
+            grown_column[:self.size] = column[:self.size]
+            self.columns[i] = grown_column
+
+    def append(self, rows: list[list]) -> None:
+        if len(rows) == 0:
+            return
+        if self.dtypes is not None:
+            self.appendTyped(rows)
+            return
+        raw: np.ndarray = np.array(rows, dtype=object).reshape(len(rows), len(self.header))
+        if self.columns is None:
+            self.columns = [np.empty(self.capacity, dtype=self.inferDtype(value)) for value in raw[0]]
+
+        self.reserve(self.size + len(rows))
+        for i in range(len(self.header)):
+            values: np.ndarray | None = self.convertColumn(raw[:, i], self.columns[i].dtype)
+            if values is None:
+                values = self.promoteColumn(i, raw[:, i])
+            self.columns[i][self.size:self.size + len(rows)] = values
+            if self.columns[i].dtype == object:
+                self.num_string_bytes += self.getNumStringBytes(values)
+        self.size += len(rows)
+        self.num_appended += len(rows)
+
+    def appendTyped(self, rows: list[list]) -> None:
+        raw_columns: list[tuple] = list(zip(*rows, strict=True))  # raises if the rows differ in length
+        if len(raw_columns) != len(self.header):
+            raise ValueError(f'Expected rows with {len(self.header)} values')
+        if self.columns is None:
+            self.columns = [np.empty(self.capacity, dtype=dtype if dtype is not None else self.inferDtype(values[0]))
+                            for dtype, values in zip(self.dtypes, raw_columns)]
+
+        self.reserve(self.size + len(rows))
+        for i, raw_column in enumerate(raw_columns):
+            values: np.ndarray | None = self.convertTypedColumn(raw_column, self.columns[i].dtype) \
+                if self.columns[i].dtype != object else None
+            if values is None:
+                raw: np.ndarray = np.empty(len(raw_column), dtype=object)
+                raw[:] = raw_column
+                values = self.convertColumn(raw, self.columns[i].dtype)
+                if values is None:
+                    values = self.promoteColumn(i, raw)
+            self.columns[i][self.size:self.size + len(rows)] = values
+            if self.columns[i].dtype == object:
+                self.num_string_bytes += self.getNumStringBytes(values)
+        self.size += len(rows)
+        self.num_appended += len(rows)
+
+    def getColumn(self, column_name: str) -> np.ndarray:
+        if self.columns is None:
+            return np.empty(0)
+        return self.columns[self.header.index(column_name)][:self.size]
+
+    @staticmethod
+    def getNumStringBytes(values: np.ndarray) -> int:
+        return sum(len(x) for x in values if isinstance(x, str))
+
+    # Object columns only hold pointers, so the length of their strings is added to the size of the arrays
+    def getNumBytes(self) -> int:
+        if self.columns is None:
+            return 0
+        return sum(column.itemsize * self.size for column in self.columns) + self.num_string_bytes
+
+    def getOrderedColumns(self) -> list[np.ndarray]:
+        if self.descending:
+            return [column[:self.size][::-1] for column in self.columns]
+        return [column[:self.size] for column in self.columns]
+
+    def clear(self) -> None:
+        self.size = 0
+        self.num_string_bytes = 0
+
+    def toDataFrame(self) -> pd.DataFrame:
+        if self.columns is None:
+            return pd.DataFrame([], columns=self.header)
+        return pd.DataFrame(dict(zip(self.header, self.getOrderedColumns())), copy=False)
+
+    def toArrowTable(self) -> pa.Table:
+        if self.columns is None:
+            return pa.table({name: pa.array([]) for name in self.header})
+        return pa.table({name: pa.array(column) for name, column in zip(self.header, self.getOrderedColumns())})
+
+
+class mdCandleFlushError(Exception):
+    pass
+
+
+# Candle buffer that hands its content to flush_callback (and starts over) whenever it holds more than max_candles
+# candles or max_bytes bytes, so that the memory used by a single backfill stays bounded. Once a flush has failed,
+# the buffer is cleared and every further append or flush raises mdCandleFlushError, which stops the download.
+class mdStreamingCandleBuffer(mdCandleBuffer):
+    def __init__(self, header: list[str], flush_callback: Callable[[mdCandleBuffer], bool], max_candles: int,
+                 max_bytes: int, descending: bool = False, dtypes: dict[str, np.dtype] | None = None):
+        mdCandleBuffer.__init__(self, header, min(max_candles, consts.INITIAL_CAPACITY) if max_candles > 0
+                                else consts.INITIAL_CAPACITY, descending, dtypes)
+        self.flush_callback: Callable[[mdCandleBuffer], bool] = flush_callback
+        self.max_candles: int = max_candles
+        self.max_bytes: int = max_bytes
+        self.num_flushes: int = 0
+        self.flush_failed: bool = False
+
+    def append(self, rows: list[list]) -> None:
+        if self.flush_failed:
+            raise mdCandleFlushError('a previous flush failed')
+        mdCandleBuffer.append(self, rows)
+        if (self.max_candles > 0 and self.size >= self.max_candles) or \
+                (self.max_bytes > 0 and self.getNumBytes() >= self.max_bytes):
+            self.flush()
+
+    def flush(self) -> None:
+        if self.flush_failed:
+            raise mdCandleFlushError('a previous flush failed')
+        if self.size == 0:
+            return
+        flushed: bool = self.flush_callback(self)
+        self.clear()
+        if not flushed:
+            self.flush_failed = True
+            raise mdCandleFlushError('flush callback failed')
+        self.num_flushes += 1
@@ -0,0 +1,146 @@
+import logging
+import re
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+
+class consts:
+    TYPE_INT64 = 'int64'
+    TYPE_FLOAT64 = 'float64'
+    TYPE_STRING = 'string'
+    DECIMAL_TYPE_PATTERN = re.compile(r'decimal\(\s*(\d+)\s*,\s*(\d+)\s*\)')
+    ENCODING_DELTA = 'DELTA_BINARY_PACKED'
+    DEFAULT_COMPRESSION = 'snappy'
+
+
+# Column types of an exchange's candles, declared in its config next to data_header (data_types). Candles are parsed
+# straight into these types (see mdCandleBuffer) and existing files are conformed to them when they are read, so new
+# and existing candles always have the same dtypes. Decimal columns are kept in memory as strings with exactly the
+# declared number of decimals (e.g. '0.10000000' for decimal(18, 8)), which are what the exchanges send, so that they
+# are stored as decimals without ever going through float64.
+class mdCandleSchema:
+    def __init__(self, header: list[str], types: list[str]):
+        if len(header) != len(types):
+            raise ValueError(f'Expected {len(header)} data types (one per data_header column), got {len(types)}')
+        self.header: list[str] = header
+        self.types: list[str] = types
+        self.arrow_schema: pa.Schema = pa.schema([(name, self.getArrowType(x)) for name, x in zip(header, types)])
+        self.dtypes: dict[str, np.dtype] = {name: self.getNumpyDtype(x) for name, x in zip(header, types)}
+        self.decimal_types: dict[str, pa.DataType] = {name: x.type for name, x in zip(header, self.arrow_schema)
+                                                      if pa.types.is_decimal(x.type)}
+
+    @staticmethod
+    def getArrowType(type_str: str) -> pa.DataType:
+        match type_str:
+            case consts.TYPE_INT64:
+                return pa.int64()
+            case consts.TYPE_FLOAT64:
+                return pa.float64()
+            case consts.TYPE_STRING:
+                return pa.string()
+        decimal_match: re.Match | None = consts.DECIMAL_TYPE_PATTERN.fullmatch(type_str)
+        if decimal_match is None:
+            raise ValueError(f'Unsupported data type:{type_str}')
+        return pa.decimal128(int(decimal_match.group(1)), int(decimal_match.group(2)))
+
+    @staticmethod
+    def getNumpyDtype(type_str: str) -> np.dtype:
+        match type_str:
+            case consts.TYPE_INT64:
+                return np.dtype(np.int64)
+            case consts.TYPE_FLOAT64:
+                return np.dtype(np.float64)
+        return np.dtype(object)  # strings and decimals
+
+    # Column dtypes for mdCandleBuffer
+    def getCandleDtypes(self) -> dict[str, np.dtype]:
+        return self.dtypes
+
+    # Converts candles to the in-memory dtypes of the schema. Needed for candles read from existing files (e.g. written
+    # before the schema was declared, with numbers stored as strings, or with decimal columns). Columns that already
+    # have the right dtype are left as they are, except decimal columns, which are always brought to the declared
+    # number of decimals (a vectorized round trip through the decimal type).
+    def conform(self, candles: pd.DataFrame) -> pd.DataFrame:
+        conversions: dict[str, np.dtype | type] = {}
+        decimal_columns: dict[str, pd.Series] = {}
+        for name, dtype in self.dtypes.items():
+            if name not in candles.columns:
+                continue
+            if name in self.decimal_types:
+                decimal_columns[name] = self.toDecimalStrings(candles[name], self.decimal_types[name])
+            elif dtype == object:
+                # string columns may hold numbers, depending on how they were parsed
+                if not pd.api.types.is_string_dtype(candles[name]):
+                    conversions[name] = str
+            elif candles[name].dtype != dtype:
+                conversions[name] = dtype
+        if len(conversions) > 0:
+            candles = candles.astype(conversions)
+        if len(decimal_columns) > 0:
+            candles = candles.assign(**decimal_columns)
+        return candles
+
+    # Raises ValueError if a value has more decimals than decimal_type or doesn't fit it
+    @staticmethod
+    def toDecimalStrings(values: pd.Series, decimal_type: pa.DataType) -> pd.Series:
+        strings: pa.Array = pa.array(values.astype(str), type=pa.string(), from_pandas=True)
+        try:
+            decimal_strings: pa.Array = strings.cast(decimal_type).cast(pa.string())
+        except pa.ArrowInvalid as e:
+            raise ValueError(f'Values of column:{values.name} don\'t fit {decimal_type} ({e})') from e
+        return pd.Series(decimal_strings.to_numpy(zero_copy_only=False), index=values.index, name=values.name,
+                         dtype=object)
+
+    # Decimal columns are cast from their strings (see conform), so no value goes through float64
+    def toArrowTable(self, candles: pd.DataFrame) -> pa.Table:
+        if list(candles.columns) != self.header:
+            if set(candles.columns) != set(self.header):
+                raise ValueError(f'Candles with columns:{list(candles.columns)} don\'t match the declared schema with '
+                                 f'columns:{self.header}')
+            candles = candles[self.header]
+        non_string_decimal_columns: dict[str, type] = {name: str for name in self.decimal_types
+                                                       if not pd.api.types.is_string_dtype(candles[name])}
+        if len(non_string_decimal_columns) > 0:
+            candles = candles.astype(non_string_decimal_columns)
+        return pa.Table.from_pandas(candles, preserve_index=False).cast(self.arrow_schema)
+
+
+# Compression and encoding settings used for every parquet file a recorder writes
+class mdParquetOptions:
+    def __init__(self, compression: str = consts.DEFAULT_COMPRESSION, compression_level: int | None = None,
+                 row_group_size: int | None = None, dictionary_columns: list[str] | None = None,
+                 delta_columns: list[str] | None = None):
+        self.compression: str = compression
+        self.compression_level: int | None = compression_level
+        self.row_group_size: int | None = row_group_size
+        self.dictionary_columns: list[str] | None = dictionary_columns  # None = pyarrow default (all columns)
+        self.delta_columns: list[str] = delta_columns or []  # int64 columns stored with DELTA_BINARY_PACKED
+
+    # Keyword arguments for pq.ParquetWriter (and pq.write_table)
+    def getWriterOptions(self, columns: list[str]) -> dict:
+        options: dict = {'compression': self.compression, 'compression_level': self.compression_level}
+        delta_columns: list[str] = [x for x in self.delta_columns if x in columns]
+        if self.dictionary_columns is not None or delta_columns:
+            dictionary_columns: list[str] = columns if self.dictionary_columns is None else self.dictionary_columns
+            # Columns with an explicit encoding can't be dictionary encoded
+            options['use_dictionary'] = [x for x in dictionary_columns if x in columns and x not in delta_columns]
+        if delta_columns:
+            options['column_encoding'] = {x: consts.ENCODING_DELTA for x in delta_columns}
+        return options
+
+    def writeTable(self, table: pa.Table, filename: str) -> None:
+        with pq.ParquetWriter(filename, table.schema, **self.getWriterOptions(table.schema.names)) as writer:
+            writer.write_table(table, row_group_size=self.row_group_size)
+
+
+def createCandleSchema(header: list[str], types: list[str] | None) -> mdCandleSchema | None:
+    if not types:
+        return None
+    try:
+        return mdCandleSchema(header, types)
+    except ValueError as e:
+        logging.error(f'Invalid data_types ({e}). Letting the column types be inferred instead.')
+        return None
@@ -0,0 +1,50 @@
+import json
+import logging
+from typing import Any, Callable
+
+
+class consts:
+    BACKEND_AUTO = 'auto'
+    BACKEND_ORJSON = 'orjson'
+    BACKEND_SIMDJSON = 'simdjson'
+    BACKEND_JSON = 'json'
+    FASTEST_BACKENDS_FIRST = [BACKEND_ORJSON, BACKEND_SIMDJSON, BACKEND_JSON]
+
+
+# Decodes response bodies with the fastest JSON library that is installed (orjson, then pysimdjson, then the standard
+# library). The fast libraries are optional; they are only imported when a decoder is created.
+class mdJsonDecoder:
+    def __init__(self, backend: str = consts.BACKEND_AUTO):
+        backends: list[str] = consts.FASTEST_BACKENDS_FIRST if backend == consts.BACKEND_AUTO else [backend]
+        self.backend: str = consts.BACKEND_JSON
+        self.loads: Callable[[bytes], Any] = json.loads
+        for candidate in backends:
+            loads: Callable[[bytes], Any] | None = self.importBackend(candidate)
+            if loads is not None:
+                self.backend, self.loads = candidate, loads
+                break
+        else:
+            logging.error(f'JSON backend:{backend} is not available. Using {self.backend} instead.')
+
+    @staticmethod
+    def importBackend(backend: str) -> Callable[[bytes], Any] | None:
+        try:
+            match backend:
+                case consts.BACKEND_ORJSON:
+                    import orjson
+                    return orjson.loads
+                case consts.BACKEND_SIMDJSON:
+                    import simdjson
+                    return simdjson.loads
+                case consts.BACKEND_JSON:
+                    return json.loads
+        except ImportError:
+            pass
+        return None
+
+    def decode(self, content: bytes) -> Any:
+        return self.loads(content)
+
+    # Takes anything with a content attribute (requests/httpx responses)
+    def decodeResponse(self, r) -> Any:
+        return self.loads(r.content)
@@ -0,0 +1,261 @@
+import asyncio
+import json
+import logging
+import threading
+import time
+import uuid
+from typing import Callable
+
+import aiohttp
+
+
+class consts:
+    MIN_RECONNECT_DELAY_IN_SEC = 1
+    MAX_RECONNECT_DELAY_IN_SEC = 60
+    HEARTBEAT_IN_SEC = 30  # websocket ping frames, for exchanges that don't send any themselves
+    BINANCE_MAX_STREAMS_PER_CONNECTION = 1024
+    BINANCE_MAX_STREAMS_PER_SUBSCRIBE = 200
+    BINANCE_SUBSCRIBE_INTERVAL_IN_SEC = 0.25  # Binance accepts at most 5 incoming messages per second
+    BINANCE_EVENT_KLINE = 'kline'
+    COINBASE_CHANNEL_CANDLES = 'candles'
+    COINBASE_CHANNEL_HEARTBEATS = 'heartbeats'
+    COINBASE_CANDLES_TIMEFRAME = '5m'  # the only granularity of the candles channel
+    COINBASE_MAX_PRODUCTS_PER_CONNECTION = 500
+    KUCOIN_MAX_TOPICS_PER_CONNECTION = 300
+    KUCOIN_MAX_SERIES_PER_SUBSCRIBE = 100
+    KUCOIN_SUCCESS_CODE = '200000'
+    KUCOIN_TOPIC_CANDLES = '/market/candles:'
+    KUCOIN_SUBJECT_CANDLES = 'trade.candles.update'
+
+
+# Subscribes to the kline/candle websocket streams of an exchange for every product/timeframe series and calls
+# on_closed_candle(product_id, timeframe, row) with each candle once it has closed, from the stream's own thread. Rows
+# have the layout of the exchange's REST candles, so that they can be written like downloaded ones. Exchanges that
+# don't flag closed candles are handled by treating a candle as closed once an update of the next one arrives.
+# Series are split across as many connections as the exchange's per connection limit requires. Every connection is
+# re-established (with exponential backoff) when it drops, and candles that were open at that point are dropped, so
+# that the recorder sees a gap and refetches them over REST instead of writing a candle with missed updates.
+class mdKlineStream:
+    max_series_per_connection: int = 0  # 0 = no limit
+
+    def __init__(self, websocket_url: str, product_ids: list[str], timeframes: list[str],
+                 on_closed_candle: Callable[[str, str, list], None]):
+        self.websocket_url: str = websocket_url
+        self.timeframes: list[str] = [x for x in timeframes if self.isSupportedTimeframe(x)]
+        self.series: list[tuple[str, str]] = [(product_id, timeframe) for product_id in product_ids
+                                              for timeframe in self.timeframes]
+        self.on_closed_candle: Callable[[str, str, list], None] = on_closed_candle
+        self.open_candles: dict[tuple[str, str], tuple[int, list]] = {}  # latest update of the candle in progress
+        self.loop: asyncio.AbstractEventLoop = asyncio.new_event_loop()
+        self.stop_event: asyncio.Event = asyncio.Event()
+        self.thread: threading.Thread | None = None
+
+    def isSupportedTimeframe(self, timeframe: str) -> bool:
+        return True
+
+    # Timeframes that are streamed (the others have to be polled over REST)
+    def getTimeframes(self) -> list[str]:
+        return self.timeframes
+
+    # Must return the URL to open a connection to (called again on every reconnect)
+    async def getConnectionURL(self, session: aiohttp.ClientSession) -> str:
+        return self.websocket_url
+
+    # Must return the messages subscribing a connection to series
+    def getSubscribeMessages(self, series: list[tuple[str, str]]) -> list[dict]:
+        raise NotImplementedError
+
+    # Must return the (product_id, timeframe, open time, row, closed or None if the exchange doesn't say) of every
+    # candle update in message. Other messages (acks, heartbeats...) return an empty list.
+    def parseMessage(self, message: dict) -> list[tuple[str, str, int, list, bool | None]]:
+        raise NotImplementedError
+
+    async def subscribe(self, ws: aiohttp.ClientWebSocketResponse, series: list[tuple[str, str]]) -> None:
+        for message in self.getSubscribeMessages(series):
+            await ws.send_json(message)
+
+    # Application level pings, for exchanges that require them on top of websocket ping frames
+    async def sendPings(self, ws: aiohttp.ClientWebSocketResponse) -> None:
+        pass
+
+    def start(self) -> None:
+        self.thread = threading.Thread(target=self.loop.run_until_complete, args=(self.run(),), name='klineStream',
+                                       daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        if self.thread is not None:
+            self.loop.call_soon_threadsafe(self.stop_event.set)
+            self.thread.join()
+        self.loop.close()
+
+    async def run(self) -> None:
+        max_series: int = self.max_series_per_connection or max(1, len(self.series))
+        async with aiohttp.ClientSession() as session:
+            tasks: list[asyncio.Task] = [asyncio.create_task(self.runConnection(session, self.series[i:i + max_series]))
+                                         for i in range(0, len(self.series), max_series)]
+            logging.info(f'Streaming {len(self.series)} series of timeframes:{",".join(self.timeframes)} over '
+                         f'{len(tasks)} websocket connections')
+            await self.stop_event.wait()
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        logging.info('Kline stream stopped')
+
+    async def runConnection(self, session: aiohttp.ClientSession, series: list[tuple[str, str]]) -> None:
+        reconnect_delay_in_sec: float = consts.MIN_RECONNECT_DELAY_IN_SEC
+        while True:
+            try:
+                url: str = await self.getConnectionURL(session)
+                async with session.ws_connect(url, heartbeat=consts.HEARTBEAT_IN_SEC) as ws:
+                    for key in series:
+                        self.open_candles.pop(key, None)
+                    await self.subscribe(ws, series)
+                    logging.info(f'Subscribed to {len(series)} kline streams on {url.split("?")[0]}')
+                    reconnect_delay_in_sec = consts.MIN_RECONNECT_DELAY_IN_SEC
+                    ping_task: asyncio.Task = asyncio.create_task(self.sendPings(ws))
+                    try:
+                        async for message in ws:
+                            if message.type == aiohttp.WSMsgType.TEXT:
+                                self.onMessage(message.data)
+                            elif message.type == aiohttp.WSMsgType.ERROR:
+                                break
+                    finally:
+                        ping_task.cancel()
+                logging.warning(f'Kline stream connection to {url.split("?")[0]} closed '
+                                f'(code:{ws.close_code}). Reconnecting in {reconnect_delay_in_sec}s')
+            except (aiohttp.ClientError, asyncio.TimeoutError, KeyError, ValueError, TypeError) as e:
+                logging.error(f'Caught exception "{e}" on kline stream connection. '
+                              f'Reconnecting in {reconnect_delay_in_sec}s')
+            await asyncio.sleep(reconnect_delay_in_sec)
+            reconnect_delay_in_sec = min(2 * reconnect_delay_in_sec, consts.MAX_RECONNECT_DELAY_IN_SEC)
+
+    def onMessage(self, data: str) -> None:
+        try:
+            updates: list[tuple[str, str, int, list, bool | None]] = self.parseMessage(json.loads(data))
+        except (KeyError, ValueError, TypeError, IndexError) as e:
+            logging.warning(f'Caught exception "{e}" while parsing kline stream message:{data[:200]}. Skipping...')
+            return
+        for product_id, timeframe, open_time, row, is_closed in updates:
+            if is_closed is not None:
+                if is_closed:
+                    self.on_closed_candle(product_id, timeframe, row)
+                continue
+            key: tuple[str, str] = (product_id, timeframe)
+            open_candle: tuple[int, list] | None = self.open_candles.get(key)
+            if open_candle is not None and open_time < open_candle[0]:
+                continue  # late update of a candle that has already been closed
+            if open_candle is not None and open_time > open_candle[0]:
+                self.on_closed_candle(product_id, timeframe, open_candle[1])
+            self.open_candles[key] = (open_time, row)
+
+
+# https://developers.binance.com/docs/binance-spot-api-docs/web-socket-streams (<symbol>@kline_<interval> streams)
+class binanceKlineStream(mdKlineStream):
+    max_series_per_connection = consts.BINANCE_MAX_STREAMS_PER_CONNECTION
+
+    def __init__(self, websocket_url: str, product_ids: list[str], timeframes: list[str],
+                 on_closed_candle: Callable[[str, str, list], None]):
+        mdKlineStream.__init__(self, websocket_url, product_ids, timeframes, on_closed_candle)
+        self.product_ids_by_symbol: dict[str, str] = {x.replace('-', ''): x for x in product_ids}
+
+    @staticmethod
+    def getStreamName(product_id: str, timeframe: str) -> str:
+        return f'{product_id.replace("-", "").lower()}@kline_{timeframe}'
+
+    def getSubscribeMessages(self, series: list[tuple[str, str]]) -> list[dict]:
+        stream_names: list[str] = [self.getStreamName(*x) for x in series]
+        return [{'method': 'SUBSCRIBE', 'params': stream_names[i:i + consts.BINANCE_MAX_STREAMS_PER_SUBSCRIBE],
+                 'id': i // consts.BINANCE_MAX_STREAMS_PER_SUBSCRIBE + 1}
+                for i in range(0, len(stream_names), consts.BINANCE_MAX_STREAMS_PER_SUBSCRIBE)]
+
+    async def subscribe(self, ws: aiohttp.ClientWebSocketResponse, series: list[tuple[str, str]]) -> None:
+        for message in self.getSubscribeMessages(series):
+            await ws.send_json(message)
+            await asyncio.sleep(consts.BINANCE_SUBSCRIBE_INTERVAL_IN_SEC)
+
+    def parseMessage(self, message: dict) -> list[tuple[str, str, int, list, bool | None]]:
+        data: dict | None = message.get('data')
+        if data is None or data.get('e') != consts.BINANCE_EVENT_KLINE:
+            return []
+        k: dict = data['k']
+        row: list = [k['t'], k['o'], k['h'], k['l'], k['c'], k['v'], k['T'], k['q'], k['n'], k['V'], k['Q'], k['B']]
+        return [(self.product_ids_by_symbol[data['s']], k['i'], k['t'], row, k['x'])]
+
+
+# https://docs.cdp.coinbase.com/advanced-trade/docs/ws-channels#candles-channel (5 minute candles only, updated every
+# second while they are open)
+class coinbaseKlineStream(mdKlineStream):
+    max_series_per_connection = consts.COINBASE_MAX_PRODUCTS_PER_CONNECTION
+
+    def isSupportedTimeframe(self, timeframe: str) -> bool:
+        return timeframe == consts.COINBASE_CANDLES_TIMEFRAME
+
+    def getSubscribeMessages(self, series: list[tuple[str, str]]) -> list[dict]:
+        product_ids: list[str] = [product_id for product_id, _ in series]
+        # The heartbeats channel keeps connections of products without trades from being closed
+        return [{'type': 'subscribe', 'product_ids': product_ids, 'channel': consts.COINBASE_CHANNEL_CANDLES},
+                {'type': 'subscribe', 'channel': consts.COINBASE_CHANNEL_HEARTBEATS}]
+
+    def parseMessage(self, message: dict) -> list[tuple[str, str, int, list, bool | None]]:
+        if message.get('channel') != consts.COINBASE_CHANNEL_CANDLES:
+            return []
+        updates: list[tuple[str, str, int, list, bool | None]] = []
+        for event in message['events']:
+            for candle in event.get('candles', []):
+                open_time: int = int(candle['start'])
+                row: list = [open_time, float(candle['low']), float(candle['high']), float(candle['open']),
+                             float(candle['close']), float(candle['volume'])]
+                updates.append((candle['product_id'], consts.COINBASE_CANDLES_TIMEFRAME, open_time, row, None))
+        return updates
+
+
+# https://www.kucoin.com/docs/websocket/spot-trading/public-channels/klines. Connections need a token from the REST
+# API (and the server to connect to comes with it, unless websocket_url is set) and a ping every pingInterval.
+class kucoinKlineStream(mdKlineStream):
+    max_series_per_connection = consts.KUCOIN_MAX_TOPICS_PER_CONNECTION
+
+    def __init__(self, websocket_url: str | None, api_url: str, product_ids: list[str], candle_types: dict[str, str],
+                 on_closed_candle: Callable[[str, str, list], None]):
+        mdKlineStream.__init__(self, websocket_url, product_ids, list(candle_types), on_closed_candle)
+        self.api_url: str = api_url
+        self.candle_types: dict[str, str] = candle_types
+        self.timeframes_by_candle_type: dict[str, str] = {value: key for key, value in candle_types.items()}
+        self.ping_interval_in_sec: float = consts.HEARTBEAT_IN_SEC
+
+    async def getConnectionURL(self, session: aiohttp.ClientSession) -> str:
+        async with session.post(self.api_url + 'api/v1/bullet-public') as r:
+            r_json: dict = await r.json(content_type=None)
+        if r_json.get('code') != consts.KUCOIN_SUCCESS_CODE:
+            raise ValueError(f'Could not get a websocket token: {r_json}')
+        server: dict = r_json['data']['instanceServers'][0]
+        self.ping_interval_in_sec = server['pingInterval'] / 1000
+        endpoint: str = self.websocket_url if self.websocket_url else server['endpoint']
+        return f'{endpoint}?token={r_json["data"]["token"]}&connectId={uuid.uuid4().hex}'
+
+    def getSubscribeMessages(self, series: list[tuple[str, str]]) -> list[dict]:
+        topics: list[str] = [f'{product_id}_{self.candle_types[timeframe]}' for product_id, timeframe in series]
+        return [{'id': str(uuid.uuid4().int), 'type': 'subscribe',
+                 'topic': consts.KUCOIN_TOPIC_CANDLES + ','.join(topics[i:i + consts.KUCOIN_MAX_SERIES_PER_SUBSCRIBE]),
+                 'privateChannel': False, 'response': True}
+                for i in range(0, len(topics), consts.KUCOIN_MAX_SERIES_PER_SUBSCRIBE)]
+
+    # Subscriptions are only accepted once the server has welcomed the connection
+    async def subscribe(self, ws: aiohttp.ClientWebSocketResponse, series: list[tuple[str, str]]) -> None:
+        welcome: dict = await ws.receive_json()
+        if welcome.get('type') != 'welcome':
+            raise ValueError(f'Expected a welcome message. Received:{welcome}')
+        await mdKlineStream.subscribe(self, ws, series)
+
+    async def sendPings(self, ws: aiohttp.ClientWebSocketResponse) -> None:
+        while not ws.closed:
+            await asyncio.sleep(self.ping_interval_in_sec)
+            await ws.send_json({'id': str(int(time.time() * 1000)), 'type': 'ping'})
+
+    def parseMessage(self, message: dict) -> list[tuple[str, str, int, list, bool | None]]:
+        if message.get('type') != 'message' or message.get('subject') != consts.KUCOIN_SUBJECT_CANDLES:
+            return []
+        data: dict = message['data']
+        candle_type: str = message['topic'].rsplit('_', 1)[1]
+        row: list = data['candles']
+        return [(data['symbol'], self.timeframes_by_candle_type[candle_type], int(row[0]), row, None)]
@@ -0,0 +1,125 @@
+import atexit
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+from datetime import datetime
+
+
+class consts:
+    LOG_MODE_VERBOSE = 'verbose'
+    LOG_MODE_SAMPLED = 'sampled'
+    DEFAULT_SAMPLE_INTERVAL_IN_SEC = 10
+    PAGE_MESSAGE = 'URL:%s NumCandlesReceived:%d EarliestTimestamp:%s (%s) LatestTimestamp:%s (%s)'
+    EMPTY_PAGE_MESSAGE = 'Received empty response. numEmptyResponses:%d'
+
+
+# Log argument that only converts its timestamp to a datetime if the record is emitted
+class lazyDatetime:
+    __slots__ = ('timestamp', 'timestamp_units_per_sec')
+
+    def __init__(self, timestamp: float, timestamp_units_per_sec: int = 1):
+        self.timestamp: float = timestamp
+        self.timestamp_units_per_sec: int = timestamp_units_per_sec
+
+    def __str__(self) -> str:
+        return str(datetime.fromtimestamp(self.timestamp / self.timestamp_units_per_sec))
+
+
+# Logs the pages received by one download task (see MDRecorderBase.createDownloadProgress). In verbose mode every page
+# is logged at INFO, as before. In sampled mode pages are only logged at DEBUG, a progress line is logged at most every
+# sample_interval_in_sec, and finish() logs one summary of the whole task. Messages are formatted lazily in both
+# modes, so pages that are not logged cost a counter update. Window threads of the same task may share the instance.
+class mdDownloadProgress:
+    def __init__(self, description: str, log_mode: str = consts.LOG_MODE_VERBOSE,
+                 sample_interval_in_sec: float = consts.DEFAULT_SAMPLE_INTERVAL_IN_SEC,
+                 timestamp_units_per_sec: int = 1):
+        self.description: str = description
+        self.sampled: bool = log_mode == consts.LOG_MODE_SAMPLED
+        self.sample_interval_in_sec: float = sample_interval_in_sec
+        self.timestamp_units_per_sec: int = timestamp_units_per_sec
+        self.lock: threading.Lock = threading.Lock()
+        self.start_time: float = time.monotonic()
+        self.last_log_time: float = self.start_time
+        self.num_pages: int = 0
+        self.num_empty_pages: int = 0
+        self.num_candles: int = 0
+        self.earliest_timestamp: float | None = None
+        self.latest_timestamp: float | None = None
+
+    def onPage(self, url: str, num_candles: int, earliest_timestamp: float, latest_timestamp: float) -> None:
+        with self.lock:
+            self.num_pages += 1
+            self.num_candles += num_candles
+            if self.earliest_timestamp is None or earliest_timestamp < self.earliest_timestamp:
+                self.earliest_timestamp = earliest_timestamp
+            if self.latest_timestamp is None or latest_timestamp > self.latest_timestamp:
+                self.latest_timestamp = latest_timestamp
+        level: int = logging.DEBUG if self.sampled else logging.INFO
+        logging.log(level, consts.PAGE_MESSAGE, url, num_candles,
+                    earliest_timestamp, lazyDatetime(earliest_timestamp, self.timestamp_units_per_sec),
+                    latest_timestamp, lazyDatetime(latest_timestamp, self.timestamp_units_per_sec))
+        if self.sampled:
+            self.logProgressIfDue()
+
+    def onEmptyPage(self, num_empty_responses: int) -> None:
+        with self.lock:
+            self.num_empty_pages += 1
+        logging.log(logging.DEBUG if self.sampled else logging.INFO, consts.EMPTY_PAGE_MESSAGE, num_empty_responses)
+
+    def logProgressIfDue(self) -> None:
+        now: float = time.monotonic()
+        with self.lock:
+            if now - self.last_log_time < self.sample_interval_in_sec:
+                return
+            self.last_log_time = now
+        logging.info('Downloading %s: %d candles in %d pages so far. LatestTimestamp:%s (%s)', self.description,
+                     self.num_candles, self.num_pages, self.latest_timestamp,
+                     lazyDatetime(self.latest_timestamp, self.timestamp_units_per_sec))
+
+    def finish(self) -> None:
+        if not self.sampled:
+            return
+        logging.info('Downloaded %s: %d candles in %d pages (%d empty) in %.2fs. EarliestTimestamp:%s (%s) '
+                     'LatestTimestamp:%s (%s)', self.description, self.num_candles, self.num_pages,
+                     self.num_empty_pages, time.monotonic() - self.start_time,
+                     self.earliest_timestamp, lazyDatetime(self.earliest_timestamp or 0, self.timestamp_units_per_sec),
+                     self.latest_timestamp, lazyDatetime(self.latest_timestamp or 0, self.timestamp_units_per_sec))
+
+
+# QueueHandler.prepare formats every record (message and traceback) on the logging thread. The records are only used
+# within this process, so they are enqueued as they are and the handlers of the listener thread format them.
+class unformattedQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+# Replaces the handlers of the root logger with a queue, so that logging threads only enqueue their records. A single
+# listener thread hands them to the original handlers, which format and write them there (and is flushed at exit).
+# Log arguments are formatted after the call returns, so they must not be changed afterwards.
+def enableQueueLogging() -> logging.handlers.QueueListener:
+    root_logger: logging.Logger = logging.getLogger()
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    listener: logging.handlers.QueueListener = logging.handlers.QueueListener(log_queue, *root_logger.handlers,
+                                                                              respect_handler_level=True)
+    queue_handler: logging.handlers.QueueHandler = unformattedQueueHandler(log_queue)
+    queue_handler.listener = listener  # as set by logging.config, so the original handlers can still be found
+    for handler in list(root_logger.handlers):
+        root_logger.removeHandler(handler)
+    root_logger.addHandler(queue_handler)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
+# Formatter of the (first) handler that records end up in, looking through a queue handler
+def getLogFormatter() -> logging.Formatter | None:
+    root_logger: logging.Logger = logging.getLogger()
+    if not root_logger.handlers:
+        return None
+    handler: logging.Handler = root_logger.handlers[0]
+    listener: logging.handlers.QueueListener | None = getattr(handler, 'listener', None)
+    if isinstance(handler, logging.handlers.QueueHandler) and listener is not None and listener.handlers:
+        handler = listener.handlers[0]
+    return handler.formatter
@@ -0,0 +1,246 @@
+import bisect
+import contextlib
+import json
+import logging
+import os
+import threading
+import time
+import urllib.parse
+from typing import Iterator
+
+
+class consts:
+    FORMAT_PROMETHEUS = 'prometheus'
+    FORMAT_JSON = 'json'
+    DURATION_BUCKETS_IN_SEC = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+    # Histograms
+    REQUEST_DURATION = 'md_request_duration_seconds'
+    RATE_LIMITER_WAIT = 'md_rate_limiter_wait_seconds'
+    WRITE_DURATION = 'md_write_duration_seconds'
+    MERGE_DURATION = 'md_merge_duration_seconds'
+    # Counters
+    REQUESTS = 'md_requests_total'
+    RESPONSE_BYTES = 'md_response_bytes_total'
+    CANDLES_RECEIVED = 'md_candles_received_total'
+    DOWNLOAD_SECONDS = 'md_download_seconds_total'
+    WRITE_SECONDS = 'md_write_seconds_total'
+    MERGE_SECONDS = 'md_merge_seconds_total'
+    DESCRIPTIONS = {
+        REQUEST_DURATION: 'Time from sending a request until its response was received',
+        RATE_LIMITER_WAIT: 'Time requests waited for the rate limiter before being sent',
+        WRITE_DURATION: 'Time taken to write downloaded candles to disk (including merges)',
+        MERGE_DURATION: 'Time taken to read, check and merge existing candles before a write',
+        REQUESTS: 'Number of responses (or transport errors) by status',
+        RESPONSE_BYTES: 'Response body bytes received',
+        CANDLES_RECEIVED: 'Number of candles downloaded',
+        DOWNLOAD_SECONDS: 'Time spent downloading (and, without writer processes, writing) a series',
+        WRITE_SECONDS: 'Time spent writing a series',
+        MERGE_SECONDS: 'Time spent merging a series with its existing file'
+    }
+    STATUS_TRANSPORT_ERROR = 'error'
+
+
+class mdHistogram:
+    def __init__(self, buckets: tuple[float, ...] = consts.DURATION_BUCKETS_IN_SEC):
+        self.buckets: tuple[float, ...] = buckets
+        self.bucket_counts: list[int] = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.count: int = 0
+        self.sum: float = 0
+
+    def observe(self, value: float) -> None:
+        self.bucket_counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def merge(self, other) -> None:
+        self.bucket_counts = [x + y for x, y in zip(self.bucket_counts, other.bucket_counts)]
+        self.count += other.count
+        self.sum += other.sum
+
+    # (upper bound, cumulative count) pairs, as exported by Prometheus
+    def getCumulativeBuckets(self) -> list[tuple[str, int]]:
+        bounds: list[str] = [f'{x:g}' for x in self.buckets] + ['+Inf']
+        cumulative_counts: list[int] = []
+        for bucket_count in self.bucket_counts:
+            cumulative_counts.append(bucket_count + (cumulative_counts[-1] if cumulative_counts else 0))
+        return list(zip(bounds, cumulative_counts))
+
+
+# In-process metrics of a recorder: histograms and counters keyed by metric name and labels (exchange, endpoint,
+# product, timeframe...). Everything is a no-op until enabled, so instrumented code doesn't have to check whether
+# metrics are being exported. Writer processes collect into their own instance and hand its state back to be merged.
+class mdMetrics:
+    def __init__(self, exchange_name: str, enabled: bool = False):
+        self.exchange_name: str = exchange_name
+        self.enabled: bool = enabled
+        self.start_time: float = time.time()
+        self.lock: threading.Lock = threading.Lock()
+        self.active_measurements: threading.local = threading.local()
+        self.histograms: dict[str, dict[tuple, mdHistogram]] = {}
+        self.counters: dict[str, dict[tuple, float]] = {}
+
+    def __getstate__(self) -> dict:
+        state: dict = self.__dict__.copy()
+        del state['lock']
+        del state['active_measurements']
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+        self.active_measurements = threading.local()
+
+    def getLabels(self, labels: dict) -> tuple:
+        return (('exchange', self.exchange_name),) + tuple((key, str(value)) for key, value in labels.items())
+
+    # Last path segment of a request URL (e.g. klines, candles, exchangeInfo), so that product IDs in paths don't
+    # create a new series per product
+    @staticmethod
+    def getEndpoint(url: str) -> str:
+        return urllib.parse.urlsplit(url).path.rstrip('/').rsplit('/', 1)[-1]
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        if not self.enabled:
+            return
+        with self.lock:
+            series: dict[tuple, mdHistogram] = self.histograms.setdefault(name, {})
+            key: tuple = self.getLabels(labels)
+            if key not in series:
+                series[key] = mdHistogram()
+            series[key].observe(value)
+
+    def increment(self, name: str, value: float = 1, **labels) -> None:
+        if not self.enabled:
+            return
+        with self.lock:
+            series: dict[tuple, float] = self.counters.setdefault(name, {})
+            key: tuple = self.getLabels(labels)
+            series[key] = series.get(key, 0) + value
+
+    # Requests for a series are also labelled by its product and timeframe, so that a slow or throttled series can be
+    # found (requests that aren't for a series, like the product catalog, only by endpoint)
+    def observeRequest(self, url: str, status: int | str, duration_in_sec: float, num_bytes: int,
+                       product: str | None = None, timeframe: str | None = None) -> None:
+        if not self.enabled:
+            return
+        labels: dict[str, str] = {'endpoint': self.getEndpoint(url)}
+        if product is not None:
+            labels['product'] = product
+        if timeframe is not None:
+            labels['timeframe'] = timeframe
+        self.observe(consts.REQUEST_DURATION, duration_in_sec, **labels)
+        self.increment(consts.REQUESTS, **labels, status=status)
+        self.increment(consts.RESPONSE_BYTES, num_bytes, **labels)
+
+    # Times the body of the with statement, into a histogram labelled by timeframe and/or a counter of the total time
+    # per product and timeframe. A measurement nested in another one of the same metrics in the same thread (e.g. a
+    # merge that falls back to a full rewrite) is ignored, so that its time isn't counted twice.
+    @contextlib.contextmanager
+    def measure(self, histogram_name: str | None, counter_name: str | None = None, product: str | None = None,
+                timeframe: str | None = None) -> Iterator[None]:
+        active_measurements: set = self.active_measurements.__dict__.setdefault('names', set())
+        if not self.enabled or (histogram_name, counter_name) in active_measurements:
+            yield
+            return
+        active_measurements.add((histogram_name, counter_name))
+        start_time: float = time.perf_counter()
+        try:
+            yield
+        finally:
+            active_measurements.discard((histogram_name, counter_name))
+            duration_in_sec: float = time.perf_counter() - start_time
+            if histogram_name is not None:
+                self.observe(histogram_name, duration_in_sec, timeframe=timeframe)
+            if counter_name is not None:
+                self.increment(counter_name, duration_in_sec, product=product, timeframe=timeframe)
+
+    def getState(self) -> tuple[dict, dict]:
+        with self.lock:
+            return self.histograms, self.counters
+
+    def merge(self, state: tuple[dict, dict]) -> None:
+        histograms, counters = state
+        with self.lock:
+            for name, series in histograms.items():
+                for key, histogram in series.items():
+                    self.histograms.setdefault(name, {}).setdefault(key, mdHistogram()).merge(histogram)
+            for name, series in counters.items():
+                for key, value in series.items():
+                    self.counters.setdefault(name, {})[key] = self.counters.get(name, {}).get(key, 0) + value
+
+    @staticmethod
+    def formatLabels(key: tuple, extra_labels: tuple = ()) -> str:
+        escape = lambda x: x.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in key + extra_labels) + '}'
+
+    def toPrometheusText(self) -> str:
+        lines: list[str] = []
+        with self.lock:
+            for name, series in sorted(self.histograms.items()):
+                lines += [f'# HELP {name} {consts.DESCRIPTIONS.get(name, name)}', f'# TYPE {name} histogram']
+                for key, histogram in series.items():
+                    lines += [f'{name}_bucket{self.formatLabels(key, (("le", bound),))} {count}'
+                              for bound, count in histogram.getCumulativeBuckets()]
+                    lines.append(f'{name}_sum{self.formatLabels(key)} {histogram.sum}')
+                    lines.append(f'{name}_count{self.formatLabels(key)} {histogram.count}')
+            for name, series in sorted(self.counters.items()):
+                lines += [f'# HELP {name} {consts.DESCRIPTIONS.get(name, name)}', f'# TYPE {name} counter']
+                lines += [f'{name}{self.formatLabels(key)} {value}' for key, value in series.items()]
+        return '\n'.join(lines) + '\n'
+
+    # Like the Prometheus text, plus the candles per second of the whole run and of every series
+    def toJSON(self) -> dict:
+        uptime_in_sec: float = time.time() - self.start_time
+        with self.lock:
+            histograms: dict = {name: [{'labels': dict(key), 'count': x.count, 'sum': x.sum,
+                                        'buckets': dict(x.getCumulativeBuckets())} for key, x in series.items()]
+                                for name, series in self.histograms.items()}
+            counters: dict = {name: [{'labels': dict(key), 'value': value} for key, value in series.items()]
+                              for name, series in self.counters.items()}
+            candles: dict[tuple, float] = self.counters.get(consts.CANDLES_RECEIVED, {})
+            download_seconds: dict[tuple, float] = self.counters.get(consts.DOWNLOAD_SECONDS, {})
+        num_candles: float = sum(candles.values())
+        series_throughput: list[dict] = [
+            {'labels': dict(key), 'candles': value, 'download_seconds': download_seconds.get(key, 0),
+             'candles_per_sec': value / download_seconds[key] if download_seconds.get(key) else None}
+            for key, value in candles.items()]
+        return {'exchange': self.exchange_name, 'uptime_sec': uptime_in_sec, 'candles': num_candles,
+                'candles_per_sec': num_candles / uptime_in_sec if uptime_in_sec > 0 else None,
+                'series': series_throughput, 'histograms': histograms, 'counters': counters}
+
+    # Writes to a temp file and renames it, so that scrapers never read a half written file
+    def export(self, filename: str, export_format: str) -> None:
+        content: str = json.dumps(self.toJSON(), indent=1) if export_format == consts.FORMAT_JSON \
+            else self.toPrometheusText()
+        temp_filename: str = f'{filename}.{os.getpid()}.tmp'
+        try:
+            with open(temp_filename, 'w') as f:
+                f.write(content)
+            os.replace(temp_filename, filename)
+        except OSError as e:
+            logging.error(f'Could not write metrics file:{filename} ({e})')
+
+
+# Exports the metrics every interval_in_sec from a background thread (if interval_in_sec > 0) and once more on stop()
+class mdMetricsExporter:
+    def __init__(self, metrics: mdMetrics, filename: str, export_format: str, interval_in_sec: float):
+        self.metrics: mdMetrics = metrics
+        self.filename: str = filename
+        self.export_format: str = export_format
+        self.interval_in_sec: float = interval_in_sec
+        self.stop_event: threading.Event = threading.Event()
+        self.thread: threading.Thread | None = None
+        if interval_in_sec > 0:
+            self.thread = threading.Thread(target=self.run, name='metricsExporter', daemon=True)
+            self.thread.start()
+
+    def run(self) -> None:
+        while not self.stop_event.wait(self.interval_in_sec):
+            self.metrics.export(self.filename, self.export_format)
+
+    def stop(self) -> None:
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.metrics.export(self.filename, self.export_format)
+        logging.info(f'Wrote metrics to {self.filename}')
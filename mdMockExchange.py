@@ -0,0 +1,414 @@
+import asyncio
+import http.server
+import json
+import logging
+import math
+import multiprocessing
+import signal
+import socket
+import threading
+import time
+import urllib.parse
+
+import numpy as np
+
+from binanceMDRecorder import binanceMDRecorder
+from kucoinMDRecorder import kucoinMDRecorder
+
+
+class consts:
+    HOST = '127.0.0.1'
+    NUM_STAT_FIELDS = 4
+    STAT_NUM_REQUESTS = 0
+    STAT_NUM_CANDLES = 1
+    STAT_NUM_RATE_LIMITED = 2
+    STAT_NUM_BYTES = 3
+    FUNDING_RATE_INTERVAL_IN_MS = 8 * 60 * 60 * 1000
+    COINBASE_MAX_CANDLES = 300
+    KUCOIN_MAX_CANDLES = 1500
+    BINANCE_QUOTA_WINDOW_IN_SEC = 60
+    KUCOIN_QUOTA_WINDOW_IN_SEC = 30
+    KUCOIN_SUCCESS_CODE = '200000'
+    KUCOIN_PING_INTERVAL_IN_MS = 18000
+    COINBASE_CANDLES_GRANULARITY = 300
+    KLINE_STREAM_UPDATE_INTERVAL_IN_SEC = 1
+
+
+# Local stand-in for the exchange REST endpoints used by the recorders (Binance klines/exchangeInfo, Binance futures
+# fundingRate/exchangeInfo, Coinbase products and candles, KuCoin symbols and candles). Every product has candles
+# from history_in_sec ago until now, generated on the fly. latency_in_sec is added to every response, and with
+# max_requests_per_sec > 0 requests over that rate are rejected with 429 and a Retry-After header. The rate limit
+# headers that the adaptive rate limiters read (see mdRateLimiter) are sent as well.
+# With kline_streams, the kline websocket streams (see mdKlineStream) are served as well, with the same candles.
+class mdMockExchange:
+    def __init__(self, exchange_name: str, num_products: int, quote_currency: str, history_in_sec: int,
+                 latency_in_sec: float = 0, max_requests_per_sec: int = 0, kline_streams: bool = False):
+        self.exchange_name: str = exchange_name
+        self.base_currencies: list[str] = [f'COIN{i:04d}' for i in range(num_products)]
+        self.quote_currency: str = quote_currency
+        self.history_in_sec: int = history_in_sec
+        self.latency_in_sec: float = latency_in_sec
+        self.max_requests_per_sec: int = max_requests_per_sec
+        self.kline_streams: bool = kline_streams
+        self.websocket_port: int | None = None
+        self.start_time: float = time.time()
+        self.kucoin_seconds_by_candle_type: dict[str, int] = {
+            kucoinMDRecorder.getCandleTypeFromTimeframeStr(x): kucoinMDRecorder.getNumSecondsFromTimeframeStr(x)
+            for x in ['1m', '3m', '5m', '15m', '30m', '1h', '2h', '4h', '6h', '8h', '12h', '1d', '1w']}
+        self.quota_window_in_sec: int = consts.KUCOIN_QUOTA_WINDOW_IN_SEC if exchange_name == 'KUCOIN' else \
+            consts.BINANCE_QUOTA_WINDOW_IN_SEC
+        self.second_start: int = 0  # start of the current one second rate limit window
+        self.num_requests_in_second: int = 0
+        self.quota_window_start: int = 0  # start of the window that the rate limit headers report on
+        self.num_requests_in_quota_window: int = 0
+        self.lock: threading.Lock | None = None  # the following are set in the server process by serve()
+        self.stats = None
+
+    # Open times in [start, end] (in the unit of interval) of the candles that exist, oldest first
+    def getCandleTimes(self, start: int, end: int, interval: int, limit: int, unit_per_sec: int) -> np.ndarray:
+        listing_time: int = int((self.start_time - self.history_in_sec) * unit_per_sec)
+        latest_time: int = int(time.time() * unit_per_sec) // interval * interval
+        first: int = math.ceil(max(start, listing_time) / interval) * interval
+        last: int = min(end, latest_time)
+        if first > last:
+            return np.empty(0, dtype=np.int64)
+        if limit <= 0:
+            return np.arange(first, last + 1, interval, dtype=np.int64)
+        return np.arange(first, min(last, first + (limit - 1) * interval) + 1, interval, dtype=np.int64)
+
+    # Like getCandleTimes, but the latest candles (as returned by requests that only set an end time)
+    def getLatestCandleTimes(self, end: int, interval: int, limit: int, unit_per_sec: int) -> np.ndarray:
+        return self.getCandleTimes(end - (limit - 1) * interval, end, interval, 0, unit_per_sec)
+
+    @staticmethod
+    def getPrices(times: np.ndarray) -> np.ndarray:
+        return 100 + 10 * np.sin(times.astype(np.float64) / 1e7)
+
+    def getPrice(self, open_time: int) -> float:
+        return float(self.getPrices(np.array([open_time]))[0])
+
+    def getProducts(self) -> object:
+        match self.exchange_name:
+            case 'BINANCE':
+                return {'symbols': [{'symbol': base + self.quote_currency, 'baseAsset': base,
+                                     'quoteAsset': self.quote_currency, 'status': 'TRADING'}
+                                    for base in self.base_currencies]}
+            case 'BINANCEFR':
+                return {'symbols': [{'symbol': base + self.quote_currency, 'baseAsset': base,
+                                     'quoteAsset': self.quote_currency, 'status': 'TRADING',
+                                     'contractType': 'PERPETUAL'} for base in self.base_currencies]}
+            case 'COINBASE':
+                return [{'id': f'{base}-{self.quote_currency}', 'base_currency': base,
+                         'quote_currency': self.quote_currency, 'status': 'online'} for base in self.base_currencies]
+            case 'KUCOIN':
+                return {'code': consts.KUCOIN_SUCCESS_CODE,
+                        'data': [{'symbol': f'{base}-{self.quote_currency}', 'baseCurrency': base,
+                                  'quoteCurrency': self.quote_currency, 'enableTrading': True}
+                                 for base in self.base_currencies]}
+        raise ValueError(f'Exchange:{self.exchange_name} is not supported by the mock exchange')
+
+    def getBinanceKlines(self, params: dict[str, str]) -> list[list]:
+        if not binanceMDRecorder.validateTimeframeStr(params['interval']):
+            raise ValueError(f'Invalid interval:{params["interval"]}')
+        interval: int = binanceMDRecorder.getNumMillisecondsFromTimeframeStr(params['interval'])
+        limit: int = int(params.get('limit', 500))
+        times: np.ndarray = self.getCandleTimes(int(params.get('startTime', 0)),
+                                                int(params.get('endTime', time.time() * 1000)), interval, limit, 1000)
+        prices: np.ndarray = self.getPrices(times)
+        return [self.getBinanceKline(t, p, interval) for t, p in zip(times.tolist(), prices.tolist())]
+
+    @staticmethod
+    def getBinanceKline(open_time: int, price: float, interval: int) -> list:
+        return [open_time, f'{price:.8f}', f'{price + 1:.8f}', f'{price - 1:.8f}', f'{price:.8f}', '1000.00000000',
+                open_time + interval - 1, f'{1000 * price:.8f}', 100, '500.00000000', f'{500 * price:.8f}', '0']
+
+    def getBinanceFundingRates(self, params: dict[str, str]) -> list[dict]:
+        limit: int = int(params.get('limit', 100))
+        end: int = int(params.get('endTime', time.time() * 1000))
+        if 'startTime' in params:
+            times: np.ndarray = self.getCandleTimes(int(params['startTime']), end,
+                                                    consts.FUNDING_RATE_INTERVAL_IN_MS, limit, 1000)
+        else:
+            times = self.getLatestCandleTimes(end, consts.FUNDING_RATE_INTERVAL_IN_MS, limit, 1000)
+        return [{'symbol': params['symbol'], 'fundingTime': t, 'fundingRate': f'{p / 1e6:.8f}'}
+                for t, p in zip(times.tolist(), self.getPrices(times).tolist())]
+
+    def getCoinbaseCandles(self, params: dict[str, str]) -> list[list]:
+        granularity: int = int(params['granularity'])
+        if 'start' in params:
+            times: np.ndarray = self.getCandleTimes(int(params['start']), int(params['end']), granularity,
+                                                    consts.COINBASE_MAX_CANDLES, 1)
+        else:
+            times = self.getLatestCandleTimes(int(time.time()), granularity, consts.COINBASE_MAX_CANDLES, 1)
+        times = times[::-1]  # newest first
+        return [self.getCoinbaseCandle(t, p) for t, p in zip(times.tolist(), self.getPrices(times).tolist())]
+
+    @staticmethod
+    def getCoinbaseCandle(open_time: int, price: float) -> list:
+        return [open_time, price - 1, price + 1, price, price, 1000.0]
+
+    def getKucoinCandles(self, params: dict[str, str]) -> dict:
+        interval: int = self.kucoin_seconds_by_candle_type[params['type']]
+        if 'startAt' in params:
+            times: np.ndarray = self.getCandleTimes(int(params['startAt']), int(params['endAt']) - 1, interval,
+                                                    0, 1)[-consts.KUCOIN_MAX_CANDLES:]
+        else:
+            times = self.getLatestCandleTimes(int(time.time()), interval, consts.KUCOIN_MAX_CANDLES, 1)
+        times = times[::-1]  # newest first
+        return {'code': consts.KUCOIN_SUCCESS_CODE,
+                'data': [self.getKucoinCandle(t, p) for t, p in zip(times.tolist(), self.getPrices(times).tolist())]}
+
+    @staticmethod
+    def getKucoinCandle(open_time: int, price: float) -> list[str]:
+        return [str(open_time), f'{price:.8f}', f'{price:.8f}', f'{price + 1:.8f}', f'{price - 1:.8f}', '1000',
+                f'{1000 * price:.8f}']
+
+    def getKucoinWebsocketToken(self) -> dict:
+        return {'code': consts.KUCOIN_SUCCESS_CODE,
+                'data': {'token': 'mock', 'instanceServers': [
+                    {'endpoint': f'ws://{consts.HOST}:{self.websocket_port}/', 'protocol': 'websocket',
+                     'encrypt': False, 'pingInterval': consts.KUCOIN_PING_INTERVAL_IN_MS}]}}
+
+    # Returns (status, body, number of candles in body)
+    def route(self, path: str, params: dict[str, str]) -> tuple[int, object, int]:
+        if path.endswith('exchangeInfo') or path.endswith('api/v2/symbols') or \
+                (self.exchange_name == 'COINBASE' and path.endswith('/products')):
+            return 200, self.getProducts(), 0
+        if path.endswith('klines'):
+            candles: object = self.getBinanceKlines(params)
+            return 200, candles, len(candles)
+        if path.endswith('fundingRate'):
+            candles = self.getBinanceFundingRates(params)
+            return 200, candles, len(candles)
+        if path.endswith('api/v1/bullet-public') and self.websocket_port is not None:
+            return 200, self.getKucoinWebsocketToken(), 0
+        if path.endswith('api/v1/market/candles'):
+            candles = self.getKucoinCandles(params)
+            return 200, candles, len(candles['data'])
+        if self.exchange_name == 'COINBASE' and path.endswith('/candles'):
+            candles = self.getCoinbaseCandles(params)
+            return 200, candles, len(candles)
+        return 404, {'msg': f'Unknown endpoint:{path}'}, 0
+
+    # Returns (rate limited, rate limit headers) for a request arriving now
+    def countRequest(self) -> tuple[bool, dict[str, str]]:
+        now: float = time.time()
+        quota_window_start: int = int(now // self.quota_window_in_sec)
+        with self.lock:
+            if int(now) != self.second_start:
+                self.second_start, self.num_requests_in_second = int(now), 0
+            if quota_window_start != self.quota_window_start:
+                self.quota_window_start, self.num_requests_in_quota_window = quota_window_start, 0
+            self.num_requests_in_second += 1
+            self.num_requests_in_quota_window += 1
+            num_requests_in_second: int = self.num_requests_in_second
+            num_requests_in_quota_window: int = self.num_requests_in_quota_window
+
+        headers: dict[str, str] = {}
+        if self.exchange_name in ('BINANCE', 'BINANCEFR'):
+            headers['X-MBX-USED-WEIGHT-1M'] = str(num_requests_in_quota_window)
+        elif self.exchange_name == 'KUCOIN' and self.max_requests_per_sec > 0:
+            quota: int = self.max_requests_per_sec * self.quota_window_in_sec
+            headers['gw-ratelimit-limit'] = str(quota)
+            headers['gw-ratelimit-remaining'] = str(max(0, quota - num_requests_in_quota_window))
+            headers['gw-ratelimit-reset'] = str(int((self.quota_window_in_sec - now % self.quota_window_in_sec) * 1000))
+        rate_limited: bool = 0 < self.max_requests_per_sec < num_requests_in_second
+        if rate_limited:
+            headers['Retry-After'] = '1'
+        return rate_limited, headers
+
+    def addStats(self, num_candles: int, rate_limited: bool, num_bytes: int) -> None:
+        with self.stats.get_lock():
+            self.stats[consts.STAT_NUM_REQUESTS] += 1
+            self.stats[consts.STAT_NUM_CANDLES] += num_candles
+            self.stats[consts.STAT_NUM_RATE_LIMITED] += int(rate_limited)
+            self.stats[consts.STAT_NUM_BYTES] += num_bytes
+
+    def createRequestHandlerClass(self) -> type:
+        exchange: mdMockExchange = self
+
+        class requestHandler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'  # keep-alive, like the real exchanges
+
+            def do_GET(self) -> None:
+                url: urllib.parse.SplitResult = urllib.parse.urlsplit(self.path)
+                params: dict[str, str] = dict(urllib.parse.parse_qsl(url.query))
+                if exchange.latency_in_sec > 0:
+                    time.sleep(exchange.latency_in_sec)
+                rate_limited, headers = exchange.countRequest()
+                num_candles: int = 0
+                if rate_limited:
+                    status, body = 429, {'code': -1003, 'msg': 'Too many requests'}
+                else:
+                    try:
+                        status, body, num_candles = exchange.route(url.path, params)
+                    except (KeyError, ValueError) as e:
+                        status, body = 400, {'msg': f'Bad request ({e})'}
+                content: bytes = json.dumps(body, separators=(',', ':')).encode()
+                exchange.addStats(num_candles, rate_limited, len(content))
+
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(content)))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(content)
+
+            do_POST = do_GET  # KuCoin's websocket token
+
+            def log_message(self, format: str, *args) -> None:
+                pass
+
+        return requestHandler
+
+    # Serves until the process is terminated. The bound ports (HTTP, websocket or None) are put on port_queue.
+    def serve(self, stats, port_queue: multiprocessing.Queue) -> None:
+        signal.signal(signal.SIGINT, signal.SIG_IGN)  # stopped by mdMockExchangeServer, not by Ctrl+C
+        self.lock = threading.Lock()
+        self.stats = stats
+        if self.kline_streams:
+            self.websocket_port = self.serveKlineStreams()
+        server: http.server.ThreadingHTTPServer = http.server.ThreadingHTTPServer((consts.HOST, 0),
+                                                                                  self.createRequestHandlerClass())
+        server.daemon_threads = True
+        port_queue.put((server.server_address[1], self.websocket_port))
+        server.serve_forever()
+
+    # Starts the websocket server on an event loop of its own thread and returns its port
+    def serveKlineStreams(self) -> int:
+        # Imported here so that aiohttp is only required when kline streams are served
+        from aiohttp import web
+        loop: asyncio.AbstractEventLoop = asyncio.new_event_loop()
+        app: web.Application = web.Application()
+        app.router.add_get('/{path:.*}', self.handleKlineStreamConnection)
+        runner: web.AppRunner = web.AppRunner(app, access_log=None)
+        loop.run_until_complete(runner.setup())
+        sock: socket.socket = socket.socket()
+        sock.bind((consts.HOST, 0))
+        loop.run_until_complete(web.SockSite(runner, sock).start())
+        threading.Thread(target=loop.run_forever, name='mockKlineStreams', daemon=True).start()
+        return sock.getsockname()[1]
+
+    async def handleKlineStreamConnection(self, request):
+        from aiohttp import web, WSMsgType
+        ws: web.WebSocketResponse = web.WebSocketResponse()
+        await ws.prepare(request)
+        subscriptions: dict[str, tuple[str, str, int]] = {}  # stream name -> (product, interval name, interval)
+        if self.exchange_name == 'KUCOIN':
+            await ws.send_json({'id': request.query.get('connectId'), 'type': 'welcome'})
+        sender: asyncio.Task = asyncio.create_task(self.sendKlineUpdates(ws, subscriptions))
+        try:
+            async for message in ws:
+                if message.type == WSMsgType.TEXT:
+                    reply: dict | None = self.onKlineStreamMessage(json.loads(message.data), subscriptions)
+                    if reply is not None:
+                        await ws.send_json(reply)
+        finally:
+            sender.cancel()
+        return ws
+
+    # Adds the subscriptions of a message and returns the reply to send, if any
+    def onKlineStreamMessage(self, message: dict, subscriptions: dict[str, tuple[str, str, int]]) -> dict | None:
+        match self.exchange_name:
+            case 'BINANCE':
+                for stream_name in message.get('params', []):
+                    symbol, interval_name = stream_name.split('@kline_')
+                    subscriptions[stream_name] = (symbol.upper(), interval_name,
+                                                  binanceMDRecorder.getNumMillisecondsFromTimeframeStr(interval_name))
+                return {'result': None, 'id': message.get('id')}
+            case 'COINBASE':
+                if message.get('channel') == 'candles':
+                    for product_id in message['product_ids']:
+                        subscriptions[product_id] = (product_id, 'FIVE_MINUTE', consts.COINBASE_CANDLES_GRANULARITY)
+                return None
+            case 'KUCOIN':
+                if message.get('type') == 'ping':
+                    return {'id': message.get('id'), 'type': 'pong'}
+                for topic in message['topic'].split(':', 1)[1].split(','):
+                    product_id, candle_type = topic.rsplit('_', 1)
+                    subscriptions[topic] = (product_id, candle_type, self.kucoin_seconds_by_candle_type[candle_type])
+                return {'id': message.get('id'), 'type': 'ack'} if message.get('response') else None
+        return None
+
+    # Sends the open candle of every subscription every KLINE_STREAM_UPDATE_INTERVAL_IN_SEC, like the exchanges do
+    # while candles are being traded. Binance also flags each candle as closed once the next one has started.
+    async def sendKlineUpdates(self, ws, subscriptions: dict[str, tuple[str, str, int]]) -> None:
+        unit_per_sec: int = 1000 if self.exchange_name == 'BINANCE' else 1
+        last_open_times: dict[str, int] = {}
+        while not ws.closed:
+            now: float = time.time()
+            messages: list[dict] = []
+            coinbase_candles: list[dict] = []
+            for stream_name, (product_id, interval_name, interval) in list(subscriptions.items()):
+                open_time: int = int(now * unit_per_sec) // interval * interval
+                match self.exchange_name:
+                    case 'BINANCE':
+                        last_open_time: int | None = last_open_times.get(stream_name)
+                        if last_open_time is not None and last_open_time < open_time:
+                            messages.append(self.getBinanceKlineMessage(stream_name, product_id, interval_name,
+                                                                        interval, last_open_time, True))
+                        messages.append(self.getBinanceKlineMessage(stream_name, product_id, interval_name, interval,
+                                                                    open_time, False))
+                    case 'COINBASE':
+                        row: list = self.getCoinbaseCandle(open_time, self.getPrice(open_time))
+                        coinbase_candles.append({'start': str(row[0]), 'low': str(row[1]), 'high': str(row[2]),
+                                                 'open': str(row[3]), 'close': str(row[4]), 'volume': str(row[5]),
+                                                 'product_id': product_id})
+                    case 'KUCOIN':
+                        messages.append({'type': 'message', 'topic': f'/market/candles:{stream_name}',
+                                         'subject': 'trade.candles.update',
+                                         'data': {'symbol': product_id, 'time': time.time_ns(),
+                                                  'candles': self.getKucoinCandle(open_time,
+                                                                                  self.getPrice(open_time))}})
+                last_open_times[stream_name] = open_time
+            if coinbase_candles:
+                messages.append({'channel': 'candles', 'events': [{'type': 'update', 'candles': coinbase_candles}]})
+            for message in messages:
+                await ws.send_json(message)
+            await asyncio.sleep(consts.KLINE_STREAM_UPDATE_INTERVAL_IN_SEC)
+
+    def getBinanceKlineMessage(self, stream_name: str, symbol: str, interval_name: str, interval: int,
+                               open_time: int, is_closed: bool) -> dict:
+        row: list = self.getBinanceKline(open_time, self.getPrice(open_time), interval)
+        return {'stream': stream_name,
+                'data': {'e': 'kline', 'E': int(time.time() * 1000), 's': symbol,
+                         'k': {'t': row[0], 'T': row[6], 's': symbol, 'i': interval_name, 'o': row[1], 'c': row[4],
+                               'h': row[2], 'l': row[3], 'v': row[5], 'n': row[8], 'x': is_closed, 'q': row[7],
+                               'V': row[9], 'Q': row[10], 'B': row[11]}}}
+
+
+# Runs a mock exchange in its own process (so that it doesn't compete with the recorder for the GIL). stop() must be
+# called once the benchmark is done.
+class mdMockExchangeServer:
+    def __init__(self, exchange: mdMockExchange):
+        self.stats = multiprocessing.Array('q', consts.NUM_STAT_FIELDS)
+        port_queue: multiprocessing.Queue = multiprocessing.Queue()
+        self.process: multiprocessing.Process = multiprocessing.Process(target=exchange.serve,
+                                                                        args=(self.stats, port_queue),
+                                                                        name='mockExchange', daemon=True)
+        self.process.start()
+        ports: tuple[int, int | None] = port_queue.get()
+        self.port: int = ports[0]
+        self.websocket_port: int | None = ports[1]
+        logging.info(f'Mock exchange:{exchange.exchange_name} listening on {consts.HOST}:{self.port}'
+                     + (f' (kline streams on port {self.websocket_port})' if self.websocket_port is not None else ''))
+
+    # Base URL of the mock exchange with the path of api_url, e.g. https://api.binance.com/api/v3/ ->
+    # http://127.0.0.1:port/api/v3/
+    def getAPIURL(self, api_url: str) -> str:
+        return f'http://{consts.HOST}:{self.port}{urllib.parse.urlsplit(api_url).path}'
+
+    def getWebsocketURL(self) -> str:
+        return f'ws://{consts.HOST}:{self.websocket_port}/'
+
+    def getStats(self) -> dict[str, int]:
+        with self.stats.get_lock():
+            return {'num_requests': self.stats[consts.STAT_NUM_REQUESTS],
+                    'num_candles': self.stats[consts.STAT_NUM_CANDLES],
+                    'num_rate_limited': self.stats[consts.STAT_NUM_RATE_LIMITED],
+                    'num_bytes': self.stats[consts.STAT_NUM_BYTES]}
+
+    def stop(self) -> None:
+        self.process.terminate()
+        self.process.join()
@@ -0,0 +1,99 @@
+import json
+import logging
+import os
+import time
+
+
+class consts:
+    KEY_PRODUCTS = 'products'
+    KEY_FETCH_TIME = 'fetch_time'
+    KEY_PRODUCTID = 'product_id'
+    KEY_BASECURRENCY = 'base_currency'
+    KEY_QUOTECURRENCY = 'quote_currency'
+    KEY_STATUS = 'status'
+    KEY_IS_DELISTED = 'is_delisted'
+    KEY_IS_RECORDABLE = 'is_recordable'  # False for products a recorder never downloads (e.g. ETFs, non-perpetuals)
+
+
+# Parsed exchange info (one entry per symbol returned by the exchange) with indexed lookups by base currency, quote
+# currency and status. Recorders build it once per run from a single exchange info request, and it can be persisted
+# so that runs within the TTL don't need to send that request at all.
+class mdProductCatalog:
+    def __init__(self, products: list[dict], fetch_time: float | None = None):
+        self.products: list[dict] = products
+        self.fetch_time: float = time.time() if fetch_time is None else fetch_time
+
+        self.products_by_id: dict[str, dict] = {}
+        self.product_ids_by_base_currency: dict[str, set[str]] = {}
+        self.product_ids_by_quote_currency: dict[str, set[str]] = {}
+        self.product_ids_by_status: dict[str, set[str]] = {}
+        self.recordable_product_ids: list[str] = []
+        self.delisted_product_ids: list[str] = []
+        for product in products:
+            product_id: str = product[consts.KEY_PRODUCTID]
+            self.products_by_id[product_id] = product
+            self.product_ids_by_base_currency.setdefault(product[consts.KEY_BASECURRENCY], set()).add(product_id)
+            self.product_ids_by_quote_currency.setdefault(product[consts.KEY_QUOTECURRENCY], set()).add(product_id)
+            self.product_ids_by_status.setdefault(str(product[consts.KEY_STATUS]), set()).add(product_id)
+            if product[consts.KEY_IS_RECORDABLE]:
+                self.recordable_product_ids.append(product_id)
+            if product[consts.KEY_IS_DELISTED]:
+                self.delisted_product_ids.append(product_id)
+
+    @staticmethod
+    def createProduct(product_id: str, base_currency: str, quote_currency: str, status, is_delisted: bool,
+                      is_recordable: bool = True) -> dict:
+        return {
+            consts.KEY_PRODUCTID: product_id,
+            consts.KEY_BASECURRENCY: base_currency,
+            consts.KEY_QUOTECURRENCY: quote_currency,
+            consts.KEY_STATUS: status,
+            consts.KEY_IS_DELISTED: is_delisted,
+            consts.KEY_IS_RECORDABLE: is_recordable
+        }
+
+    def getNumProducts(self) -> int:
+        return len(self.products)
+
+    def getProduct(self, product_id: str) -> dict | None:
+        return self.products_by_id.get(product_id)
+
+    # In the order returned by the exchange
+    def getRecordableProductIDs(self) -> list[str]:
+        return self.recordable_product_ids
+
+    def getDelistedProductIDs(self) -> list[str]:
+        return self.delisted_product_ids
+
+    def getProductIDsByBaseCurrency(self, base_currency: str) -> set[str]:
+        return self.product_ids_by_base_currency.get(base_currency, set())
+
+    def getProductIDsByQuoteCurrency(self, quote_currency: str) -> set[str]:
+        return self.product_ids_by_quote_currency.get(quote_currency, set())
+
+    def getProductIDsByStatus(self, status) -> set[str]:
+        return self.product_ids_by_status.get(str(status), set())
+
+    def isExpired(self, ttl_in_sec: float) -> bool:
+        return time.time() - self.fetch_time > ttl_in_sec
+
+    def save(self, filename: str) -> None:
+        temp_filename: str = f'{filename}.{os.getpid()}.tmp'
+        try:
+            with open(temp_filename, 'w') as f:
+                json.dump({consts.KEY_FETCH_TIME: self.fetch_time, consts.KEY_PRODUCTS: self.products}, f)
+            os.replace(temp_filename, filename)
+        except OSError as e:
+            logging.error(f'Could not write product catalog:{filename} ({e})')
+
+    @staticmethod
+    def load(filename: str):
+        if not os.path.isfile(filename):
+            return None
+        try:
+            with open(filename, 'r') as f:
+                data: dict = json.load(f)
+            return mdProductCatalog(data[consts.KEY_PRODUCTS], data[consts.KEY_FETCH_TIME])
+        except (OSError, ValueError, KeyError) as e:
+            logging.error(f'Could not read product catalog:{filename} ({e})')
+            return None
@@ -0,0 +1,197 @@
+import logging
+import math
+import multiprocessing
+import threading
+import time
+
+
+class consts:
+    RATE_LIMITER_FIXED = 'fixed'
+    RATE_LIMITER_ADAPTIVE = 'adaptive'
+    HEADER_RETRY_AFTER = 'Retry-After'
+    HEADER_BINANCE_USED_WEIGHT_1M = 'X-MBX-USED-WEIGHT-1M'
+    HEADER_KUCOIN_LIMIT = 'gw-ratelimit-limit'
+    HEADER_KUCOIN_REMAINING = 'gw-ratelimit-remaining'
+    HEADER_KUCOIN_RESET_MS = 'gw-ratelimit-reset'
+    DEFAULT_BINANCE_MAX_WEIGHT_PER_MINUTE = 6000
+    SAFETY_FACTOR = 0.9  # fraction of the remaining quota that the adaptive limiters plan to use
+    MIN_REQUESTS_PER_SEC = 0.1
+    COST_SMOOTHING_FACTOR = 0.2
+    # Indices into a limiter's state array
+    STATE_MAX_REQUESTS_PER_SEC = 0
+    STATE_THEORETICAL_ARRIVAL_TIME = 1
+    STATE_BLOCKED_UNTIL = 2
+    STATE_COST_PER_REQUEST = 3
+    STATE_LAST_REMAINING_QUOTA = 4
+    STATE_REQUESTS_IN_FLIGHT = 5
+    STATE_RESPONSES_SINCE_QUOTA_DROP = 6
+    STATE_QUOTA_RESET_TIME = 7
+    NUM_STATE_FIELDS = 8
+
+
+# Thread-safe token bucket (implemented as a generic cell rate algorithm, so that it never needs a background
+# thread). reserve() books a slot and returns how long the caller has to wait for it, acquire() also sleeps until then.
+# With process_shared, the state lives in shared memory and is guarded by a multiprocessing lock, so that one limiter
+# created by the supervisor keeps the rate limit global across all the worker processes it is passed to.
+class tokenBucketRateLimiter:
+    def __init__(self, max_requests_per_sec: float, process_shared: bool = False):
+        initial_state: list[float] = [0.0] * consts.NUM_STATE_FIELDS
+        initial_state[consts.STATE_MAX_REQUESTS_PER_SEC] = max_requests_per_sec
+        initial_state[consts.STATE_THEORETICAL_ARRIVAL_TIME] = time.monotonic()
+        initial_state[consts.STATE_COST_PER_REQUEST] = 1
+        initial_state[consts.STATE_LAST_REMAINING_QUOTA] = math.nan
+        if process_shared:
+            self.lock = multiprocessing.Lock()
+            self.state = multiprocessing.Array('d', initial_state, lock=False)
+        else:
+            self.lock = threading.Lock()
+            self.state = initial_state
+
+    def getRate(self) -> float:
+        return self.state[consts.STATE_MAX_REQUESTS_PER_SEC]
+
+    def setRate(self, max_requests_per_sec: float) -> None:
+        with self.lock:
+            self.state[consts.STATE_MAX_REQUESTS_PER_SEC] = max(consts.MIN_REQUESTS_PER_SEC, max_requests_per_sec)
+
+    def reserve(self, weight: float = 1) -> float:
+        with self.lock:
+            now: float = time.monotonic()
+            burst_tolerance: float = 1  # allow up to one second worth of requests in a burst
+            theoretical_arrival_time: float = self.state[consts.STATE_THEORETICAL_ARRIVAL_TIME]
+            start_time: float = max(now, theoretical_arrival_time - burst_tolerance,
+                                    self.state[consts.STATE_BLOCKED_UNTIL])
+            self.state[consts.STATE_THEORETICAL_ARRIVAL_TIME] = max(theoretical_arrival_time, start_time) + \
+                weight / self.state[consts.STATE_MAX_REQUESTS_PER_SEC]
+            return start_time - now
+
+    def acquire(self, weight: float = 1) -> float:
+        wait_time: float = self.reserve(weight)
+        if wait_time > 0:
+            time.sleep(wait_time)
+        return wait_time
+
+    def cooldown(self, cooldown_period_in_sec: float) -> None:
+        with self.lock:
+            self.state[consts.STATE_BLOCKED_UNTIL] = max(self.state[consts.STATE_BLOCKED_UNTIL],
+                                                         time.monotonic() + cooldown_period_in_sec)
+
+    # Returns the number of seconds to back off for after a rejected request
+    @staticmethod
+    def getRetryAfter(headers, default_cooldown_period_in_sec: float) -> float:
+        retry_after: str | None = headers.get(consts.HEADER_RETRY_AFTER) if headers else None
+        try:
+            return float(retry_after) if retry_after else default_cooldown_period_in_sec
+        except ValueError:
+            return default_cooldown_period_in_sec
+
+    # Must be called once for every reserved request: with the response, or via onRequestFailed if there is none
+    def updateFromResponse(self, status_code: int, headers) -> None:
+        pass
+
+    def onRequestFailed(self) -> None:
+        pass
+
+
+# Re-tunes its rate after every response from the quota the exchange reports as left in its current window, so that
+# it runs close to the real limit: rate = SAFETY_FACTOR * quota left / cost per request / time left in window, where
+# the quota left is the reported remaining quota minus what the requests still in flight will use. The rate never
+# exceeds the configured max_requests_per_sec.
+# The quota cost of a request is learned from how much the reported remaining quota drops between responses. With
+# concurrent requests, responses can arrive out of order, so a drop is spread over all the responses received since
+# the previous drop (the stale ones in between don't lower the remaining quota).
+class adaptiveRateLimiter(tokenBucketRateLimiter):
+    def __init__(self, max_requests_per_sec: float, process_shared: bool = False):
+        tokenBucketRateLimiter.__init__(self, max_requests_per_sec, process_shared)
+        self.configured_max_requests_per_sec: float = max_requests_per_sec
+
+    # Must return (remaining quota, seconds until the quota window resets) or None if the headers don't have them
+    def getQuota(self, headers) -> tuple[float, float] | None:
+        raise NotImplementedError('ERROR: Method getQuota must be defined in child class!')
+
+    def getCostPerRequest(self) -> float:
+        return self.state[consts.STATE_COST_PER_REQUEST]
+
+    def reserve(self, weight: float = 1) -> float:
+        with self.lock:
+            self.state[consts.STATE_REQUESTS_IN_FLIGHT] += 1
+        return tokenBucketRateLimiter.reserve(self, weight)
+
+    def onRequestFailed(self) -> None:
+        with self.lock:
+            self.state[consts.STATE_REQUESTS_IN_FLIGHT] = max(0.0, self.state[consts.STATE_REQUESTS_IN_FLIGHT] - 1)
+
+    def updateFromResponse(self, status_code: int, headers) -> None:
+        self.onRequestFailed()  # the request is no longer in flight
+        quota: tuple[float, float] | None = self.getQuota(headers) if headers else None
+        if quota is None:
+            return
+        remaining_quota, seconds_until_reset = quota
+        with self.lock:
+            last_remaining_quota: float = self.state[consts.STATE_LAST_REMAINING_QUOTA]
+            cost_per_request: float = self.state[consts.STATE_COST_PER_REQUEST]
+            quota_reset_time: float = time.monotonic() + seconds_until_reset
+            if quota_reset_time > self.state[consts.STATE_QUOTA_RESET_TIME] + 1:  # first response of a new window
+                self.state[consts.STATE_QUOTA_RESET_TIME] = quota_reset_time
+                self.state[consts.STATE_LAST_REMAINING_QUOTA] = remaining_quota
+                self.state[consts.STATE_RESPONSES_SINCE_QUOTA_DROP] = 0
+            else:
+                num_responses: float = self.state[consts.STATE_RESPONSES_SINCE_QUOTA_DROP] + 1
+                self.state[consts.STATE_RESPONSES_SINCE_QUOTA_DROP] = num_responses
+                if remaining_quota < last_remaining_quota:
+                    cost: float = (last_remaining_quota - remaining_quota) / num_responses
+                    cost_per_request += consts.COST_SMOOTHING_FACTOR * (cost - cost_per_request)
+                    self.state[consts.STATE_COST_PER_REQUEST] = cost_per_request
+                    self.state[consts.STATE_LAST_REMAINING_QUOTA] = remaining_quota
+                    self.state[consts.STATE_RESPONSES_SINCE_QUOTA_DROP] = 0
+            quota_left: float = self.state[consts.STATE_LAST_REMAINING_QUOTA] - \
+                self.state[consts.STATE_REQUESTS_IN_FLIGHT] * cost_per_request
+
+        if quota_left <= cost_per_request * 2:
+            logging.info(f'Rate limit quota almost used up (remaining:{remaining_quota} quotaLeft:{quota_left:.2f}). '
+                         f'Pausing for {seconds_until_reset:.2f}s until the quota resets')
+            self.cooldown(seconds_until_reset)
+            return
+        self.setRate(min(self.configured_max_requests_per_sec,
+                         consts.SAFETY_FACTOR * quota_left / cost_per_request / max(seconds_until_reset, 1)))
+
+
+# Binance reports the request weight used in the current minute in X-MBX-USED-WEIGHT-1M
+class binanceWeightRateLimiter(adaptiveRateLimiter):
+    def __init__(self, max_requests_per_sec: float, max_weight_per_minute: int, process_shared: bool = False):
+        adaptiveRateLimiter.__init__(self, max_requests_per_sec, process_shared)
+        self.max_weight_per_minute: int = max_weight_per_minute
+
+    def getQuota(self, headers) -> tuple[float, float] | None:
+        used_weight: str | None = headers.get(consts.HEADER_BINANCE_USED_WEIGHT_1M)
+        if used_weight is None:
+            return None
+        return self.max_weight_per_minute - float(used_weight), 60 - time.time() % 60
+
+
+# KuCoin reports the remaining quota of its current window and the milliseconds until the window resets
+class kucoinQuotaRateLimiter(adaptiveRateLimiter):
+    def getQuota(self, headers) -> tuple[float, float] | None:
+        remaining_quota: str | None = headers.get(consts.HEADER_KUCOIN_REMAINING)
+        reset_in_ms: str | None = headers.get(consts.HEADER_KUCOIN_RESET_MS)
+        if remaining_quota is None or reset_in_ms is None:
+            return None
+        return float(remaining_quota), float(reset_in_ms) / 1000
+
+
+def createRateLimiter(rate_limiter_type: str, exchange_name: str, max_api_requests_per_sec: int,
+                      max_request_weight_per_minute: int | None,
+                      process_shared: bool = False) -> tokenBucketRateLimiter:
+    if rate_limiter_type == consts.RATE_LIMITER_ADAPTIVE:
+        match exchange_name:
+            case 'BINANCE' | 'BINANCEFR':
+                return binanceWeightRateLimiter(max_api_requests_per_sec, max_request_weight_per_minute or
+                                                consts.DEFAULT_BINANCE_MAX_WEIGHT_PER_MINUTE, process_shared)
+            case 'KUCOIN':
+                return kucoinQuotaRateLimiter(max_api_requests_per_sec, process_shared)
+            case _:
+                logging.error(f'Adaptive rate limiter not supported for exchange:{exchange_name}. '
+                              f'Using fixed rate limiter instead.')
+    elif rate_limiter_type != consts.RATE_LIMITER_FIXED:
+        logging.error(f'Unsupported rate limiter:{rate_limiter_type}. Using fixed rate limiter instead.')
+    return tokenBucketRateLimiter(max_api_requests_per_sec, process_shared)
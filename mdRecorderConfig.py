@@ -1,3 +1,4 @@
+import re
 from configparser import ConfigParser
 
 
@@ -5,14 +6,30 @@ class mdRecorderConfig:
     KEY_DUMMYSECTION = 'dummy_section'
     KEY_EXCHANGENAME = 'exchange'
     KEY_APIURL = 'api_url'
+    KEY_WEBSOCKETURL = 'websocket_url'
     KEY_DATAHEADER = 'data_header'
     KEY_DATEKEY = 'date_key'
     KEY_MAXCANDLESPERREQUEST = 'maxCandlesPerRequest'
     KEY_MAXNUMBEROFAPIREQUESTPERSECOND = 'max_api_requests_per_second'
     KEY_COOLDOWNPERIODINSECONDS = 'cooldown_period_in_seconds'
+    KEY_MAXREQUESTRETRIES = 'max_request_retries'
     KEY_TIMEFRAMES = 'timeframes'
     KEY_INTERESTINGQUOTECURRENCIES = 'interesting_quote_currencies'
     KEY_INTERESTINGCOINS = 'interesting_coins'
+    KEY_PRIORITYSYMBOLS = 'priority_symbols'
+    KEY_RATELIMITER = 'rate_limiter'
+    KEY_MAXREQUESTWEIGHTPERMINUTE = 'max_request_weight_per_minute'
+    KEY_HTTPTRANSPORT = 'http_transport'
+    KEY_HTTPPOOLSIZE = 'http_pool_size'
+    KEY_HTTPKEEPALIVE = 'http_keep_alive'
+    KEY_HTTPCOMPRESSION = 'http_compression'
+    KEY_HTTP2 = 'http2'
+    KEY_DATATYPES = 'data_types'
+    KEY_PARQUETCOMPRESSION = 'parquet_compression'
+    KEY_PARQUETCOMPRESSIONLEVEL = 'parquet_compression_level'
+    KEY_PARQUETROWGROUPSIZE = 'parquet_row_group_size'
+    KEY_PARQUETDICTIONARYCOLUMNS = 'parquet_dictionary_columns'
+    KEY_PARQUETDELTACOLUMNS = 'parquet_delta_columns'
 
     def __init__(self, configFilePath: str):
         with open(configFilePath, 'r') as f:
@@ -28,6 +45,10 @@ class mdRecorderConfig:
         api_url: str = self.config.get(self.KEY_DUMMYSECTION, self.KEY_APIURL)
         return api_url
 
+    def getWebsocketURL(self) -> str | None:
+        websocket_url: str | None = self.config.get(self.KEY_DUMMYSECTION, self.KEY_WEBSOCKETURL, fallback=None)
+        return websocket_url.strip() if websocket_url else None
+
     def getHeaderColumns(self) -> list[str]:
         header: str = self.config.get(self.KEY_DUMMYSECTION, self.KEY_DATAHEADER)
         header_list = [x.strip() for x in header.split(',')]
@@ -49,6 +70,10 @@ class mdRecorderConfig:
         cooldown_period_in_sec: int = self.config.getint(self.KEY_DUMMYSECTION, self.KEY_COOLDOWNPERIODINSECONDS)
         return cooldown_period_in_sec
 
+    def getMaxRequestRetries(self) -> int:
+        max_request_retries: int = self.config.getint(self.KEY_DUMMYSECTION, self.KEY_MAXREQUESTRETRIES, fallback=10)
+        return max_request_retries
+
     def getTimeframes(self) -> list[str]:
         config_str: str = self.config.get(self.KEY_DUMMYSECTION, self.KEY_TIMEFRAMES)
         retval: list[str] = [x.strip() for x in config_str.split(',')]
@@ -68,3 +93,79 @@ class mdRecorderConfig:
             return []
         retval: list[str] = [x.strip() for x in config_str.split(',')]
         return retval
+
+    def getPrioritySymbols(self) -> list[str]:
+        config_str: str | None = self.config.get(self.KEY_DUMMYSECTION, self.KEY_PRIORITYSYMBOLS, fallback=None)
+        if config_str is None:
+            return []
+        retval: list[str] = [x.strip() for x in config_str.split(',') if x.strip()]
+        return retval
+
+    def getRateLimiterType(self) -> str | None:
+        rate_limiter_type: str | None = self.config.get(self.KEY_DUMMYSECTION, self.KEY_RATELIMITER, fallback=None)
+        return rate_limiter_type.strip() if rate_limiter_type else None
+
+    def getMaxRequestWeightPerMinute(self) -> int | None:
+        max_request_weight_per_minute: int | None = self.config.getint(self.KEY_DUMMYSECTION,
+                                                                       self.KEY_MAXREQUESTWEIGHTPERMINUTE,
+                                                                       fallback=None)
+        return max_request_weight_per_minute
+
+    def getHttpTransport(self) -> str:
+        http_transport: str = self.config.get(self.KEY_DUMMYSECTION, self.KEY_HTTPTRANSPORT, fallback='session')
+        return http_transport.strip()
+
+    def getHttpPoolSize(self) -> int:
+        http_pool_size: int = self.config.getint(self.KEY_DUMMYSECTION, self.KEY_HTTPPOOLSIZE, fallback=0)
+        return http_pool_size
+
+    def getHttpKeepAlive(self) -> bool:
+        http_keep_alive: bool = self.config.getboolean(self.KEY_DUMMYSECTION, self.KEY_HTTPKEEPALIVE, fallback=True)
+        return http_keep_alive
+
+    def getHttpCompression(self) -> bool:
+        http_compression: bool = self.config.getboolean(self.KEY_DUMMYSECTION, self.KEY_HTTPCOMPRESSION,
+                                                        fallback=True)
+        return http_compression
+
+    def getHttp2(self) -> bool:
+        http2: bool = self.config.getboolean(self.KEY_DUMMYSECTION, self.KEY_HTTP2, fallback=False)
+        return http2
+
+    # One type per data_header column. Commas inside parentheses (e.g. decimal(38, 18)) don't separate types.
+    def getDataTypes(self) -> list[str] | None:
+        config_str: str | None = self.config.get(self.KEY_DUMMYSECTION, self.KEY_DATATYPES, fallback=None)
+        if config_str is None:
+            return None
+        retval: list[str] = [x.strip() for x in re.split(r',(?![^()]*\))', config_str)]
+        return retval
+
+    def getParquetCompression(self) -> str:
+        parquet_compression: str = self.config.get(self.KEY_DUMMYSECTION, self.KEY_PARQUETCOMPRESSION,
+                                                   fallback='snappy')
+        return parquet_compression.strip()
+
+    def getParquetCompressionLevel(self) -> int | None:
+        parquet_compression_level: int | None = self.config.getint(self.KEY_DUMMYSECTION,
+                                                                   self.KEY_PARQUETCOMPRESSIONLEVEL, fallback=None)
+        return parquet_compression_level
+
+    def getParquetRowGroupSize(self) -> int | None:
+        parquet_row_group_size: int | None = self.config.getint(self.KEY_DUMMYSECTION, self.KEY_PARQUETROWGROUPSIZE,
+                                                                fallback=None)
+        return parquet_row_group_size
+
+    def getParquetDictionaryColumns(self) -> list[str] | None:
+        config_str: str | None = self.config.get(self.KEY_DUMMYSECTION, self.KEY_PARQUETDICTIONARYCOLUMNS,
+                                                 fallback=None)
+        if config_str is None:
+            return None
+        retval: list[str] = [x.strip() for x in config_str.split(',') if x.strip()]
+        return retval
+
+    def getParquetDeltaColumns(self) -> list[str]:
+        config_str: str | None = self.config.get(self.KEY_DUMMYSECTION, self.KEY_PARQUETDELTACOLUMNS, fallback=None)
+        if config_str is None:
+            return []
+        retval: list[str] = [x.strip() for x in config_str.split(',') if x.strip()]
+        return retval
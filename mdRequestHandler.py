@@ -0,0 +1,113 @@
+import logging
+import time
+
+import requests
+import requests.adapters
+
+from mdMetrics import consts as metrics_consts, mdMetrics
+from mdRateLimiter import tokenBucketRateLimiter
+
+
+class consts:
+    HTTP_STATUS_TOO_MANY_REQUESTS = 429
+    HTTP_STATUS_IP_BANNED = 418  # Binance returns this if requests keep coming in after a 429
+    HTTP_STATUS_SERVER_ERROR = 500
+    REQUEST_TIMEOUT_IN_SEC = 30
+    DEFAULT_MAX_RETRIES = 10
+    DEFAULT_POOL_SIZE = 10
+    MAX_POOLED_HOSTS = 4  # number of hosts a session keeps a connection pool for
+    ACCEPT_ENCODING_COMPRESSED = 'gzip, deflate'
+    ACCEPT_ENCODING_IDENTITY = 'identity'
+
+
+class mdRequestError(Exception):
+    pass
+
+
+# Drop-in replacement for totalRequestHandler whose rate limiting is done by a pluggable (and possibly adaptive)
+# rate limiter shared by all worker threads. All requests go through one session whose connection pool is sized to
+# the number of threads using it, so connections (and their TLS handshakes) are reused instead of being set up again
+# for every tiny candle request. With http2, the session is an httpx client if httpx (with h2) is installed.
+# Rate limited, server error and failed requests are retried after a cooldown, up to max_retries times, after which
+# get raises mdRequestError.
+class mdRequestHandler:
+    def __init__(self, rate_limiter: tokenBucketRateLimiter, cooldown_period_in_sec: int,
+                 pool_size: int = consts.DEFAULT_POOL_SIZE, keep_alive: bool = True, compression: bool = True,
+                 http2: bool = False, metrics: mdMetrics | None = None, max_retries: int = consts.DEFAULT_MAX_RETRIES):
+        self.rate_limiter: tokenBucketRateLimiter = rate_limiter
+        self.metrics: mdMetrics = metrics if metrics is not None else mdMetrics('')
+        self.cooldown_period_in_sec: int = cooldown_period_in_sec
+        self.max_retries: int = max(0, max_retries)
+        self.transport_errors: tuple[type[Exception], ...] = (requests.RequestException,)
+        self.session = None
+        if http2:
+            self.session = self.createHttp2Session(pool_size, keep_alive, compression)
+        if self.session is None:
+            self.session = self.createSession(pool_size, keep_alive, compression)
+
+    @staticmethod
+    def getDefaultHeaders(keep_alive: bool, compression: bool) -> dict[str, str]:
+        headers: dict[str, str] = {'Accept-Encoding': consts.ACCEPT_ENCODING_COMPRESSED if compression
+                                   else consts.ACCEPT_ENCODING_IDENTITY}
+        if not keep_alive:
+            headers['Connection'] = 'close'
+        return headers
+
+    @staticmethod
+    def createSession(pool_size: int, keep_alive: bool, compression: bool) -> requests.Session:
+        session: requests.Session = requests.Session()
+        # pool_block makes threads wait for a pooled connection instead of opening (and dropping) extra ones
+        adapter: requests.adapters.HTTPAdapter = requests.adapters.HTTPAdapter(
+            pool_connections=consts.MAX_POOLED_HOSTS, pool_maxsize=max(1, pool_size), pool_block=True)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        session.headers.update(mdRequestHandler.getDefaultHeaders(keep_alive, compression))
+        return session
+
+    def createHttp2Session(self, pool_size: int, keep_alive: bool, compression: bool):
+        try:
+            import httpx
+            session = httpx.Client(http2=True, headers=self.getDefaultHeaders(keep_alive, compression),
+                                   limits=httpx.Limits(max_connections=max(1, pool_size),
+                                                       max_keepalive_connections=pool_size if keep_alive else 0))
+        except ImportError as e:
+            logging.error(f'HTTP/2 requires httpx and h2 ({e}). Using HTTP/1.1 instead.')
+            return None
+        self.transport_errors = (httpx.HTTPError,)
+        return session
+
+    @staticmethod
+    def isRateLimitedOrServerError(status_code: int) -> bool:
+        return status_code in (consts.HTTP_STATUS_TOO_MANY_REQUESTS, consts.HTTP_STATUS_IP_BANNED) or \
+            status_code >= consts.HTTP_STATUS_SERVER_ERROR
+
+    # product and timeframe only label the request metrics
+    def get(self, url: str, params: dict[str, str] | None = None, product: str | None = None,
+            timeframe: str | None = None) -> requests.Response:
+        for _ in range(self.max_retries + 1):
+            self.metrics.observe(metrics_consts.RATE_LIMITER_WAIT, self.rate_limiter.acquire())
+            start_time: float = time.perf_counter()
+            try:
+                r: requests.Response = self.session.get(url, params=params, timeout=consts.REQUEST_TIMEOUT_IN_SEC)
+            except self.transport_errors as e:
+                self.metrics.observeRequest(url, metrics_consts.STATUS_TRANSPORT_ERROR,
+                                            time.perf_counter() - start_time, 0, product, timeframe)
+                self.rate_limiter.onRequestFailed()
+                logging.error(f'Caught exception "{e}" while requesting URL:{url} params:{params}. '
+                              f'Cooling down for {self.cooldown_period_in_sec}s')
+                self.rate_limiter.cooldown(self.cooldown_period_in_sec)
+                continue
+
+            self.metrics.observeRequest(url, r.status_code, time.perf_counter() - start_time, len(r.content),
+                                        product, timeframe)
+            self.rate_limiter.updateFromResponse(r.status_code, r.headers)
+            if self.isRateLimitedOrServerError(r.status_code):
+                cooldown: float = self.rate_limiter.getRetryAfter(r.headers, self.cooldown_period_in_sec)
+                logging.error(f'Received status:{r.status_code} for URL:{r.url}. Cooling down for {cooldown}s')
+                self.rate_limiter.cooldown(cooldown)
+                continue
+            return r
+        raise mdRequestError(f'Giving up on URL:{url} params:{params} after {self.max_retries} retries')
+
+    def close(self) -> None:
+        self.session.close()
@@ -0,0 +1,164 @@
+import json
+import logging
+import os
+import threading
+import time
+import zlib
+
+
+class consts:
+    KEY_LATEST_TIMESTAMP = 'latest_timestamp'
+    KEY_ROW_COUNT = 'row_count'
+    KEY_CHECKSUM = 'checksum'
+    KEY_FILE_SIZE = 'size'
+    KEY_FILE_MTIME = 'mtime_ns'
+    KEY_GAPS_SCANNED_UNTIL = 'gaps_scanned_until'
+    KEY_EMPTY_RANGES = 'empty_ranges'
+    CHECKSUM_BLOCK_SIZE = 1 << 16
+    SAVE_INTERVAL_IN_SEC = 5
+
+
+# Small on-disk index (one per exchange, kept in the output directory) that maps each market data file (keyed by its
+# path relative to the output directory) to its latest timestamp, row count and a checksum of its tail. An entry is
+# only trusted while the file's size and mtime (or tail checksum) still match, so files modified outside the recorder
+# are simply re-read. A series that is a directory (the partitioned layout) is validated against the data_filename
+# passed along with it, i.e. its latest partition.
+# With gap filling, an entry also keeps the timestamp up to which the file has been scanned for gaps and the ranges
+# that the exchange has no candles for (see MDRecorderBase.fillGaps). Those are kept when the entry is updated.
+# Updates only mark the index as dirty. It is saved at most every SAVE_INTERVAL_IN_SEC by the thread updating it, and
+# by flush() at the end of every recording pass, so a crash loses at most the last few seconds of entries (whose files
+# are then re-read).
+class mdResumeIndex:
+    def __init__(self, index_filename: str):
+        self.index_filename: str = index_filename
+        self.base_directory: str = os.path.dirname(index_filename) or os.curdir
+        self.lock: threading.Lock = threading.Lock()
+        self.save_lock: threading.Lock = threading.Lock()  # serializes writes of the index file
+        self.autosave: bool = True  # False in writer processes, where the owning process saves their updates
+        self.dirty: bool = False
+        self.last_save_time: float = time.monotonic()
+        self.entries: dict[str, dict] = {}
+        if os.path.isfile(index_filename):
+            try:
+                with open(index_filename, 'r') as f:
+                    self.entries = json.load(f)
+            except (OSError, ValueError) as e:
+                logging.error(f'Could not read resume index:{index_filename} ({e}). Starting with an empty index.')
+                self.entries = {}
+
+    def __getstate__(self) -> dict:
+        state: dict = self.__dict__.copy()
+        del state['lock']
+        del state['save_lock']
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+
+    def getKey(self, filename: str) -> str:
+        return os.path.relpath(filename, self.base_directory)
+
+    @staticmethod
+    def getTailChecksum(filename: str) -> int:
+        with open(filename, 'rb') as f:
+            position: int = f.seek(0, os.SEEK_END)
+            f.seek(max(0, position - consts.CHECKSUM_BLOCK_SIZE))
+            return zlib.crc32(f.read())
+
+    def getEntry(self, filename: str, data_filename: str | None = None) -> dict | None:
+        data_filename = data_filename or filename
+        with self.lock:
+            entry: dict | None = self.entries.get(self.getKey(filename))
+        if entry is None or not os.path.isfile(data_filename):
+            return None
+
+        stat: os.stat_result = os.stat(data_filename)
+        if stat.st_size != entry[consts.KEY_FILE_SIZE]:
+            return None
+        if stat.st_mtime_ns != entry[consts.KEY_FILE_MTIME] and \
+                self.getTailChecksum(data_filename) != entry[consts.KEY_CHECKSUM]:
+            return None
+        return entry
+
+    def getLatestTimestamp(self, filename: str) -> int | None:
+        entry: dict | None = self.getEntry(filename)
+        return None if entry is None else entry[consts.KEY_LATEST_TIMESTAMP]
+
+    def getRowCount(self, filename: str) -> int | None:
+        entry: dict | None = self.getEntry(filename)
+        return None if entry is None else entry[consts.KEY_ROW_COUNT]
+
+    # Only trusted while the file is unchanged, like the rest of the entry
+    def getGapsScannedUntil(self, filename: str, data_filename: str | None = None) -> int | None:
+        entry: dict | None = self.getEntry(filename, data_filename)
+        return None if entry is None else entry.get(consts.KEY_GAPS_SCANNED_UNTIL)
+
+    # Still valid if the file was modified, since they are about the exchange's data
+    def getEmptyRanges(self, filename: str) -> list[tuple[int, int]]:
+        entry: dict | None = self.getRawEntry(filename)
+        return [] if entry is None else [(start, end) for start, end in entry.get(consts.KEY_EMPTY_RANGES, [])]
+
+    def setGapScan(self, filename: str, scanned_until: int, empty_ranges: list[tuple[int, int]]) -> None:
+        entry: dict | None = self.getRawEntry(filename)
+        if entry is None:
+            return
+        entry = dict(entry)
+        entry[consts.KEY_GAPS_SCANNED_UNTIL] = int(scanned_until)
+        entry[consts.KEY_EMPTY_RANGES] = [[int(start), int(end)] for start, end in empty_ranges]
+        self.setRawEntry(filename, entry)
+
+    def update(self, filename: str, latest_timestamp: int, row_count: int | None,
+               data_filename: str | None = None) -> None:
+        data_filename = data_filename or filename
+        stat: os.stat_result = os.stat(data_filename)
+        entry: dict = {
+            consts.KEY_LATEST_TIMESTAMP: int(latest_timestamp),
+            consts.KEY_ROW_COUNT: row_count,
+            consts.KEY_CHECKSUM: self.getTailChecksum(data_filename),
+            consts.KEY_FILE_SIZE: stat.st_size,
+            consts.KEY_FILE_MTIME: stat.st_mtime_ns
+        }
+        previous_entry: dict | None = self.getRawEntry(filename)
+        for key in (consts.KEY_GAPS_SCANNED_UNTIL, consts.KEY_EMPTY_RANGES):
+            if previous_entry is not None and key in previous_entry:
+                entry[key] = previous_entry[key]
+        self.setRawEntry(filename, entry)
+
+    # Unvalidated entry, e.g. to hand it to (or take it over from) a writer process
+    def getRawEntry(self, filename: str) -> dict | None:
+        with self.lock:
+            return self.entries.get(self.getKey(filename))
+
+    def setRawEntry(self, filename: str, entry: dict | None) -> None:
+        with self.lock:
+            if entry is None:
+                self.entries.pop(self.getKey(filename), None)
+            else:
+                self.entries[self.getKey(filename)] = entry
+            self.dirty = True
+            save_due: bool = self.autosave and time.monotonic() - self.last_save_time >= consts.SAVE_INTERVAL_IN_SEC
+        if save_due:
+            self.save()
+
+    # Saves the index if it has unsaved updates
+    def flush(self) -> None:
+        if self.autosave and self.dirty:
+            self.save()
+
+    # Writes to a temp file and renames it so that a crash never leaves a half written index behind. Only the copy of
+    # the entries is made under the lock, so updates don't wait for the index to be serialized.
+    def save(self) -> None:
+        with self.save_lock:
+            with self.lock:
+                entries: dict[str, dict] = dict(self.entries)
+                self.dirty = False
+                self.last_save_time = time.monotonic()
+            temp_filename: str = f'{self.index_filename}.{os.getpid()}.tmp'
+            try:
+                with open(temp_filename, 'w') as f:
+                    json.dump(entries, f, separators=(',', ':'))
+                os.replace(temp_filename, self.index_filename)
+            except OSError as e:
+                logging.error(f'Could not write resume index:{self.index_filename} ({e})')
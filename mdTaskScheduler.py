@@ -0,0 +1,76 @@
+import collections
+import threading
+
+
+class consts:
+    # Tasks expected to need more requests than this are backfills, whose concurrency is capped
+    MIN_BACKFILL_REQUESTS = 10
+    DEFAULT_BACKFILL_WORKER_SHARE = 0.5
+
+
+# One product/timeframe download, with its expected cost (number of requests, estimated from the latest timestamp of
+# its file, the candle interval and the max number of candles per request)
+class mdRecordingTask:
+    def __init__(self, product_id: str, timeframe: str, is_delisted: bool, expected_num_requests: float,
+                 is_priority: bool):
+        self.product_id: str = product_id
+        self.timeframe: str = timeframe
+        self.is_delisted: bool = is_delisted
+        self.expected_num_requests: float = expected_num_requests
+        self.is_priority: bool = is_priority
+
+    def isBackfill(self) -> bool:
+        return self.expected_num_requests > consts.MIN_BACKFILL_REQUESTS
+
+    # Priority products first, then cheapest first (within the updates and within the backfills)
+    def getSortKey(self) -> tuple:
+        return not self.is_priority, self.expected_num_requests
+
+
+# Hands out recording tasks to at most max_running_tasks workers at a time, of which up to max_running_backfills run
+# backfills alongside the updates (a priority update still goes before a non-priority backfill). The other workers keep
+# serving the updates, and the cap also holds once only backfills are left, so long backfills never take every worker.
+# Thread-safe, since tasks are handed out from the completion callbacks of the tasks before them.
+class mdTaskScheduler:
+    def __init__(self, tasks: list[mdRecordingTask], max_running_tasks: int, max_running_backfills: int):
+        sorted_tasks: list[mdRecordingTask] = sorted(tasks, key=mdRecordingTask.getSortKey)
+        self.updates: collections.deque[mdRecordingTask] = collections.deque(x for x in sorted_tasks
+                                                                             if not x.isBackfill())
+        self.backfills: collections.deque[mdRecordingTask] = collections.deque(x for x in sorted_tasks
+                                                                               if x.isBackfill())
+        self.num_tasks: int = len(tasks)
+        self.max_running_tasks: int = max(1, max_running_tasks)
+        self.max_running_backfills: int = max(1, max_running_backfills)
+        self.num_running_tasks: int = 0
+        self.num_running_backfills: int = 0
+        self.lock: threading.Lock = threading.Lock()
+
+    def getNumTasks(self) -> int:
+        return self.num_tasks
+
+    def getNumBackfills(self) -> int:
+        return len(self.backfills)
+
+    # Returns None if all tasks have been handed out or no worker may start one right now
+    def popNextTask(self) -> mdRecordingTask | None:
+        with self.lock:
+            if self.num_running_tasks >= self.max_running_tasks:
+                return None
+            may_start_backfill: bool = bool(self.backfills) and \
+                self.num_running_backfills < self.max_running_backfills and \
+                (not self.updates or self.backfills[0].is_priority or not self.updates[0].is_priority)
+            if may_start_backfill:
+                task: mdRecordingTask = self.backfills.popleft()
+                self.num_running_backfills += 1
+            elif self.updates:
+                task = self.updates.popleft()
+            else:
+                return None
+            self.num_running_tasks += 1
+            return task
+
+    def onTaskDone(self, task: mdRecordingTask) -> None:
+        with self.lock:
+            self.num_running_tasks -= 1
+            if task.isBackfill():
+                self.num_running_backfills -= 1